@@ -0,0 +1,56 @@
+"""Measure worker cold-start time: importing main in a fresh interpreter, and loading the tokenizer.
+
+Usage: python bench_startup.py [--runs N]
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+
+IMPORT_SNIPPET = "import time; start = time.perf_counter(); import main; print(time.perf_counter() - start)"
+TOKENIZER_SNIPPET = (
+    "import time; from tokenizer import tokenizer; start = time.perf_counter(); "
+    "tokenizer.get_encoding(); print(time.perf_counter() - start)"
+)
+
+def run_snippet(snippet: str) -> float:
+    """Run a snippet in a fresh interpreter and return the seconds it reports"""
+    result = subprocess.run(
+        [sys.executable, "-c", snippet],
+        cwd=BACKEND_DIR,
+        capture_output=True,
+        text=True,
+        check=True
+    )
+    return float(result.stdout.strip().splitlines()[-1])
+
+def report(name: str, samples: list) -> None:
+    print(
+        f"{name:<16} min {min(samples) * 1000:8.1f} ms  "
+        f"median {statistics.median(samples) * 1000:8.1f} ms  "
+        f"max {max(samples) * 1000:8.1f} ms"
+    )
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args()
+
+    wall = []
+    imports = []
+    for _ in range(args.runs):
+        start = time.perf_counter()
+        imports.append(run_snippet(IMPORT_SNIPPET))
+        wall.append(time.perf_counter() - start)
+    tokenizer_loads = [run_snippet(TOKENIZER_SNIPPET) for _ in range(args.runs)]
+
+    report("import main", imports)
+    report("process total", wall)
+    report("tokenizer load", tokenizer_loads)
+
+if __name__ == "__main__":
+    main()
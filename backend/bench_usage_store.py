@@ -0,0 +1,69 @@
+"""Measure the per-request latency the Redis usage store adds over the in-memory one.
+
+Each iteration does what a metered chat request does: reserve, read usage, add usage, release.
+Usage: REDIS_URL=redis://localhost:6379 python bench_usage_store.py [--iterations N] [--budget-ms 1.0]
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+import redis.asyncio as aioredis
+from usage_store import InMemoryUsageStore, RedisUsageStore
+
+def percentile(samples: list, fraction: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+async def measure(store, iterations: int) -> dict:
+    """Per-operation latencies in milliseconds"""
+    timings = {"reserve": [], "get": [], "incr": [], "release": []}
+    for i in range(iterations):
+        username = f"bench:{i % 100}"
+
+        start = time.perf_counter()
+        _, _, reservation_id = await store.reserve(username, 10**9, None, 100, 32, 8192, 60)
+        timings["reserve"].append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        await store.get(username)
+        timings["get"].append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        await store.incr(username, 150)
+        timings["incr"].append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        await store.release(username, reservation_id)
+        timings["release"].append(time.perf_counter() - start)
+    return {op: [t * 1000 for t in samples] for op, samples in timings.items()}
+
+async def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--iterations", type=int, default=5000)
+    parser.add_argument("--budget-ms", type=float, default=1.0)
+    args = parser.parse_args()
+
+    client = aioredis.from_url(os.getenv("REDIS_URL", "redis://localhost:6379"), decode_responses=True)
+    try:
+        memory = await measure(InMemoryUsageStore(), args.iterations)
+        # Warm the connection and script cache before timing
+        await measure(RedisUsageStore(client), 100)
+        redis_timings = await measure(RedisUsageStore(client), args.iterations)
+    finally:
+        await client.close()
+
+    failed = False
+    print(f"{'op':<8} {'memory p99':>12} {'redis p50':>12} {'redis p99':>12} {'added p99':>12}")
+    for op in memory:
+        added = percentile(redis_timings[op], 0.99) - percentile(memory[op], 0.99)
+        failed = failed or added > args.budget_ms
+        print(
+            f"{op:<8} {percentile(memory[op], 0.99):10.3f}ms {percentile(redis_timings[op], 0.5):10.3f}ms "
+            f"{percentile(redis_timings[op], 0.99):10.3f}ms {added:10.3f}ms"
+        )
+    print("FAIL" if failed else "PASS", f"(budget {args.budget_ms}ms added at p99 per operation)")
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))
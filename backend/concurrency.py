@@ -0,0 +1,166 @@
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Dict, Any, Optional
+import asyncio
+import logging
+import os
+import time
+from dotenv import load_dotenv
+import httpx
+
+load_dotenv()
+
+class ConcurrencyLimitExceeded(Exception):
+    """Raised when the wait queue is full or a queued call waited too long"""
+
+    def __init__(self, message: str, retry_after: int):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+def is_upstream_overload(exc: BaseException) -> bool:
+    """Errors that mean the upstream is congested and concurrency should back off"""
+    if isinstance(exc, (httpx.TimeoutException, asyncio.TimeoutError)):
+        return True
+    if isinstance(exc, httpx.HTTPStatusError):
+        return exc.response.status_code in (429, 502, 503, 504)
+    return False
+
+class UpstreamSlot:
+    """Handle for one admitted call; streams mark their first chunk on it"""
+
+    def __init__(self):
+        self.start = time.monotonic()
+        self.first_chunk_latency: Optional[float] = None
+
+    def mark_first_chunk(self) -> None:
+        if self.first_chunk_latency is None:
+            self.first_chunk_latency = time.monotonic() - self.start
+
+class AdaptiveConcurrencyLimiter:
+    """AIMD concurrency limit for upstream LLM calls with a bounded FIFO wait queue"""
+
+    LATENCY_WINDOW = 1000
+
+    def __init__(self):
+        self.min_limit = int(os.getenv('LLM_CONCURRENCY_MIN', 1))
+        self.max_limit = int(os.getenv('LLM_CONCURRENCY_MAX', 100))
+        self.limit = float(os.getenv('LLM_CONCURRENCY_INITIAL', 10))
+        self.max_queue = int(os.getenv('LLM_QUEUE_SIZE', 100))
+        self.queue_timeout = float(os.getenv('LLM_QUEUE_TIMEOUT', 5.0))
+        # Time to first streamed chunk above which the upstream counts as congested
+        self.target_latency = float(os.getenv('LLM_TARGET_LATENCY', 15.0))
+        self.backoff_ratio = float(os.getenv('LLM_BACKOFF_RATIO', 0.9))
+        self.in_flight = 0
+        self._waiters: deque = deque()
+        self._queue_times: deque = deque(maxlen=self.LATENCY_WINDOW)
+        self.stats = {
+            'admitted': 0,
+            'queued': 0,
+            'rejected_queue_full': 0,
+            'rejected_queue_timeout': 0,
+            'successes': 0,
+            'overloads': 0,
+            'slow_first_chunks': 0
+        }
+
+    def _retry_after(self) -> int:
+        return max(1, int(self.queue_timeout))
+
+    def _wake_waiters(self) -> None:
+        while self._waiters and self.in_flight < int(self.limit):
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                self.in_flight += 1
+                waiter.set_result(None)
+
+    async def _acquire(self) -> None:
+        if self.in_flight < int(self.limit) and not self._waiters:
+            self.in_flight += 1
+            self._queue_times.append(0.0)
+            self.stats['admitted'] += 1
+            return
+
+        if len(self._waiters) >= self.max_queue:
+            self.stats['rejected_queue_full'] += 1
+            raise ConcurrencyLimitExceeded("Upstream queue is full", self._retry_after())
+
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        self.stats['queued'] += 1
+        start = time.monotonic()
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter), self.queue_timeout)
+        except asyncio.TimeoutError:
+            if waiter.done():
+                # Admitted just as the timeout fired; hand the slot back
+                self._release(success=None)
+            else:
+                waiter.cancel()
+                try:
+                    self._waiters.remove(waiter)
+                except ValueError:
+                    pass
+            self.stats['rejected_queue_timeout'] += 1
+            raise ConcurrencyLimitExceeded("Timed out waiting for upstream capacity", self._retry_after())
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                self._release(success=None)
+            else:
+                waiter.cancel()
+            raise
+
+        self._queue_times.append(time.monotonic() - start)
+        self.stats['admitted'] += 1
+
+    def _release(self, success: Optional[bool]) -> None:
+        """Free a slot and adjust the limit; success=None leaves the limit unchanged"""
+        self.in_flight -= 1
+        if success is None:
+            pass
+        elif success:
+            # Additive increase: roughly +1 per full window of successful calls
+            self.limit = min(self.max_limit, self.limit + 1 / max(self.limit, 1))
+            self.stats['successes'] += 1
+        else:
+            # Multiplicative decrease on overload signals
+            self.limit = max(self.min_limit, self.limit * self.backoff_ratio)
+            self.stats['overloads'] += 1
+            logging.warning(f"Upstream overload, concurrency limit now {int(self.limit)}")
+        self._wake_waiters()
+
+    @asynccontextmanager
+    async def acquire(self):
+        """Hold an upstream slot for the duration of the block.
+
+        Total call time is not a congestion signal, since long answers take long
+        to generate; only overload errors and a slow first streamed chunk are.
+        """
+        await self._acquire()
+        slot = UpstreamSlot()
+        try:
+            yield slot
+        except BaseException as e:
+            # Only congestion signals shrink the limit; other errors are neutral
+            self._release(success=False if is_upstream_overload(e) else None)
+            raise
+        slow_start = slot.first_chunk_latency is not None and slot.first_chunk_latency > self.target_latency
+        if slow_start:
+            self.stats['slow_first_chunks'] += 1
+        self._release(success=not slow_start)
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Get the current limit, queue depth and queue-time percentiles"""
+        queue_times = sorted(self._queue_times)
+        count = len(queue_times)
+        return {
+            **self.stats,
+            'limit': int(self.limit),
+            'in_flight': self.in_flight,
+            'queue_depth': len(self._waiters),
+            'queue_time_avg': sum(queue_times) / count if count else 0.0,
+            'queue_time_p95': queue_times[min(count - 1, int(count * 0.95))] if count else 0.0,
+            'queue_time_max': queue_times[-1] if count else 0.0
+        }
+
+# Initialize upstream concurrency limiter
+deepseek_limiter = AdaptiveConcurrencyLimiter()
@@ -0,0 +1,15 @@
+import asyncio
+import fakeredis
+import pytest
+
+def make_fake_redis():
+    """In-process Redis on a fresh server; Lua scripts run through lupa"""
+    return fakeredis.aioredis.FakeRedis(server=fakeredis.FakeServer(), decode_responses=True)
+
+@pytest.fixture(params=["memory", "redis"])
+def backend(request):
+    """Both backends must behave the same"""
+    return request.param
+
+def run(coro):
+    return asyncio.run(coro)
@@ -1,5 +1,6 @@
 from datetime import datetime, timezone
 from typing import Dict, Any, List
+import logging
 import os
 from dotenv import load_dotenv
 from fastapi import HTTPException
@@ -12,7 +13,9 @@ class CostTracker:
             'input_tokens': 0,
             'output_tokens': 0,
             'cache_hits': 0,
-            'cache_misses': 0
+            'cache_misses': 0,
+            'input_cache_hit_tokens': 0,
+            'input_cache_miss_tokens': 0
         }
         self.pricing = self._get_pricing()
         self.budget = float(os.getenv('DEEPSEEK_BUDGET', 2.0))
@@ -77,19 +80,31 @@ class CostTracker:
             'projected_total_cost': self.total_cost + (avg_cost * remaining_requests)
         }
 
-    def track_usage(self, input_tokens: int, output_tokens: int, cache_hit: bool = False):
+    def track_usage(self, input_tokens: int, output_tokens: int, cache_hit: bool = False,
+                    cache_hit_tokens: int = None, enforce_budget: bool = True):
         """Track token usage and update statistics"""
+        # cache_hit_tokens are input tokens served from DeepSeek's context cache;
+        # without it, cache_hit bills all or none of the input as hits
+        if cache_hit_tokens is None:
+            cache_hit_tokens = input_tokens if cache_hit else 0
+        cache_miss_tokens = input_tokens - cache_hit_tokens
+
         self.usage['input_tokens'] += input_tokens
         self.usage['output_tokens'] += output_tokens
+        self.usage['input_cache_hit_tokens'] += cache_hit_tokens
+        self.usage['input_cache_miss_tokens'] += cache_miss_tokens
         
-        if cache_hit:
+        if cache_hit_tokens > 0:
             self.usage['cache_hits'] += 1
         else:
             self.usage['cache_misses'] += 1
 
         # Calculate cost for this request
         pricing = self._get_pricing()
-        input_cost = pricing['input_cache_hit'] * input_tokens / 1000000 if cache_hit else pricing['input_cache_miss'] * input_tokens / 1000000
+        input_cost = (
+            pricing['input_cache_hit'] * cache_hit_tokens / 1000000 +
+            pricing['input_cache_miss'] * cache_miss_tokens / 1000000
+        )
         output_cost = pricing['output'] * output_tokens / 1000000
         request_cost = input_cost + output_cost
         
@@ -113,9 +128,44 @@ class CostTracker:
             self.alert_history.extend(alerts)
 
         # Check if we've exceeded budget
-        if self.total_cost > self.budget:
+        if enforce_budget and self.total_cost > self.budget:
             raise Exception(f"Budget exceeded! Current cost: ${self.total_cost:.2f}, Budget: ${self.budget:.2f}")
 
+    def track_api_usage(self, usage: Dict[str, Any]):
+        """Track usage from a DeepSeek `usage` block, billing context-cache hits separately"""
+        input_tokens = usage.get('prompt_tokens', 0)
+        cache_hit_tokens = usage.get('prompt_cache_hit_tokens', 0)
+        if 'prompt_cache_miss_tokens' in usage:
+            input_tokens = cache_hit_tokens + usage['prompt_cache_miss_tokens']
+
+        # Called after the upstream has already been paid, so only record the spend:
+        # raising here would throw away an answer that was billed anyway
+        was_over_budget = self.total_cost > self.budget
+        self.track_usage(
+            input_tokens,
+            usage.get('completion_tokens', 0),
+            cache_hit_tokens=cache_hit_tokens,
+            enforce_budget=False
+        )
+        if not was_over_budget and self.total_cost > self.budget:
+            logging.warning(f"API spend ${self.total_cost:.2f} passed the ${self.budget:.2f} budget")
+
+    def get_context_cache_stats(self) -> Dict[str, Any]:
+        """Get DeepSeek context-cache hit rate and the input cost it saved"""
+        pricing = self._get_pricing()
+        hit_tokens = self.usage['input_cache_hit_tokens']
+        input_tokens = self.usage['input_tokens']
+        return {
+            'input_cache_hit_tokens': hit_tokens,
+            'input_cache_miss_tokens': self.usage['input_cache_miss_tokens'],
+            'token_hit_rate': hit_tokens / input_tokens if input_tokens else 0.0,
+            'requests_with_hits': self.usage['cache_hits'],
+            'requests_without_hits': self.usage['cache_misses'],
+            'estimated_savings': (pricing['input_cache_miss'] - pricing['input_cache_hit']) * hit_tokens / 1000000,
+            'total_cost': self.total_cost,
+            'over_budget': self.total_cost > self.budget
+        }
+
     def set_budget(self, amount: float) -> Dict[str, Any]:
         """Set new budget amount with validation and history tracking"""
         try:
@@ -174,17 +224,19 @@ class CostTracker:
         
         # Calculate costs in USD
         input_cost = (
-            (self.usage['cache_hits'] * pricing['input_cache_hit'] * 1000000) +
-            (self.usage['cache_misses'] * pricing['input_cache_miss'] * 1000000)
+            (self.usage['input_cache_hit_tokens'] * pricing['input_cache_hit'] / 1000000) +
+            (self.usage['input_cache_miss_tokens'] * pricing['input_cache_miss'] / 1000000)
         )
         
-        output_cost = self.usage['output_tokens'] * pricing['output'] * 1000000
+        output_cost = self.usage['output_tokens'] * pricing['output'] / 1000000
         
         return {
             'input_tokens': self.usage['input_tokens'],
             'output_tokens': self.usage['output_tokens'],
             'cache_hits': self.usage['cache_hits'],
             'cache_misses': self.usage['cache_misses'],
+            'input_cache_hit_tokens': self.usage['input_cache_hit_tokens'],
+            'input_cache_miss_tokens': self.usage['input_cache_miss_tokens'],
             'input_cost': input_cost,
             'output_cost': output_cost,
             'total_cost': self.total_cost,
@@ -199,7 +251,9 @@ class CostTracker:
             'input_tokens': 0,
             'output_tokens': 0,
             'cache_hits': 0,
-            'cache_misses': 0
+            'cache_misses': 0,
+            'input_cache_hit_tokens': 0,
+            'input_cache_miss_tokens': 0
         }
         self.total_cost = 0.0
 
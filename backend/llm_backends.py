@@ -0,0 +1,244 @@
+from abc import ABC, abstractmethod
+from typing import Any, AsyncIterator, Dict, List, Optional
+import asyncio
+import hashlib
+import json
+import os
+from dotenv import load_dotenv
+import httpx
+import openai
+from openai import AsyncOpenAI
+
+load_dotenv()
+
+class LLMBackend(ABC):
+    """Async chat-completion backend returning DeepSeek-shaped responses and chunks"""
+
+    name = "base"
+    requires_api_key = False
+
+    @abstractmethod
+    async def complete(self, messages: List[Dict[str, str]], model: str, temperature: float,
+                       max_tokens: Optional[int] = None) -> Dict[str, Any]:
+        """Return a full completion with `choices` and `usage`"""
+
+    @abstractmethod
+    def stream(self, messages: List[Dict[str, str]], model: str, temperature: float,
+               max_tokens: Optional[int] = None) -> AsyncIterator[Dict[str, Any]]:
+        """Yield completion chunks with `choices[].delta`; the last one carries `usage`"""
+
+    async def aclose(self) -> None:
+        """Release pooled connections"""
+
+class DeepSeekHTTPBackend(LLMBackend):
+    """DeepSeek chat completions over a pooled keep-alive httpx client"""
+
+    name = "deepseek"
+    requires_api_key = True
+
+    def __init__(self):
+        self.api_url = os.getenv('DEEPSEEK_API_URL', 'https://api.deepseek.com/v1/chat/completions')
+        self.timeout = float(os.getenv('DEEPSEEK_TIMEOUT', 30.0))
+        self.max_connections = int(os.getenv('DEEPSEEK_MAX_CONNECTIONS', 100))
+        self.max_keepalive = int(os.getenv('DEEPSEEK_MAX_KEEPALIVE', 20))
+        self.keepalive_expiry = float(os.getenv('DEEPSEEK_KEEPALIVE_EXPIRY', 30.0))
+        self.http2 = os.getenv('DEEPSEEK_HTTP2', 'true').lower() == 'true'
+        self.client: Optional[httpx.AsyncClient] = None
+
+    def get_client(self) -> httpx.AsyncClient:
+        """Return the shared client, creating it on first use"""
+        if self.client is None or self.client.is_closed:
+            self.client = httpx.AsyncClient(
+                http2=self.http2,
+                timeout=self.timeout,
+                limits=httpx.Limits(
+                    max_connections=self.max_connections,
+                    max_keepalive_connections=self.max_keepalive,
+                    keepalive_expiry=self.keepalive_expiry
+                )
+            )
+        return self.client
+
+    def _headers(self, stream: bool = False) -> Dict[str, str]:
+        api_key = os.getenv("DEEPSEEK_API_KEY")
+        if not api_key:
+            raise ValueError("DEEPSEEK_API_KEY not set")
+        headers = {
+            "Authorization": f"Bearer {api_key}",
+            "Content-Type": "application/json"
+        }
+        if stream:
+            headers["Accept"] = "text/event-stream"
+        return headers
+
+    @staticmethod
+    def _payload(messages, model, temperature, max_tokens) -> Dict[str, Any]:
+        data = {
+            "model": model,
+            "messages": messages,
+            "temperature": temperature
+        }
+        if max_tokens is not None:
+            data["max_tokens"] = max_tokens
+        return data
+
+    async def complete(self, messages, model, temperature, max_tokens=None):
+        response = await self.get_client().post(
+            self.api_url,
+            headers=self._headers(),
+            json=self._payload(messages, model, temperature, max_tokens)
+        )
+        response.raise_for_status()
+        return response.json()
+
+    async def stream(self, messages, model, temperature, max_tokens=None):
+        data = self._payload(messages, model, temperature, max_tokens)
+        data["stream"] = True
+        data["stream_options"] = {"include_usage": True}
+
+        async with self.get_client().stream("POST", self.api_url, headers=self._headers(stream=True), json=data) as response:
+            response.raise_for_status()
+            async for line in response.aiter_lines():
+                if not line.startswith("data:"):
+                    continue
+                payload = line[len("data:"):].strip()
+                if payload == "[DONE]":
+                    break
+                yield json.loads(payload)
+
+    async def aclose(self):
+        if self.client is not None:
+            await self.client.aclose()
+
+class OpenAISDKBackend(LLMBackend):
+    """DeepSeek through the async OpenAI SDK, with SDK errors mapped to httpx errors"""
+
+    name = "openai"
+    requires_api_key = True
+
+    def __init__(self):
+        self.client = AsyncOpenAI(
+            api_key=os.getenv("DEEPSEEK_API_KEY") or "missing",
+            base_url=os.getenv('OPENAI_BASE_URL', 'https://api.deepseek.com'),
+            timeout=float(os.getenv('DEEPSEEK_TIMEOUT', 30.0)),
+            # Retries are handled by the resilience layer
+            max_retries=0
+        )
+
+    @staticmethod
+    def _translate(e: Exception) -> Exception:
+        """Map SDK exceptions onto the httpx errors the retry and limiter layers classify"""
+        if isinstance(e, openai.APITimeoutError):
+            return httpx.ReadTimeout(str(e), request=e.request)
+        if isinstance(e, openai.APIStatusError):
+            return httpx.HTTPStatusError(str(e), request=e.response.request, response=e.response)
+        if isinstance(e, openai.APIConnectionError):
+            return httpx.ConnectError(str(e), request=e.request)
+        return e
+
+    async def complete(self, messages, model, temperature, max_tokens=None):
+        try:
+            response = await self.client.chat.completions.create(
+                model=model,
+                messages=messages,
+                temperature=temperature,
+                max_tokens=max_tokens,
+                stream=False
+            )
+        except openai.OpenAIError as e:
+            raise self._translate(e) from e
+        return response.model_dump()
+
+    async def stream(self, messages, model, temperature, max_tokens=None):
+        try:
+            chunks = await self.client.chat.completions.create(
+                model=model,
+                messages=messages,
+                temperature=temperature,
+                max_tokens=max_tokens,
+                stream=True,
+                extra_body={"stream_options": {"include_usage": True}}
+            )
+            async for chunk in chunks:
+                yield chunk.model_dump()
+        except openai.OpenAIError as e:
+            raise self._translate(e) from e
+
+    async def aclose(self):
+        await self.client.close()
+
+class StubBackend(LLMBackend):
+    """Deterministic in-process backend for CI and load tests, no network access"""
+
+    name = "stub"
+
+    def __init__(self):
+        self.latency = float(os.getenv('STUB_LLM_LATENCY', 0.0))
+        self.chunk_delay = float(os.getenv('STUB_LLM_CHUNK_DELAY', 0.0))
+        self.requests = 0
+
+    @staticmethod
+    def _answer(messages) -> str:
+        prompt = messages[-1]["content"] if messages else ""
+        digest = hashlib.sha256(prompt.encode("utf-8")).hexdigest()[:8]
+        return f"Stub answer {digest}: step 1, read the problem. Step 2, solve it. Final answer: {prompt}"
+
+    @staticmethod
+    def _usage(messages, content: str) -> Dict[str, int]:
+        prompt_tokens = sum(len(m["content"].split()) for m in messages)
+        completion_tokens = len(content.split())
+        return {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+            "prompt_cache_hit_tokens": 0,
+            "prompt_cache_miss_tokens": prompt_tokens
+        }
+
+    async def complete(self, messages, model, temperature, max_tokens=None):
+        self.requests += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        words = self._answer(messages).split()
+        finish_reason = "stop"
+        if max_tokens is not None and len(words) > max_tokens:
+            words = words[:max_tokens]
+            finish_reason = "length"
+        content = " ".join(words)
+        return {
+            "model": model,
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": finish_reason}],
+            "usage": self._usage(messages, content)
+        }
+
+    async def stream(self, messages, model, temperature, max_tokens=None):
+        self.requests += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        words = self._answer(messages).split()
+        finish_reason = "stop"
+        if max_tokens is not None and len(words) > max_tokens:
+            words = words[:max_tokens]
+            finish_reason = "length"
+        for i, word in enumerate(words):
+            if self.chunk_delay:
+                await asyncio.sleep(self.chunk_delay)
+            delta = word if i == 0 else " " + word
+            choice = {"index": 0, "delta": {"content": delta}}
+            if i == len(words) - 1:
+                choice["finish_reason"] = finish_reason
+            yield {"model": model, "choices": [choice]}
+        yield {"model": model, "choices": [], "usage": self._usage(messages, " ".join(words))}
+
+BACKENDS = {
+    DeepSeekHTTPBackend.name: DeepSeekHTTPBackend,
+    OpenAISDKBackend.name: OpenAISDKBackend,
+    StubBackend.name: StubBackend
+}
+
+def create_backend(name: Optional[str] = None) -> LLMBackend:
+    """Create the backend selected by name or the LLM_BACKEND setting"""
+    name = (name or os.getenv('LLM_BACKEND', 'deepseek')).lower()
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown LLM_BACKEND '{name}', expected one of {sorted(BACKENDS)}")
+    return BACKENDS[name]()
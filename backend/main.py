@@ -1,7 +1,7 @@
 from fastapi import FastAPI, Request, HTTPException, Depends, status
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.security import OAuth2PasswordBearer
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, StreamingResponse
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials, OAuth2PasswordRequestForm, OAuth2PasswordBearer
 from fastapi_limiter import FastAPILimiter
 from fastapi_limiter.depends import RateLimiter
@@ -14,23 +14,24 @@ from pydantic import BaseModel
 from dotenv import load_dotenv
 import asyncio
 import atexit
+import json
+import math
 from datetime import datetime, timedelta
 import jwt
 from passlib.context import CryptContext
 import logging
 from enum import Enum
-import tiktoken
 from typing import Dict
 import random
 from fastapi import Body
+from llm_backends import create_backend
+from redis_pool import create_redis_pool
 from google.oauth2 import id_token
 from google.auth.transport import requests
 import uuid
 import redis
 from datetime import datetime
 # First ensure we have the proper Redis imports
-import redis.asyncio as async_redis
-import redis  # For sync operations
 from typing import Optional
 
 # Initialize FastAPI app
@@ -44,61 +45,43 @@ from typing import Optional
 # OAuth2 scheme
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")  # Add this near other auth constants
 
-class User(BaseModel):
-    id: str
-    name: str
-    email: str
-    tier: str = "free"
-    daily_token_limit: int = 10000
-    monthly_token_limit: int = 0
-    created_at: datetime = datetime.utcnow()
-
-class TokenUsage(BaseModel):
-    user_id: str
-    tokens_used: int
-    operation: str
-    timestamp: datetime = datetime.utcnow()
-
-# Database setup (in production use MongoDB/PostgreSQL)
-users_db: Dict[str, User] = {}
-token_usage_db: List[TokenUsage] = []
-
-def reset_daily_limits():
-    # In production, run this daily via cron job
-    for user in users_db.values():
-        if user.tier == "free":
-            user.daily_token_limit = 10000
-
 @app.post("/track-usage")
 async def track_usage(
     user_id: str = Body(...),
     tokens_used: int = Body(...),
     operation: str = Body(...)
 ):
-    if user_id not in users_db:
+    user = await user_repository.get_by_username(user_id)
+    if user is None:
         raise HTTPException(status_code=404, detail="User not found")
     
-    # Record usage
-    usage = TokenUsage(
-        user_id=user_id,
-        tokens_used=tokens_used,
-        operation=operation
-    )
-    token_usage_db.append(usage)
-    
-    # Update user's daily usage
-    user = users_db[user_id]
-    user.daily_token_limit -= tokens_used
-    
-    return {"status": "success", "remaining": user.daily_token_limit}
+    tier = UserTier(user.tier)
+    await usage_history.record(user_id, tokens_used, operation)
+    await token_tracker.add_usage(user_id, tokens_used, tier)
+    remaining = await token_tracker.remaining_tokens(user_id, tier)
+    return {"status": "success", "remaining": remaining}
 
 @app.get("/usage-history/{user_id}")
-async def get_usage_history(user_id: str):
-    if user_id not in users_db:
+async def get_usage_history(user_id: str, limit: int = 50, cursor: Optional[str] = None):
+    """Newest events first; pass next_cursor back as cursor for the following page"""
+    if await user_repository.get_by_username(user_id) is None:
         raise HTTPException(status_code=404, detail="User not found")
-    
-    history = [u for u in token_usage_db if u.user_id == user_id]
-    return {"history": history, "total_used": sum(u.tokens_used for u in history)}
+    if not 1 <= limit <= USAGE_HISTORY_MAX_PAGE:
+        raise HTTPException(status_code=422, detail=f"limit must be between 1 and {USAGE_HISTORY_MAX_PAGE}")
+
+    try:
+        history, next_cursor = await usage_history.page(user_id, limit, cursor)
+    except ValueError:
+        raise HTTPException(status_code=422, detail="Invalid cursor")
+
+    # The total covers the whole retained history, read from the user's daily rollups
+    days = min(token_tracker.rollups.retention["day"], math.ceil(usage_history.retention_seconds / 86400) + 1)
+    buckets = await token_tracker.rollups.series(user_id, "day", days)
+    return {
+        "history": history,
+        "total_used": sum(b["tokens"] for b in buckets),
+        "next_cursor": next_cursor
+    }
 
 logging.basicConfig(level=logging.DEBUG)
 
@@ -108,6 +91,41 @@ SECRET_KEY = os.getenv('SECRET_KEY', 'fallback-secret-key')
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
 GOOGLE_CLIENT_ID = os.getenv('GOOGLE_CLIENT_ID', 'your-google-client-id')
+CHAT_BATCH_MAX_ITEMS = int(os.getenv('CHAT_BATCH_MAX_ITEMS', 50))
+CHAT_BATCH_CONCURRENCY = int(os.getenv('CHAT_BATCH_CONCURRENCY', 5))
+ADMIN_API_KEY = os.getenv('ADMIN_API_KEY')
+
+# LLM generation settings (the backend is chosen with LLM_BACKEND)
+DEEPSEEK_MODEL = os.getenv('DEEPSEEK_MODEL', 'deepseek-chat')
+DEEPSEEK_TEMPERATURE = float(os.getenv('DEEPSEEK_TEMPERATURE', 0.7))
+
+# Pre-flight quota check: completions are clamped to what the user can still afford
+CHAT_MAX_TOKENS = int(os.getenv('CHAT_MAX_TOKENS', 8192))  # Upstream completion ceiling
+PREFLIGHT_MIN_COMPLETION_TOKENS = int(os.getenv('PREFLIGHT_MIN_COMPLETION_TOKENS', 32))
+PREFLIGHT_ESTIMATE_MARGIN = float(os.getenv('PREFLIGHT_ESTIMATE_MARGIN', 1.1))
+
+# Kept byte-identical across requests so DeepSeek's context cache can reuse the prefix;
+# anything per-request must come after it
+MATH_SYSTEM_PROMPT = (
+    "You are MathSeek, a patient math tutor for students. "
+    "Solve the problem the student sends and explain the reasoning step by step. "
+    "Number each step, show every intermediate result, and state the final answer "
+    "clearly on its own line at the end. Use plain-text math notation such as x^2, "
+    "sqrt(x) and a/b so answers render on mobile devices. If the problem is ambiguous, "
+    "state the assumption you make before solving. If the question is not about math, "
+    "answer briefly and steer the student back to math."
+)
+
+def build_messages(prompt: str, tone: str = "friendly", language: str = "en") -> list:
+    """Build chat messages with the static system prompt first and per-request parts last"""
+    return [
+        {"role": "system", "content": MATH_SYSTEM_PROMPT},
+        {"role": "system", "content": f"Use a {tone} tone and reply in language code '{language}'."},
+        {"role": "user", "content": prompt}
+    ]
+
+# Shared async LLM backend: deepseek (httpx pool), openai (async SDK) or stub
+llm_backend = create_backend()
 
 # CORS Configuration
 app.add_middleware(
@@ -119,13 +137,13 @@ app.add_middleware(
     expose_headers=["*"]
 )
 
-# Redis setup
-redis_conn = aioredis.from_url(
-    "redis://localhost:6379",
-    decode_responses=True,
-    socket_connect_timeout=5,
-    retry_on_timeout=True
-)
+# Redis setup: one pooled client shared by every request and background task
+redis_pool = create_redis_pool()
+redis_conn = aioredis.Redis(connection_pool=redis_pool)
+
+async def get_redis() -> aioredis.Redis:
+    """Dependency handing out the shared client instead of a per-request connection"""
+    return redis_conn
 
 security = HTTPBearer()
 
@@ -133,12 +151,30 @@ security = HTTPBearer()
 @app.on_event("startup")
 async def startup():
     try:
+        logging.info(f"LLM backend initialized: {llm_backend.name}")
+
+        # Refuse to serve with approximate counts when no vocab was built
+        tokenizer.check_vocab()
+        # Warm the tokenizer off the startup path so workers accept traffic immediately
+        app.state.tokenizer_warmup = asyncio.create_task(tokenizer.warm())
+
+        response_cache.redis = redis_conn
+
         await FastAPILimiter.init(redis_conn)
         logging.info("Redis rate limiter initialized")
+
+        await anonymous_quota.load(redis_conn)
+        logging.info("Anonymous quota script loaded")
+
+        await user_repository.init()
+
+        token_tracker.store.start()
+        token_tracker.rollups.start()
+        logging.info(f"Usage store initialized: {token_tracker.store.name}")
         
         # Verify API key is loaded
         DEEPSEEK_API_KEY = os.getenv("DEEPSEEK_API_KEY")
-        if not DEEPSEEK_API_KEY:
+        if llm_backend.requires_api_key and not DEEPSEEK_API_KEY:
             logging.error("DEEPSEEK_API_KEY not found in environment")
             raise ValueError("Missing DEEPSEEK_API_KEY in environment")
         logging.info("DeepSeek API key verified")
@@ -190,7 +226,7 @@ async def get_current_user(request: Request):
             )
         
         # Your existing user validation
-        user = users_db.get(user_id)
+        user = await user_repository.get_by_username(user_id)
         if user is None:
             raise HTTPException(
                 status_code=status.HTTP_404_NOT_FOUND,
@@ -203,8 +239,17 @@ async def get_current_user(request: Request):
             detail="Invalid token"
         )
 
+async def require_admin(request: Request):
+    """Admin-only dependency checked against the ADMIN_API_KEY setting"""
+    admin_key = request.headers.get("X-Admin-Key")
+    if not ADMIN_API_KEY or admin_key != ADMIN_API_KEY:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Admin access required"
+        )
+
 # New dependency for anonymous or authenticated users
-async def get_user_or_anonymous(request: Request):
+async def get_user_or_anonymous(request: Request, redis_client: aioredis.Redis = Depends(get_redis)):
     logging.debug(f"Auth attempt - path: {request.url.path}")
     
     # First try regular authentication
@@ -225,12 +270,12 @@ async def get_user_or_anonymous(request: Request):
     
     if token:
         try:
-            async with redis.Redis.from_url(os.getenv("REDIS_URL")) as redis_client:
-                quota = await redis_client.hget(f"anonymous:{token}", "quota_remaining")
-                logging.debug(f"Token quota check: {quota}")
-                if quota and int(quota) > 0:
-                    logging.debug(f"Anonymous auth granted for token: {token}")
-                    return {"sub": f"anonymous:{token}", "tier": "anonymous"}
+            # Cost 0: validate the token and check its quota without spending any
+            outcome, quota = await anonymous_quota.consume(redis_client, token, cost=0)
+            logging.debug(f"Token quota check: {quota}")
+            if outcome == anonymous_quota.CONSUMED:
+                logging.debug(f"Anonymous auth granted for token: {token}")
+                return {"sub": f"anonymous:{token}", "tier": "anonymous"}
         except Exception as e:
             logging.error(f"Redis error: {str(e)}")
     
@@ -252,14 +297,6 @@ class UserCreate(BaseModel):
     email: str = None
     tier: UserTier = UserTier.FREE
 
-class UserInDB(UserCreate):
-    hashed_password: str
-    daily_token_limit: int = 10000  # Default for free tier
-    monthly_token_limit: int = 0    # 0 means unlimited for paid tiers
-    tokens_used_today: int = 0
-    tokens_used_month: int = 0
-    last_reset_date: datetime = None
-
 class TokenUsage(BaseModel):
     input_tokens: int
     output_tokens: int
@@ -267,12 +304,14 @@ class TokenUsage(BaseModel):
     cost: float
 
 class UserUsage(BaseModel):
-    daily_limit: int
-    monthly_limit: int
+    daily_limit: Optional[int]      # None means no limit for this period
+    monthly_limit: Optional[int]
     daily_used: int
     monthly_used: int
-    remaining_daily: int
-    remaining_monthly: int
+    remaining_daily: Optional[int]
+    remaining_monthly: Optional[int]
+    daily_resets_at: Optional[datetime] = None
+    monthly_resets_at: Optional[datetime] = None
 
 class ChatRequest(BaseModel):
     prompt: str
@@ -284,97 +323,163 @@ class ChatResponse(BaseModel):
     response: str
     tokens_used: int
 
+class BatchChatRequest(BaseModel):
+    items: List[ChatRequest]
+
 class BudgetRequest(BaseModel):
     amount: float
 
 # Helper function for DeepSeek API
-from openai import OpenAI
-from openai.types.chat import ChatCompletionMessage
 from cost_tracking import cost_tracker
-
-# Initialize OpenAI client with DeepSeek endpoint
-client = OpenAI(
-    api_key=os.getenv("DEEPSEEK_API_KEY"),
-    base_url="https://api.deepseek.com"
-)
-
-async def call_deepseek_api(prompt: str) -> dict:
-    """Call DeepSeek API using OpenAI SDK"""
-    try:
-        # Prepare messages with tone and language context
-        messages = [
-            {"role": "system", "content": "You are a helpful assistant"},
-            {"role": "user", "content": prompt}
-        ]
-        
-        # Make the API call
-        response = client.chat.completions.create(
-            model="deepseek-chat",
-            messages=messages,
-            temperature=0.7,
-            max_tokens=2000,
-            stream=False
-        )
-        
-        # Convert to our expected format
-        return {
-            "choices": [{
-                "message": {
-                    "content": response.choices[0].message.content
-                }
-            }],
-            "usage": {
-                "total_tokens": response.usage.total_tokens,
-                "prompt_tokens": response.usage.prompt_tokens,
-                "completion_tokens": response.usage.completion_tokens
-            }
-        }
-    except Exception as e:
-        logging.error(f"DeepSeek API error: {str(e)}", exc_info=True)
-        error_msg = str(e)
-        
-        # Handle specific error types
-        if "Invalid API key" in error_msg:
-            raise HTTPException(
-                status_code=401,
-                detail="Invalid API key"
-            )
-        elif "Insufficient Balance" in error_msg:
-            raise HTTPException(
-                status_code=402,
-                detail="Insufficient balance",
-                headers={"Retry-After": "86400"}  # 24 hours
-            )
-        else:
-            raise HTTPException(
-                status_code=500,
-                detail=f"DeepSeek API error: {error_msg}"
-            )
-
-# Initialize tiktoken encoder
-encoding = tiktoken.encoding_for_model("gpt-3.5-turbo")  # Using GPT-3.5 as a compatible fallback
+from cost_tracking import cost_tracker as api_cost_tracker
+from response_cache import response_cache
+from singleflight import single_flight
+from math_solver import math_solver
+from concurrency import deepseek_limiter, ConcurrencyLimitExceeded
+from resilience import deepseek_resilience, CircuitOpenError
+
+# Tokenizer vocab is loaded lazily from local disk (see tokenizer.py)
+from tokenizer import tokenizer
+from quota import anonymous_quota
+from usage_store import InMemoryUsageStore, create_usage_store
+from usage_history import create_usage_history
+from usage_rollups import GRANULARITIES, create_usage_rollups
+from users import UserExistsError, UserRecord, user_repository
+
+async def consume_anonymous_quota(redis_client, token: str, cost: int = 1) -> int:
+    """Atomically check and spend an anonymous token's quota, returning what is left"""
+    outcome, remaining = await anonymous_quota.consume(redis_client, token, cost)
+    if outcome == anonymous_quota.INVALID:
+        raise HTTPException(status_code=401, detail="Invalid anonymous token")
+    if outcome == anonymous_quota.EXCEEDED:
+        raise HTTPException(status_code=429, detail="Daily quota exceeded")
+    return remaining
 
 class TokenTracker:
-    def __init__(self):
-        self.usage_db = {}
+    def __init__(self, store=None, tier_of=None, rollups=None, model: str = DEEPSEEK_MODEL):
+        # Daily/monthly counters live in the store so every worker sees the same usage
+        self.store = store or InMemoryUsageStore()
+        # Async lookup of a user's tier, which picks the time zone their periods reset in
+        self.tier_of = tier_of
+        # Hourly/daily reporting buckets, folded in as usage is charged
+        self.rollups = rollups
+        self.model = model
         self.tier_limits = {
             UserTier.FREE: 10000,  # Daily limit for free tier
             UserTier.PRO: 1000000,  # Monthly limit for pro tier
             UserTier.CUSTOM: 5000000,  # Monthly limit for custom tier
         }
         self.token_cost = 0.002  # Cost per 1K tokens
+        self.usage_sources = {"upstream": 0, "estimated": 0}
+        self.reservation_ttl = float(os.getenv('TOKEN_RESERVATION_TTL', 300))
+        self.reservation_stats = {"reserved": 0, "reconciled": 0, "released": 0}
 
     def count_tokens(self, text: str) -> int:
-        """Count tokens using tiktoken encoder"""
-        return len(encoding.encode(text))
+        """Count tokens with the shared tokenizer"""
+        return tokenizer.count_tokens(text)
+
+    async def count_tokens_async(self, text: str) -> int:
+        """Count tokens in a worker thread so long texts don't block the event loop"""
+        return (await tokenizer.count_tokens_async([text]))[0]
+
+    def limits_for(self, tier: UserTier) -> tuple:
+        """(daily_limit, monthly_limit) for a tier; None means no limit of that kind"""
+        daily_limit = self.tier_limits[UserTier.FREE] if tier == UserTier.FREE else None
+        monthly_limit = self.tier_limits[tier] if tier != UserTier.FREE else None
+        return daily_limit, monthly_limit
+
+    async def add_usage(self, username: str, tokens_used: int, tier: Optional[UserTier] = None) -> dict:
+        """Add tokens to the user's counters for the current day and month"""
+        if tier is None:
+            tier = await self.tier_of(username) if self.tier_of else UserTier.FREE
+        usage = await self.store.incr(username, tokens_used, tier)
+        if self.rollups is not None:
+            # Billing estimate at the flat per-1K rate; upstream spend is tracked by api_cost_tracker
+            await self.rollups.record(
+                username, UserTier(tier).value, self.model, tokens_used, (tokens_used / 1000) * self.token_cost
+            )
+        return usage
 
-    async def calculate_token_usage(self, response: dict) -> TokenUsage:
+    async def estimate_prompt_tokens(self, messages: list) -> int:
+        """Estimate prompt tokens for the messages about to be sent"""
+        if not messages:
+            return 0
+        counts = await tokenizer.count_tokens_async([msg.get("content", "") for msg in messages])
+        return sum(counts)
+
+    async def remaining_tokens(self, username: str, tier: UserTier) -> Optional[int]:
+        """Tokens left under the tightest daily or monthly limit, None if unlimited"""
+        daily_limit, monthly_limit = self.limits_for(tier)
+        if daily_limit is None and monthly_limit is None:
+            return None
+        usage = await self.store.get(username, tier)
+
+        remaining = []
+        if daily_limit:
+            remaining.append(daily_limit - usage["daily_used"])
+        if monthly_limit:
+            remaining.append(monthly_limit - usage["monthly_used"])
+        return min(remaining) - usage["held"]
+
+    async def reserve(self, username: str, tier: UserTier, prompt_tokens: int,
+                      min_completion: int, max_completion: int) -> tuple:
+        """Atomically hold the prompt plus the granted completion budget, returning (reservation_id, budget).
+
+        Callers must cap max_tokens at the budget so the hold covers the worst case.
+        """
+        daily_limit, monthly_limit = self.limits_for(tier)
+        if daily_limit is None and monthly_limit is None:
+            return None, None
+
+        # The store checks and holds in one step, so concurrent requests can't both pass
+        ok, budget, reservation_id = await self.store.reserve(
+            username,
+            daily_limit,
+            monthly_limit,
+            prompt_tokens,
+            min_completion,
+            max_completion,
+            self.reservation_ttl,
+            tier
+        )
+        if not ok:
+            raise HTTPException(
+                status_code=status.HTTP_402_PAYMENT_REQUIRED,
+                detail="Not enough tokens left for this request. Please upgrade your plan."
+            )
+        self.reservation_stats["reserved"] += 1
+        return reservation_id, budget
+
+    async def reconcile(self, username: str, reservation_id: Optional[str], tokens_used: int):
+        """Replace a reservation with the tokens actually used"""
+        if tokens_used:
+            await self.add_usage(username, tokens_used)
+        if reservation_id and await self.store.release(username, reservation_id):
+            self.reservation_stats["reconciled"] += 1
+
+    async def release(self, username: str, reservation_id: Optional[str]):
+        """Drop a reservation after a failure or cancellation; a no-op once reconciled"""
+        if reservation_id and await self.store.release(username, reservation_id):
+            self.reservation_stats["released"] += 1
+
+    def get_reservation_stats(self) -> dict:
+        """Reservation counters plus the store's expiry count"""
+        return {**self.reservation_stats, "expired": self.store.stats["expired_holds"]}
+
+    async def calculate_token_usage(self, response: dict, messages: Optional[list] = None) -> TokenUsage:
         """Calculate token usage from API response"""
-        # Get input tokens from the prompt
-        input_tokens = self.count_tokens(response.get("messages", [{}])[-1].get("content", ""))
-        
-        # Get output tokens from the response
-        output_tokens = self.count_tokens(response.get("choices", [{}])[0].get("message", {}).get("content", ""))
+        usage = response.get("usage") or {}
+        if "prompt_tokens" in usage and "completion_tokens" in usage:
+            # Exact counts reported by the upstream
+            self.usage_sources["upstream"] += 1
+            input_tokens = usage["prompt_tokens"]
+            output_tokens = usage["completion_tokens"]
+        else:
+            # Fallback: estimate locally from the messages that were sent
+            self.usage_sources["estimated"] += 1
+            input_tokens = await self.estimate_prompt_tokens(messages or [])
+            choices = response.get("choices") or [{}]
+            output_tokens = await self.count_tokens_async(choices[0].get("message", {}).get("content", ""))
         
         total_tokens = input_tokens + output_tokens
         cost = (total_tokens / 1000) * self.token_cost
@@ -388,31 +493,15 @@ class TokenTracker:
 
     async def update_usage(self, username: str, tokens_used: int, tier: UserTier):
         """Update user's token usage and handle limits"""
-        current_date = datetime.now()
-        
-        if username not in self.usage_db:
-            self.usage_db[username] = {
-                "daily_used": 0,
-                "monthly_used": 0,
-                "last_reset_date": current_date.date()
-            }
-        
-        # Reset daily usage if new day
-        if self.usage_db[username]["last_reset_date"] != current_date.date():
-            self.usage_db[username]["daily_used"] = 0
-            self.usage_db[username]["last_reset_date"] = current_date.date()
-            
         # Update usage
-        self.usage_db[username]["daily_used"] += tokens_used
-        self.usage_db[username]["monthly_used"] += tokens_used
+        usage = await self.add_usage(username, tokens_used, tier)
         
         # Check limits
-        daily_limit = self.tier_limits[UserTier.FREE] if tier == UserTier.FREE else None
-        monthly_limit = self.tier_limits[tier] if tier != UserTier.FREE else None
+        daily_limit, monthly_limit = self.limits_for(tier)
         
         # Calculate remaining tokens
-        daily_remaining = daily_limit - self.usage_db[username]["daily_used"] if daily_limit else None
-        monthly_remaining = monthly_limit - self.usage_db[username]["monthly_used"] if monthly_limit else None
+        daily_remaining = daily_limit - usage["daily_used"] if daily_limit else None
+        monthly_remaining = monthly_limit - usage["monthly_used"] if monthly_limit else None
         
         # Check if we need to suggest an upgrade
         upgrade_suggested = False
@@ -432,7 +521,7 @@ class TokenTracker:
             }
             
         # If we exceed limits, raise appropriate error
-        if daily_limit and self.usage_db[username]["daily_used"] > daily_limit:
+        if daily_limit and usage["daily_used"] > daily_limit:
             raise HTTPException(
                 status_code=status.HTTP_402_PAYMENT_REQUIRED,
                 detail={
@@ -443,7 +532,7 @@ class TokenTracker:
                 }
             )
             
-        if monthly_limit and self.usage_db[username]["monthly_used"] > monthly_limit:
+        if monthly_limit and usage["monthly_used"] > monthly_limit:
             raise HTTPException(
                 status_code=status.HTTP_402_PAYMENT_REQUIRED,
                 detail={
@@ -455,14 +544,10 @@ class TokenTracker:
 
     async def get_usage(self, username: str, tier: UserTier) -> UserUsage:
         """Get user's current token usage"""
-        usage = self.usage_db.get(username, {
-            "daily_used": 0,
-            "monthly_used": 0,
-            "last_reset_date": datetime.now().date()
-        })
+        usage = await self.store.get(username, tier)
         
-        daily_limit = self.tier_limits[UserTier.FREE] if tier == UserTier.FREE else None
-        monthly_limit = self.tier_limits[tier] if tier != UserTier.FREE else None
+        daily_limit, monthly_limit = self.limits_for(tier)
+        daily_resets_at, monthly_resets_at = self.store.periods.next_resets(tier)
         
         return UserUsage(
             daily_limit=daily_limit,
@@ -470,73 +555,36 @@ class TokenTracker:
             daily_used=usage["daily_used"],
             monthly_used=usage["monthly_used"],
             remaining_daily=(daily_limit - usage["daily_used"]) if daily_limit else None,
-            remaining_monthly=(monthly_limit - usage["monthly_used"]) if monthly_limit else None
+            remaining_monthly=(monthly_limit - usage["monthly_used"]) if monthly_limit else None,
+            daily_resets_at=daily_resets_at,
+            monthly_resets_at=monthly_resets_at
         )
 
-# Initialize token tracker
-token_tracker = TokenTracker()
-
-# Mock database (replace with real DB in production)
-users_db = {}
-
-def get_user_tier(username: str) -> UserTier:
-    user = users_db.get(username)
-    if not user:
-        return UserTier.FREE
-    return user.tier
+# Per-user usage event streams (USAGE_HISTORY_STORE=memory keeps them per process)
+usage_history = create_usage_history(redis_conn)
+USAGE_HISTORY_MAX_PAGE = 200
 
-def update_token_usage(username: str, tokens_used: int):
-    user = users_db[username]
-    current_date = datetime.now()
-    
-    # Reset daily usage if new day
-    if user.last_reset_date and user.last_reset_date.date() != current_date.date():
-        user.tokens_used_today = 0
-        user.last_reset_date = current_date
-    
-    # Update usage
-    user.tokens_used_today += tokens_used
-    user.tokens_used_month += tokens_used
-    users_db[username] = user
-
-def check_token_limits(username: str, tokens_needed: int) -> UserUsage:
-    user = users_db.get(username)
-    if not user:
-        return UserUsage(
-            daily_limit=10000,
-            monthly_limit=0,
-            daily_used=0,
-            monthly_used=0,
-            remaining_daily=10000,
-            remaining_monthly=0
-        )
-    
-    daily_remaining = user.daily_token_limit - user.tokens_used_today
-    monthly_remaining = user.monthly_token_limit - user.tokens_used_month
-    
-    return UserUsage(
-        daily_limit=user.daily_token_limit,
-        monthly_limit=user.monthly_token_limit,
-        daily_used=user.tokens_used_today,
-        monthly_used=user.tokens_used_month,
-        remaining_daily=daily_remaining,
-        remaining_monthly=monthly_remaining
-    )
+async def get_user_tier(username: str) -> UserTier:
+    user = await user_repository.get_by_username(username)
+    return UserTier(user.tier) if user else UserTier.FREE
 
-def get_user(username: str):
-    if username in users_db:
-        user_dict = users_db[username]
-        return UserInDB(**user_dict)
-    return None
+# Initialize token tracker (TOKEN_STORE=memory keeps usage per process)
+token_tracker = TokenTracker(
+    create_usage_store(redis_conn),
+    tier_of=get_user_tier,
+    rollups=create_usage_rollups(redis_conn)
+)
 
 def verify_password(plain_password: str, hashed_password: str):
     return pwd_context.verify(plain_password, hashed_password)
 
-def authenticate_user(username: str, password: str):
-    user = get_user(username)
-    if not user:
+async def authenticate_user(username: str, password: str) -> Optional[UserRecord]:
+    user = await user_repository.get_by_username(username)
+    # OAuth users have no password and can't log in here
+    if not user or not user.hashed_password:
         return None
-    if not verify_password(password, user.hashed_password):
+    # bcrypt is deliberately slow; keep it off the event loop
+    if not await asyncio.to_thread(verify_password, password, user.hashed_password):
         return None
     return user
 
@@ -544,7 +592,7 @@ def authenticate_user(username: str, password: str):
 @app.post("/token")
 async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends()):
     try:
-        user = authenticate_user(form_data.username, form_data.password)
+        user = await authenticate_user(form_data.username, form_data.password)
         if not user:
             raise HTTPException(
                 status_code=status.HTTP_401_UNAUTHORIZED,
@@ -569,25 +617,19 @@ async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(
 @app.post("/register")
 async def register_user(user: UserCreate):
     try:
-        if user.username in users_db:
-            raise HTTPException(
-                status_code=status.HTTP_400_BAD_REQUEST,
-                detail="Username already registered"
-            )
-        
-        hashed_password = pwd_context.hash(user.password)
-        users_db[user.username] = {
-            "username": user.username,
-            "hashed_password": hashed_password,
-            "email": user.email,
-            "tier": user.tier,
-            "daily_token_limit": 10000,
-            "monthly_token_limit": 0,
-            "tokens_used_today": 0,
-            "tokens_used_month": 0,
-            "last_reset_date": None
-        }
+        hashed_password = await asyncio.to_thread(pwd_context.hash, user.password)
+        await user_repository.create(
+            user.username,
+            hashed_password=hashed_password,
+            email=user.email,
+            tier=user.tier.value
+        )
         return {"message": "User registered successfully"}
+    except UserExistsError:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Username already registered"
+        )
     except Exception as e:
         logging.error(f"Registration error: {str(e)}")
         raise HTTPException(
@@ -600,86 +642,319 @@ async def register_user(user: UserCreate):
 async def protected_route(user: dict = Depends(get_current_user)):
     return {"message": "You are authenticated"}
 
+def wants_stream(request: Request, message: dict) -> bool:
+    """Check whether the client opted into Server-Sent Events streaming"""
+    if request.query_params.get("stream", "").lower() == "true":
+        return True
+    if message.get("stream") is True:
+        return True
+    return "text/event-stream" in request.headers.get("Accept", "")
+
+def format_sse(data: dict, event: Optional[str] = None) -> str:
+    """Format a payload as a Server-Sent Events frame"""
+    frame = f"event: {event}\n" if event else ""
+    return frame + f"data: {json.dumps(data)}\n\n"
+
+def streaming_chat_response(
+    message: str,
+    username: Optional[str] = None,
+    tone: str = "friendly",
+    language: str = "en",
+    max_tokens: Optional[int] = None,
+    reservation_id: Optional[str] = None
+) -> StreamingResponse:
+    """Wrap the chat stream in an SSE response"""
+    return StreamingResponse(
+        process_chat_message_stream(message, username, tone, language, max_tokens, reservation_id),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
 @app.post("/chat", dependencies=[Depends(RateLimiter(times=10, minutes=1))])
 async def chat_endpoint(
     request: Request,
-    message: dict = Body(...)
+    message: dict = Body(...),
+    redis_client: aioredis.Redis = Depends(get_redis)
 ):
     """Handle chat messages with anonymous token support"""
     try:
+        stream = wants_stream(request, message)
+        tone = message.get("tone", "friendly")
+        language = message.get("language", "en")
+
         # First check for anonymous token
         anonymous_token = request.headers.get("X-Anonymous-Token")
         if anonymous_token:
-            redis_url = os.getenv("REDIS_URL")
-            if not redis_url:
-                raise HTTPException(status_code=500, detail="Server configuration error")
-
-            async with async_redis.Redis.from_url(redis_url) as redis_client:
-                quota = await redis_client.hget(f"anonymous:{anonymous_token}", "quota_remaining")
-                if not quota:
-                    raise HTTPException(status_code=401, detail="Invalid anonymous token")
-                
-                if int(quota) <= 0:
-                    raise HTTPException(status_code=429, detail="Daily quota exceeded")
-                
-                await redis_client.hincrby(f"anonymous:{anonymous_token}", "quota_remaining", -1)
-
-            return {"response": await process_chat_message(message["message"])}
+            prompt_tokens = (await tokenizer.count_tokens_async([message["message"]]))[0]
+            await consume_anonymous_quota(
+                redis_client, anonymous_token, anonymous_quota.cost_for_tokens(prompt_tokens)
+            )
+
+            if stream:
+                return streaming_chat_response(message["message"], tone=tone, language=language)
+            return {"response": await process_chat_message(message["message"], tone, language)}
 
         # If no anonymous token, require regular auth
         user = await get_current_user(request)
-        return {"response": await process_chat_message(message["message"])}
+
+        # Reserve quota (or reject) before any upstream spend
+        reservation_id, max_tokens = await reserve_chat_quota(
+            user["sub"], await get_user_tier(user["sub"]), message["message"], tone, language
+        )
+        if stream:
+            return streaming_chat_response(
+                message["message"], user["sub"], tone, language, max_tokens, reservation_id
+            )
+        return {"response": await process_chat_message(
+            message["message"], tone, language, user["sub"], max_tokens, reservation_id
+        )}
 
     except HTTPException:
         raise
     except Exception as e:
         logging.error(f"Chat error: {str(e)}")
         raise HTTPException(status_code=500, detail="Chat processing failed")
-async def process_chat_message(message: str) -> str:
+
+async def process_chat_message(
+    message: str,
+    tone: str = "friendly",
+    language: str = "en",
+    username: Optional[str] = None,
+    max_tokens: Optional[int] = None,
+    reservation_id: Optional[str] = None
+) -> str:
     """Process chat message and generate response"""
     try:
+        # Simple problems are answered locally without an upstream call
+        local_answer = await math_solver.try_solve(message)
+        if local_answer is not None:
+            return local_answer
+
         # Call your AI/LLM service here
-        response = await call_deepseek_api(message)
+        response, cache_hit = await cached_deepseek_call(message, tone, language, max_tokens)
+        if username:
+            token_usage = await token_tracker.calculate_token_usage(
+                response, build_messages(message, tone, language)
+            )
+            tokens = response_cache.billable_tokens(token_usage.total_tokens, cache_hit)
+            await token_tracker.reconcile(username, reservation_id, tokens)
         return response["choices"][0]["message"]["content"]
+    except HTTPException as e:
+        # Let load-shedding reach the client so it can honour Retry-After
+        if e.status_code == status.HTTP_503_SERVICE_UNAVAILABLE:
+            raise
+        logging.error(f"Chat processing error: {str(e)}")
+        return "Sorry, I couldn't process your message. Please try again later."
     except Exception as e:
         logging.error(f"Chat processing error: {str(e)}")
         return "Sorry, I couldn't process your message. Please try again later."
+    finally:
+        # Failed, cancelled or answered locally: hand the held tokens back
+        if username:
+            await token_tracker.release(username, reservation_id)
+
+async def process_chat_message_stream(
+    message: str,
+    username: Optional[str] = None,
+    tone: str = "friendly",
+    language: str = "en",
+    max_tokens: Optional[int] = None,
+    reservation_id: Optional[str] = None
+):
+    """Stream chat response deltas, releasing the quota reservation however the stream ends"""
+    try:
+        async for event in _chat_stream_events(message, username, tone, language, max_tokens):
+            yield event
+    finally:
+        # Tokens were charged as they streamed; the hold is no longer needed
+        if username:
+            await token_tracker.release(username, reservation_id)
+
+async def _chat_stream_events(
+    message: str,
+    username: Optional[str],
+    tone: str,
+    language: str,
+    max_tokens: Optional[int]
+):
+    """Stream chat response deltas as Server-Sent Events, charging exact usage at the end"""
+    local_answer = await math_solver.try_solve(message)
+    if local_answer is not None:
+        yield format_sse({"delta": local_answer, "local": True})
+        yield format_sse({"done": True, "tokens_used": 0})
+        return
+
+    cache_key = response_cache.make_key(message, DEEPSEEK_MODEL, DEEPSEEK_TEMPERATURE, tone, language)
+    cached = await response_cache.get(cache_key)
+    if cached is not None and fits_max_tokens(cached, max_tokens):
+        tokens = response_cache.billable_tokens(cached.get("usage", {}).get("total_tokens", 0), cache_hit=True)
+        if username and tokens:
+            await token_tracker.add_usage(username, tokens)
+        yield format_sse({"delta": cached["choices"][0]["message"]["content"], "cached": True})
+        yield format_sse({"done": True, "tokens_used": tokens})
+        return
+
+    counted_tokens = 0
+    if username:
+        counted_tokens = await token_tracker.count_tokens_async(message)
+        await token_tracker.add_usage(username, counted_tokens)
+
+    parts = []
+    usage = None
+    try:
+        truncated = False
+        # Identical concurrent prompts share one upstream stream
+        flight = flight_key(cache_key, max_tokens)
+        async for chunk in single_flight.stream(flight, lambda: stream_deepseek_api(message, tone, language, max_tokens)):
+            for choice in chunk.get("choices") or []:
+                if choice.get("finish_reason") == "length":
+                    truncated = True
+                delta = (choice.get("delta") or {}).get("content")
+                if not delta:
+                    continue
+                parts.append(delta)
+                yield format_sse({"delta": delta})
+
+            # The final chunk carries exact usage; charge the rest of it on top of the prompt
+            if chunk.get("usage"):
+                usage = chunk["usage"]
+                if username:
+                    await token_tracker.add_usage(username, usage["total_tokens"] - counted_tokens)
+                    counted_tokens = usage["total_tokens"]
+
+        if username and usage is None and parts:
+            # Backend sent no usage block: charge an estimate of what was delivered
+            delivered = await token_tracker.count_tokens_async("".join(parts))
+            await token_tracker.add_usage(username, delivered)
+            counted_tokens += delivered
+            usage = {}
+
+        if not truncated:
+            await response_cache.set(cache_key, {
+                "choices": [{"message": {"content": "".join(parts)}}],
+                "usage": usage or {}
+            })
+        yield format_sse({"done": True, "tokens_used": counted_tokens})
+    except (ConcurrencyLimitExceeded, CircuitOpenError) as e:
+        yield format_sse({"error": "AI service is busy, please retry", "retry_after": e.retry_after}, event="error")
+    except Exception as e:
+        logging.error(f"Chat streaming error: {str(e)}")
+        yield format_sse({"error": "Sorry, I couldn't process your message. Please try again later."}, event="error")
+    finally:
+        # Cut short by a disconnect or upstream error: charge what was delivered
+        if username and usage is None and parts:
+            await token_tracker.add_usage(username, await token_tracker.count_tokens_async("".join(parts)))
 
 # Add this near other utility functions
-async def call_deepseek_api(prompt: str) -> dict:
-    """Call the DeepSeek API with the given prompt"""
+async def call_deepseek_api(prompt: str, tone: str = "friendly", language: str = "en",
+                            max_tokens: Optional[int] = None) -> dict:
+    """Call the configured LLM backend with the given prompt"""
     try:
-        api_key = os.getenv("DEEPSEEK_API_KEY")
-        if not api_key:
-            raise ValueError("DEEPSEEK_API_KEY not set")
+        messages = build_messages(prompt, tone, language)
+
+        async def attempt() -> dict:
+            # Every attempt, including hedges and retries, takes its own upstream slot
+            async with deepseek_limiter.acquire():
+                return await llm_backend.complete(messages, DEEPSEEK_MODEL, DEEPSEEK_TEMPERATURE, max_tokens)
+
+        return await deepseek_resilience.call(attempt)
             
-        headers = {
-            "Authorization": f"Bearer {api_key}",
-            "Content-Type": "application/json"
-        }
-        
-        data = {
-            "model": "deepseek-chat",
-            "messages": [{"role": "user", "content": prompt}],
-            "temperature": 0.7
-        }
-        
-        async with httpx.AsyncClient() as client:
-            response = await client.post(
-                "https://api.deepseek.com/v1/chat/completions",
-                headers=headers,
-                json=data,
-                timeout=30.0
+    except ConcurrencyLimitExceeded as e:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="AI service is busy, please retry",
+            headers={"Retry-After": str(e.retry_after)}
+        )
+    except CircuitOpenError as e:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="AI service is temporarily unavailable, please retry",
+            headers={"Retry-After": str(e.retry_after)}
+        )
+    except httpx.HTTPStatusError as e:
+        logging.error(f"DeepSeek API error: {str(e)}")
+        if e.response.status_code == 401:
+            raise HTTPException(status_code=401, detail="Invalid API key")
+        if e.response.status_code == 402:
+            raise HTTPException(
+                status_code=402,
+                detail="Insufficient balance",
+                headers={"Retry-After": "86400"}  # 24 hours
             )
-            response.raise_for_status()
-            return response.json()
-            
+        raise HTTPException(
+            status_code=500,
+            detail="Failed to process message with AI service"
+        )
     except Exception as e:
         logging.error(f"DeepSeek API error: {str(e)}")
         raise HTTPException(
             status_code=500,
             detail="Failed to process message with AI service"
         )
+
+async def stream_deepseek_api(prompt: str, tone: str = "friendly", language: str = "en",
+                              max_tokens: Optional[int] = None):
+    """Stream completion chunks from the LLM backend as they are generated"""
+    async for chunk in deepseek_resilience.stream(lambda: _stream_deepseek_once(prompt, tone, language, max_tokens)):
+        yield chunk
+
+async def _stream_deepseek_once(prompt: str, tone: str, language: str, max_tokens: Optional[int] = None):
+    """Open one streaming completion against the LLM backend"""
+    messages = build_messages(prompt, tone, language)
+    async with deepseek_limiter.acquire() as slot:
+        async for chunk in llm_backend.stream(messages, DEEPSEEK_MODEL, DEEPSEEK_TEMPERATURE, max_tokens):
+            slot.mark_first_chunk()
+            if chunk.get("usage"):
+                api_cost_tracker.track_api_usage(chunk["usage"])
+            yield chunk
+
+def fits_max_tokens(response: dict, max_tokens: Optional[int]) -> bool:
+    """Whether a cached answer is within the completion budget of this request"""
+    if max_tokens is None:
+        return True
+    return response.get("usage", {}).get("completion_tokens", 0) <= max_tokens
+
+def flight_key(cache_key: str, max_tokens: Optional[int]) -> str:
+    """Only requests with the same completion budget may share an upstream call"""
+    return cache_key if max_tokens is None else f"{cache_key}:max_tokens={max_tokens}"
+
+async def cached_deepseek_call(prompt: str, tone: str = "friendly", language: str = "en",
+                               max_tokens: Optional[int] = None) -> tuple:
+    """Call DeepSeek through the response cache, returning (response, cache_hit)"""
+    cache_key = response_cache.make_key(prompt, DEEPSEEK_MODEL, DEEPSEEK_TEMPERATURE, tone, language)
+    cached = await response_cache.get(cache_key)
+    if cached is not None and fits_max_tokens(cached, max_tokens):
+        return cached, True
+
+    async def fetch() -> dict:
+        response = await call_deepseek_api(prompt, tone, language, max_tokens)
+        api_cost_tracker.track_api_usage(response.get("usage", {}))
+        # Answers cut short by a clamped max_tokens must not be served to others
+        if (response.get("choices") or [{}])[0].get("finish_reason") != "length":
+            await response_cache.set(cache_key, response)
+        return response
+
+    # Identical concurrent prompts share one upstream request
+    response = await single_flight.do(flight_key(cache_key, max_tokens), fetch)
+    return response, False
+
+async def reserve_chat_quota(username: str, tier: UserTier, prompt: str,
+                             tone: str = "friendly", language: str = "en") -> tuple:
+    """Reserve the estimated cost up front, returning (reservation_id, max_tokens)"""
+    if token_tracker.limits_for(tier) == (None, None):
+        return None, None
+
+    prompt_tokens = await token_tracker.estimate_prompt_tokens(build_messages(prompt, tone, language))
+    reservation_id, budget = await token_tracker.reserve(
+        username,
+        tier,
+        int(prompt_tokens * PREFLIGHT_ESTIMATE_MARGIN),
+        PREFLIGHT_MIN_COMPLETION_TOKENS,
+        CHAT_MAX_TOKENS
+    )
+    # Plenty left: keep the upstream default so requests still coalesce across users
+    return reservation_id, (budget if budget is not None and budget < CHAT_MAX_TOKENS else None)
+
 # Updated chat endpoint
 @app.post("/chat", dependencies=[Depends(RateLimiter(times=10, minutes=1))])
 async def chat(
@@ -693,32 +968,37 @@ async def chat(
             token = user["sub"].replace("anonymous:", "")
             
             # Make API call
-            response = await call_deepseek_api(chat_request.prompt)
+            response, _ = await cached_deepseek_call(chat_request.prompt, chat_request.tone, chat_request.language)
             
             # Calculate token usage (no tracking for anonymous users)
-            token_usage = await token_tracker.calculate_token_usage(response)
+            token_usage = await token_tracker.calculate_token_usage(
+                response, build_messages(chat_request.prompt, chat_request.tone, chat_request.language)
+            )
             
             return response
             
         # Original logic for authenticated users
-        user_tier = get_user_tier(user["sub"])
+        user_tier = await get_user_tier(user["sub"])
         
-        # Check freemium quota
-        user = users_db.get(user["sub"])
-        if user and user.tier == UserTier.FREE:
-            daily_remaining = user.daily_token_limit - user.tokens_used_today
-            if daily_remaining <= 0:
-                raise HTTPException(
-                    status_code=status.HTTP_402_PAYMENT_REQUIRED,
-                    detail="Daily token limit exceeded. Please upgrade your plan."
-                )
+        # Check quota against the current period's counters
+        remaining = await token_tracker.remaining_tokens(user["sub"], user_tier)
+        if remaining is not None and remaining <= 0:
+            raise HTTPException(
+                status_code=status.HTTP_402_PAYMENT_REQUIRED,
+                detail="Token limit exceeded. Please upgrade your plan."
+            )
         
         # Make API call
-        response = await call_deepseek_api(chat_request.prompt)
+        response, cache_hit = await cached_deepseek_call(chat_request.prompt, chat_request.tone, chat_request.language)
         
-        # Calculate and update token usage
-        token_usage = await token_tracker.calculate_token_usage(response)
-        usage_result = await token_tracker.update_usage(user["sub"], token_usage.total_tokens, user_tier)
+        # Calculate and update token usage (cache hits are free or discounted)
+        token_usage = await token_tracker.calculate_token_usage(
+            response, build_messages(chat_request.prompt, chat_request.tone, chat_request.language)
+        )
+        usage_result = None
+        tokens_charged = response_cache.billable_tokens(token_usage.total_tokens, cache_hit)
+        if tokens_charged:
+            usage_result = await token_tracker.update_usage(user["sub"], tokens_charged, user_tier)
         
         # If an upgrade was suggested, modify the response
         if isinstance(usage_result, dict) and usage_result.get("upgrade_suggested"):
@@ -741,11 +1021,130 @@ async def chat(
             }
         raise
 
+async def answer_chat_item(index: int, item: ChatRequest, max_tokens: Optional[int] = None) -> dict:
+    """Answer one batch item, reporting the tokens it should be charged"""
+    try:
+        local_answer = await math_solver.try_solve(item.prompt)
+        if local_answer is not None:
+            return {"index": index, "response": local_answer, "tokens_used": 0, "source": "local"}
+
+        response, cache_hit = await cached_deepseek_call(item.prompt, item.tone, item.language, max_tokens)
+        token_usage = await token_tracker.calculate_token_usage(
+            response, build_messages(item.prompt, item.tone, item.language)
+        )
+        return {
+            "index": index,
+            "response": response["choices"][0]["message"]["content"],
+            "tokens_used": response_cache.billable_tokens(token_usage.total_tokens, cache_hit),
+            "source": "cache" if cache_hit else "upstream"
+        }
+    except HTTPException as e:
+        return {"index": index, "error": e.detail, "status_code": e.status_code, "tokens_used": 0}
+    except Exception as e:
+        logging.error(f"Batch item error: {str(e)}")
+        return {"index": index, "error": "Chat processing failed", "status_code": 500, "tokens_used": 0}
+
+async def reserve_batch_quota(user: dict, items: List[ChatRequest]) -> tuple:
+    """Charge or reserve quota once for the whole batch, returning (tier, reservation_id, max_tokens per item)"""
+    if user["sub"].startswith("anonymous:"):
+        prompt_tokens = await tokenizer.count_tokens_async([item.prompt for item in items])
+        cost = sum(anonymous_quota.cost_for_tokens(tokens) for tokens in prompt_tokens)
+        await consume_anonymous_quota(redis_conn, user["sub"].replace("anonymous:", ""), cost)
+        return None, None, None
+
+    tier = await get_user_tier(user["sub"])
+    if token_tracker.limits_for(tier) == (None, None):
+        return tier, None, None
+
+    prompt_tokens = sum(await tokenizer.count_tokens_async([
+        msg["content"] for item in items for msg in build_messages(item.prompt, item.tone, item.language)
+    ]))
+    # One hold covers every item; each gets an equal share of the granted completion budget
+    reservation_id, budget = await token_tracker.reserve(
+        user["sub"],
+        tier,
+        int(prompt_tokens * PREFLIGHT_ESTIMATE_MARGIN),
+        PREFLIGHT_MIN_COMPLETION_TOKENS * len(items),
+        CHAT_MAX_TOKENS * len(items)
+    )
+    per_item = budget // len(items)
+    return tier, reservation_id, (per_item if per_item < CHAT_MAX_TOKENS else None)
+
+async def charge_batch_usage(user: dict, reservation_id: Optional[str], results: List[dict]) -> dict:
+    """Replace the batch reservation with one aggregated charge for all items"""
+    total_tokens = sum(r["tokens_used"] for r in results)
+    if not user["sub"].startswith("anonymous:"):
+        await token_tracker.reconcile(user["sub"], reservation_id, total_tokens)
+    return {"tokens_used": total_tokens}
+
+@app.post("/chat/batch", dependencies=[Depends(RateLimiter(times=10, minutes=1))])
+async def chat_batch(
+    request: Request,
+    batch: BatchChatRequest,
+    user: dict = Depends(get_user_or_anonymous)
+):
+    """Answer many prompts with one auth, quota check and usage update"""
+    if not batch.items:
+        raise HTTPException(status_code=400, detail="Batch is empty")
+    if len(batch.items) > CHAT_BATCH_MAX_ITEMS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Batch cannot exceed {CHAT_BATCH_MAX_ITEMS} items"
+        )
+
+    _, reservation_id, max_tokens = await reserve_batch_quota(user, batch.items)
+
+    async def release_hold():
+        # Failed or disconnected before reconciling: hand the held tokens back
+        if not user["sub"].startswith("anonymous:"):
+            await token_tracker.release(user["sub"], reservation_id)
+
+    semaphore = asyncio.Semaphore(CHAT_BATCH_CONCURRENCY)
+
+    async def bounded(index: int, item: ChatRequest) -> dict:
+        async with semaphore:
+            return await answer_chat_item(index, item, max_tokens)
+
+    tasks = [asyncio.ensure_future(bounded(i, item)) for i, item in enumerate(batch.items)]
+
+    ndjson = (
+        request.query_params.get("stream", "").lower() == "true"
+        or "application/x-ndjson" in request.headers.get("Accept", "")
+    )
+    if ndjson:
+        async def stream_results():
+            results = []
+            charged = False
+            try:
+                for next_done in asyncio.as_completed(tasks):
+                    result = await next_done
+                    results.append(result)
+                    yield json.dumps(result) + "\n"
+                summary = await charge_batch_usage(user, reservation_id, results)
+                charged = True
+                yield json.dumps({"done": True, **summary}) + "\n"
+            finally:
+                for task in tasks:
+                    task.cancel()
+                # Cut short by a disconnect: charge the items already sent, release the rest
+                if not charged and results:
+                    await charge_batch_usage(user, reservation_id, results)
+                await release_hold()
+
+        return StreamingResponse(stream_results(), media_type="application/x-ndjson")
+
+    try:
+        results = await asyncio.gather(*tasks)
+        summary = await charge_batch_usage(user, reservation_id, results)
+    finally:
+        await release_hold()
+    return {"results": results, **summary}
+
 # Add endpoint to get user's token usage
 @app.get("/token-usage")
 async def get_token_usage(user: dict = Depends(get_current_user)):
     try:
-        user_tier = get_user_tier(user["sub"])
+        user_tier = await get_user_tier(user["sub"])
         usage = await token_tracker.get_usage(user["sub"], user_tier)
         return usage
     except Exception as e:
@@ -755,6 +1154,21 @@ async def get_token_usage(user: dict = Depends(get_current_user)):
             detail=str(e)
         )
 
+@app.get("/token-usage/rollups")
+async def get_token_usage_rollups(
+    granularity: str = "hour",
+    periods: int = 24,
+    user: dict = Depends(get_current_user)
+):
+    check_rollup_query(granularity, periods)
+    buckets = await token_tracker.rollups.series(user["sub"], granularity, periods)
+    return {
+        "total_tokens": sum(b["tokens"] for b in buckets),
+        "total_billed_cost": sum(b["billed_cost"] for b in buckets),
+        "granularity": granularity,
+        "buckets": buckets
+    }
+
 # Initialize cost tracking
 from datetime import datetime
 from typing import Dict, List
@@ -864,14 +1278,25 @@ async def get_budget_alerts():
             detail=f"Error getting budget alerts: {str(e)}"
         )
 
+def check_rollup_query(granularity: str, periods: int) -> None:
+    """Reject rollup queries for unknown granularities or more buckets than are kept"""
+    if granularity not in GRANULARITIES:
+        raise HTTPException(status_code=422, detail=f"granularity must be one of {', '.join(GRANULARITIES)}")
+    kept = token_tracker.rollups.retention[granularity]
+    if not 1 <= periods <= kept:
+        raise HTTPException(status_code=422, detail=f"periods must be between 1 and {kept}")
+
 @app.get("/usage")
-async def get_usage():
+async def get_usage(granularity: str = "day", periods: int = 1):
+    check_rollup_query(granularity, periods)
     try:
-        usage = cost_tracker.get_usage()
+        # Pre-aggregated buckets, newest first
+        buckets = await token_tracker.rollups.series(None, granularity, periods)
         return {
-            "total_cost": usage["total_cost"],
-            "total_tokens": usage["total_tokens"],
-            "requests_count": usage["requests_count"]
+            "total_billed_cost": sum(b["billed_cost"] for b in buckets),
+            "total_tokens": sum(b["tokens"] for b in buckets),
+            "granularity": granularity,
+            "buckets": buckets
         }
     except Exception as e:
         logging.error(f"Usage error: {str(e)}")
@@ -908,22 +1333,86 @@ async def reset_usage():
             detail=f"Error resetting usage: {str(e)}"
         )
 
+# Response cache admin endpoints
+@app.get("/cache/stats", dependencies=[Depends(require_admin)])
+async def get_cache_stats():
+    return {
+        **response_cache.get_stats(),
+        "coalescing": single_flight.get_stats()
+    }
+
+@app.post("/cache/invalidate", dependencies=[Depends(require_admin)])
+async def invalidate_cache(
+    prompt: Optional[str] = Body(None),
+    tone: str = Body("friendly"),
+    language: str = Body("en")
+):
+    """Invalidate one cached prompt, or the whole cache when no prompt is given"""
+    try:
+        key = None
+        if prompt is not None:
+            key = response_cache.make_key(prompt, DEEPSEEK_MODEL, DEEPSEEK_TEMPERATURE, tone, language)
+        removed = await response_cache.invalidate(key)
+        return {"status": "success", "removed": removed}
+    except Exception as e:
+        logging.error(f"Cache invalidation error: {str(e)}")
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Error invalidating cache: {str(e)}"
+        )
+
+@app.get("/usage/context-cache")
+async def get_context_cache_usage():
+    try:
+        return api_cost_tracker.get_context_cache_stats()
+    except Exception as e:
+        logging.error(f"Context cache usage error: {str(e)}")
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Error getting context cache usage: {str(e)}"
+        )
+
+@app.get("/solver/stats", dependencies=[Depends(require_admin)])
+async def get_solver_stats():
+    return math_solver.get_stats()
+
+@app.get("/limiter/stats", dependencies=[Depends(require_admin)])
+async def get_limiter_stats():
+    return deepseek_limiter.get_stats()
+
+@app.get("/quota/stats", dependencies=[Depends(require_admin)])
+async def get_quota_stats():
+    return {
+        "anonymous": anonymous_quota.get_stats(),
+        "reservations": token_tracker.get_reservation_stats(),
+        "usage_store": token_tracker.store.get_stats(),
+        "usage_rollups": token_tracker.rollups.get_stats(),
+        "usage_history": usage_history.get_stats()
+    }
+
+@app.get("/tokenizer/stats", dependencies=[Depends(require_admin)])
+async def get_tokenizer_stats():
+    return tokenizer.get_stats()
+
+@app.get("/upstream/breaker", dependencies=[Depends(require_admin)])
+async def get_upstream_breaker():
+    return deepseek_resilience.get_stats()
+
+@app.get("/users/stats", dependencies=[Depends(require_admin)])
+async def get_user_stats():
+    return user_repository.get_stats()
+
+@app.get("/redis/stats", dependencies=[Depends(require_admin)])
+async def get_redis_stats():
+    return redis_pool.get_stats()
+
 # Health check endpoints
 # Then update the health check endpoint
 @app.get("/health")
-async def health_check():
+async def health_check(redis_client: aioredis.Redis = Depends(get_redis)):
     """Endpoint to verify Redis connectivity"""
     try:
-        redis_url = os.getenv("REDIS_URL")
-        if not redis_url:
-            return JSONResponse(
-                {"status": "REDIS_URL not configured"},
-                status_code=500
-            )
-        
-        # Use sync connection for health check
-        sync_redis = redis.Redis.from_url(redis_url)
-        if not sync_redis.ping():
+        if not await redis_client.ping():
             return JSONResponse(
                 {"status": "Redis unavailable"},
                 status_code=500
@@ -936,35 +1425,22 @@ async def health_check():
             status_code=500
         )
         
-# Add this near your Redis config
-MAX_ANONYMOUS_TOKENS = 30  # New global limit
-
 @app.post("/api/anonymous/token")
 async def generate_anonymous_token():
-    """Generate token with daily limit check"""
-    redis_url = os.getenv("REDIS_URL")
-    if not redis_url:
-        raise HTTPException(500, "Redis not configured")
-
-    async with async_redis.Redis.from_url(redis_url) as r:
-        # Count existing tokens
-        token_count = len(await r.keys("anonymous:*"))
-        if token_count >= MAX_ANONYMOUS_TOKENS:
-            raise HTTPException(
-                status_code=429,
-                detail="Daily anonymous user limit reached"
-            )
+    """Generate a new anonymous session token, subject to the daily issuance limit"""
+    try:
+        # One scripted round trip checks the daily counter and creates the token
+        token, _ = await anonymous_quota.issue(redis_conn)
+    except redis.RedisError as e:
+        logging.error(f"Token generation error: {str(e)}")
+        return JSONResponse({"error": "Token storage failed"}, status_code=500)
 
-        token = str(uuid.uuid4())
-        await r.hset(
-            f"anonymous:{token}",
-            mapping={
-                "quota_remaining": 1000,
-                "quota_reset_at": (datetime.utcnow() + timedelta(days=1)).isoformat()
-            }
+    if token is None:
+        raise HTTPException(
+            status_code=429,
+            detail="Daily anonymous user limit reached"
         )
-        await r.expireat(f"anonymous:{token}", int((datetime.utcnow() + timedelta(days=1)).timestamp()))
-        return {"token": token}
+    return token
 
 # Test endpoints
 @app.get("/test/user/{username}")
@@ -993,11 +1469,10 @@ async def test_deepseek_api():
         )
 
 @app.get("/test/redis")
-async def test_redis():
+async def test_redis(redis_client: aioredis.Redis = Depends(get_redis)):
     try:
-        async with redis.Redis.from_url(os.getenv("REDIS_URL")) as redis_client:
-            await redis_client.ping()
-            return {"status": "success", "message": "Redis connection working"}
+        await redis_client.ping()
+        return {"status": "success", "message": "Redis connection working"}
     except Exception as e:
         logging.error(f"Redis connection failed: {e}")
         raise HTTPException(status_code=500, detail="Redis connection failed")
@@ -1005,11 +1480,8 @@ async def test_redis():
 # Upgrade endpoint
 @app.post("/upgrade")
 async def upgrade_user(user_id: str = Body(...)):
-    if user_id not in users_db:
+    if not await user_repository.set_tier(user_id, UserTier.PRO.value):
         raise HTTPException(status_code=404, detail="User not found")
-    
-    users_db[user_id]['tier'] = UserTier.PRO
-    users_db[user_id]['monthly_token_limit'] = 1000000
     return {"status": "success", "message": "Upgraded to Pro plan"}
 
 # OAuth endpoints
@@ -1019,20 +1491,10 @@ async def auth_google(token: str = Body(...)):
         idinfo = id_token.verify_oauth2_token(token, requests.Request(), GOOGLE_CLIENT_ID)
         
         # Create or get user
-        user_id = f"google_{idinfo['sub']}"
-        if user_id not in users_db:
-            users_db[user_id] = {
-                'name': idinfo.get('name'),
-                'email': idinfo.get('email'),
-                'tier': UserTier.FREE,
-                'daily_token_limit': 10000,
-                'monthly_token_limit': 0,
-                'tokens_used_today': 0,
-                'tokens_used_month': 0,
-                'last_reset_date': None
-            }
-        
-        return {"user_id": user_id, "name": users_db[user_id]['name']}
+        user = await user_repository.get_or_create_oauth(
+            "google", idinfo['sub'], name=idinfo.get('name'), email=idinfo.get('email')
+        )
+        return {"user_id": user.username, "name": user.name}
     except ValueError:
         raise HTTPException(status_code=400, detail="Invalid token")
 
@@ -1040,24 +1502,22 @@ async def auth_google(token: str = Body(...)):
 async def auth_apple(token: str = Body(...)):
     # In production, implement proper Apple ID token verification
     # This is a simplified version for development
-    user_id = f"apple_{token[-10:]}"  # Mock user ID
-    if user_id not in users_db:
-        users_db[user_id] = {
-            'name': "Apple User",
-            'email': f"{user_id}@example.com",
-            'tier': UserTier.FREE,
-            'daily_token_limit': 10000,
-            'monthly_token_limit': 0,
-            'tokens_used_today': 0,
-            'tokens_used_month': 0,
-            'last_reset_date': None
-        }
-    return {"user_id": user_id, "name": users_db[user_id]['name']}
+    subject = token[-10:]  # Mock subject
+    user = await user_repository.get_or_create_oauth(
+        "apple", subject, name="Apple User", email=f"apple_{subject}@example.com"
+    )
+    return {"user_id": user.username, "name": user.name}
 
 # Shutdown handler
 @app.on_event("shutdown")
 async def shutdown_event():
+    # Flush buffered usage before the connection goes away
+    await token_tracker.store.aclose()
+    await token_tracker.rollups.aclose()
     await redis_conn.close()
+    await redis_pool.disconnect()
+    await user_repository.aclose()
+    await llm_backend.aclose()
 
 # Setup logging
 logging.basicConfig(
@@ -1076,53 +1536,48 @@ async def log_requests(request: Request, call_next):
     )
     return response
 
-import redis
 from datetime import datetime
 
-# Redis setup
-r = redis.Redis(
-    host='localhost',
-    port=6379,
-    decode_responses=True
-)
-
-DAILY_LIMIT = 1000  # Tokens per day for anonymous users
-
-# Token counting function (placeholder)
-async def count_tokens(text: str) -> int:
-    """Approximate token count - replace with actual DeepSeek tokenizer"""
-    return len(text.split())  # Simple approximation
-
 @app.post("/anonymous-chat")
-async def anonymous_chat(chat_request: ChatRequest, request: Request):
+async def anonymous_chat(
+    chat_request: ChatRequest,
+    request: Request,
+    redis_client: aioredis.Redis = Depends(get_redis)
+):
     try:
         client_ip = request.client.host
-        today = datetime.utcnow().strftime("%Y-%m-%d")
-        redis_key = f"anon_usage:{today}:{client_ip}"
-        
-        # Get current usage
-        current_usage = int(r.get(redis_key) or 0)
-        
-        if current_usage >= DAILY_LIMIT:
+        prompt_tokens = (await tokenizer.count_tokens_async([chat_request.prompt]))[0]
+
+        # Hold the prompt plus as much completion as today's allowance covers, in one script,
+        # so concurrent requests from the same IP can't all pass a stale check
+        granted, _, usage_key = await anonymous_quota.reserve_ip_tokens(
+            redis_client, client_ip,
+            prompt_tokens + PREFLIGHT_MIN_COMPLETION_TOKENS,
+            prompt_tokens + min(CHAT_MAX_TOKENS, anonymous_quota.ip_max_completion)
+        )
+        if not granted:
             raise HTTPException(
                 status_code=429,
-                detail=f"Daily limit reached ({DAILY_LIMIT} tokens). Sign in for more access."
+                detail=f"Daily limit reached ({anonymous_quota.ip_daily_limit} tokens). Sign in for more access."
             )
-        
-        # Process request
-        response = await call_deepseek_api(chat_request.prompt)
-        token_count = await count_tokens(chat_request.prompt + response)
-        
-        # Update usage with pipeline for atomic operation
-        with r.pipeline() as pipe:
-            pipe.incrby(redis_key, token_count)
-            pipe.expire(redis_key, 86400)  # 24 hours
-            pipe.execute()
-        
+
+        spent = 0
+        try:
+            max_tokens = granted - prompt_tokens
+            response, _ = await cached_deepseek_call(
+                chat_request.prompt, chat_request.tone, chat_request.language,
+                max_tokens if max_tokens < CHAT_MAX_TOKENS else None
+            )
+            content = response["choices"][0]["message"]["content"]
+            spent = sum(await tokenizer.count_tokens_async([chat_request.prompt, content]))
+        finally:
+            # Swap the hold for what was actually used; nothing if the call failed
+            usage = await anonymous_quota.settle_ip_tokens(redis_client, usage_key, granted, spent)
+
         return {
-            "response": response,
-            "usage": current_usage + token_count,
-            "remaining": max(0, DAILY_LIMIT - (current_usage + token_count))
+            "response": content,
+            "usage": usage,
+            "remaining": max(0, anonymous_quota.ip_daily_limit - usage)
         }
     except HTTPException:
         raise
@@ -1132,14 +1587,14 @@ async def anonymous_chat(chat_request: ChatRequest, request: Request):
 
 # Add usage tracking endpoints
 @app.post("/track")
-async def track_usage(request: Request):
+async def track_usage(request: Request, redis_client: aioredis.Redis = Depends(get_redis)):
     # Get or create anonymous user ID
     anon_id = request.cookies.get('anon_id') or str(uuid.uuid4())
     
     # Track in Redis with timestamp
     timestamp = datetime.now().isoformat()
     data = await request.json()
-    r.hset(f"user:{anon_id}", mapping={
+    await redis_client.hset(f"user:{anon_id}", mapping={
         "last_active": timestamp,
         data['action']: timestamp
     })
@@ -1192,56 +1647,6 @@ class AnonymousUser(BaseModel):
     quota_remaining: int = 1000  # Default daily quota
     quota_reset_at: datetime = datetime.utcnow() + timedelta(days=1)
 
-# Anonymous endpoints
-@app.post("/api/anonymous/token")
-async def generate_anonymous_token():
-    """Generate a new anonymous session token with daily quota"""
-    try:
-        # Validate Redis URL first
-        redis_url = os.getenv("REDIS_URL")
-        if not redis_url:
-            logging.error("REDIS_URL environment variable not set")
-            return JSONResponse(
-                {"error": "Server configuration error"},
-                status_code=500
-            )
-
-        token = str(uuid.uuid4())
-        reset_time = datetime.utcnow() + timedelta(days=1)
-        
-        try:
-            async with redis.Redis.from_url(redis_url) as redis_client:
-                # Test connection first
-                if not await redis_client.ping():
-                    raise ConnectionError("Redis connection failed")
-                    
-                await redis_client.hset(
-                    f"anonymous:{token}",
-                    mapping={
-                        "quota_remaining": 1000,
-                        "quota_reset_at": reset_time.isoformat()
-                    }
-                )
-                await redis_client.expire(f"anonymous:{token}", 86400)
-        except redis.RedisError as e:
-            logging.error(f"Redis operation failed: {str(e)}")
-            return JSONResponse(
-                {"error": "Token storage failed"},
-                status_code=500
-            )
-
-        return JSONResponse({
-            "token": token,
-            "quota_remaining": 1000,
-            "quota_reset_at": reset_time.isoformat()
-        })
-    except Exception as e:
-        logging.error(f"Token generation error: {str(e)}")
-        return JSONResponse(
-            {"error": "Token generation failed"},
-            status_code=500
-        )
-
 # Updated middleware
 @app.middleware("http")
 async def check_anonymous_quota(request: Request, call_next):
@@ -1256,13 +1661,10 @@ async def check_anonymous_quota(request: Request, call_next):
         if not token:
             raise HTTPException(status_code=401, detail="Anonymous token required")
             
-        async with redis.Redis.from_url(os.getenv("REDIS_URL")) as redis_client:
-            quota = await redis_client.hget(f"anonymous:{token}", "quota_remaining")
-            if not quota or int(quota) <= 0:
-                raise HTTPException(status_code=429, detail="Daily quota exceeded")
-            
-            # Decrement quota for each request
-            await redis_client.hincrby(f"anonymous:{token}", "quota_remaining", -1)
+        # Middleware can't take dependencies, so use the shared client directly
+        outcome, _ = await anonymous_quota.consume(redis_conn, token)
+        if outcome != anonymous_quota.CONSUMED:
+            raise HTTPException(status_code=429, detail="Daily quota exceeded")
     
     return await call_next(request)
 
@@ -0,0 +1,267 @@
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from typing import Dict, Any, Optional
+import asyncio
+import logging
+import math
+import os
+import re
+import threading
+from dotenv import load_dotenv
+import sympy
+from sympy.parsing.sympy_parser import (
+    parse_expr,
+    standard_transformations,
+    implicit_multiplication_application,
+    convert_xor
+)
+
+load_dotenv()
+
+TRANSFORMATIONS = standard_transformations + (implicit_multiplication_application, convert_xor)
+
+# Only plain math notation is ever handed to the sympy parser
+ALLOWED_CHARS = re.compile(r"^[0-9a-z\s+\-*/^().=,]+$")
+ALLOWED_WORDS = {"sin", "cos", "tan", "log", "ln", "exp", "sqrt", "pi"}
+WORD = re.compile(r"[a-z]+")
+NUMBER = re.compile(r"\d+")
+# "2 3" would parse as 2*3; numbers side by side need an explicit operator
+ADJACENT_NUMBERS = re.compile(r"[\d.]\s+[\d.]")
+# Trig or log of a plain number: students may mean degrees or log base 10, so leave it to the LLM
+AMBIGUOUS_CALL = re.compile(r"\b(?:sin|cos|tan|log)\s*(?:\(\s*[\d.\s+\-*/^]+\)|[\d.]+)")
+
+PREFIX = re.compile(
+    r"^(?:what\s+is|what's|calculate|compute|evaluate|simplify|find|solve(?:\s+for\s+[a-z])?)\s*:?\s*"
+)
+DERIVATIVE = re.compile(
+    r"^(?:(?:find\s+)?(?:the\s+)?derivative\s+of|differentiate|d/d([a-z]))\s*:?\s*(.+?)(?:\s+with\s+respect\s+to\s+([a-z]))?$"
+)
+
+class LocalMathSolver:
+    """Deterministic sympy fast path for arithmetic, simple equations and derivatives"""
+
+    MAX_PROMPT_LENGTH = 200
+    MAX_NUMBER_DIGITS = 15
+    MAX_EXPONENT = 1000
+    MAX_RESULT_DIGITS = 1000
+    MAX_EQUATION_DEGREE = 2
+
+    def __init__(self):
+        self.enabled = os.getenv('LOCAL_SOLVER_ENABLED', 'true').lower() == 'true'
+        self.timeout = float(os.getenv('LOCAL_SOLVER_TIMEOUT', 0.25))
+        # Own small pool: a timed-out solve keeps running, so it must not tie up the
+        # default executor that bcrypt and the tokenizer share
+        self.max_workers = int(os.getenv('LOCAL_SOLVER_WORKERS', 2))
+        self._executor = ThreadPoolExecutor(self.max_workers, thread_name_prefix="math-solver")
+        self._slots = threading.BoundedSemaphore(self.max_workers)
+        self.stats = {
+            'attempts': 0,
+            'solved': 0,
+            'fell_through': 0,
+            'timeouts': 0,
+            'saturated': 0
+        }
+
+    @staticmethod
+    def _clean(prompt: str) -> str:
+        # "!" is kept so factorials fall through instead of being silently dropped
+        text = prompt.strip().lower().rstrip("?. ")
+        return text.replace("×", "*").replace("÷", "/").replace("−", "-")
+
+    @staticmethod
+    @lru_cache(maxsize=2048)
+    def _parse(text: str, evaluate: bool = True) -> sympy.Expr:
+        """Parse an expression, caching the result for repeated prompts"""
+        local_dict = {"ln": sympy.log, "e": sympy.E}
+        return parse_expr(text, local_dict=local_dict, transformations=TRANSFORMATIONS, evaluate=evaluate)
+
+    def _is_safe_text(self, text: str) -> bool:
+        if not text or len(text) > self.MAX_PROMPT_LENGTH or not ALLOWED_CHARS.match(text):
+            return False
+        if any(len(n) > self.MAX_NUMBER_DIGITS for n in NUMBER.findall(text)):
+            return False
+        if ADJACENT_NUMBERS.search(text) or AMBIGUOUS_CALL.search(text):
+            return False
+        return all(len(w) == 1 or w in ALLOWED_WORDS for w in WORD.findall(text))
+
+    def _is_safe_expr(self, expr: sympy.Expr) -> bool:
+        """Reject powers that would take unbounded time or memory to evaluate"""
+        for node in sympy.preorder_traversal(expr):
+            if not isinstance(node, sympy.Pow) or node.exp.free_symbols:
+                continue
+            if abs(node.exp.evalf(5)) > self.MAX_EXPONENT:
+                return False
+            if not node.free_symbols:
+                base = abs(node.base.evalf(5))
+                if base == 0:
+                    continue
+                digits = (sympy.log(base, 10) * node.exp).evalf(5)
+                if digits.is_real and abs(digits) > self.MAX_RESULT_DIGITS:
+                    return False
+        return True
+
+    @classmethod
+    def _degree_bound(cls, expr: sympy.Expr) -> float:
+        """Upper bound on polynomial degree read from the unexpanded tree; inf if not polynomial"""
+        if not expr.free_symbols:
+            return 0
+        if expr.is_Symbol:
+            return 1
+        if isinstance(expr, sympy.Add):
+            return max(cls._degree_bound(arg) for arg in expr.args)
+        if isinstance(expr, sympy.Mul):
+            return sum(cls._degree_bound(arg) for arg in expr.args)
+        if isinstance(expr, sympy.Pow) and expr.exp.is_Integer and expr.exp >= 0:
+            return cls._degree_bound(expr.base) * int(expr.exp)
+        return math.inf
+
+    def _parse_safe(self, text: str) -> Optional[sympy.Expr]:
+        if not self._is_safe_text(text):
+            return None
+        if not self._is_safe_expr(self._parse(text, evaluate=False)):
+            return None
+        return self._parse(text)
+
+    @staticmethod
+    def _format(expr: sympy.Expr) -> str:
+        return sympy.sstr(expr).replace("**", "^")
+
+    @staticmethod
+    def _approx(value: sympy.Expr) -> Optional[float]:
+        """Float approximation, or None when it overflows or underflows to zero"""
+        try:
+            approx = float(value)
+        except OverflowError:
+            return None
+        if not math.isfinite(approx) or (approx == 0 and value != 0):
+            return None
+        return approx
+
+    def _format_number(self, value: sympy.Expr) -> Optional[str]:
+        if value.is_Integer:
+            return str(value)
+        approx = self._approx(value)
+        if approx is None:
+            return None
+        return f"{self._format(value)} ≈ {approx:.10g}"
+
+    def _solve_derivative(self, text: str) -> Optional[str]:
+        match = DERIVATIVE.match(text)
+        if not match:
+            return None
+        body = match.group(2)
+        expr = self._parse_safe(body)
+        if expr is None or not expr.free_symbols:
+            return None
+
+        var_name = match.group(1) or match.group(3)
+        if var_name:
+            var = sympy.Symbol(var_name)
+        elif len(expr.free_symbols) == 1:
+            var = next(iter(expr.free_symbols))
+        else:
+            var = sympy.Symbol("x")
+        if var not in expr.free_symbols:
+            return None
+
+        result = sympy.diff(expr, var)
+        return f"d/d{var} ({self._format(expr)}) = {self._format(result)}"
+
+    def _solve_equation(self, text: str) -> Optional[str]:
+        left, right = text.split("=")
+        lhs, rhs = self._parse_safe(left), self._parse_safe(right)
+        if lhs is None or rhs is None:
+            return None
+        # Checked before sympy expands anything: (x+1)^999 = 0 would take seconds to minutes
+        unevaluated = (self._parse(left, evaluate=False), self._parse(right, evaluate=False))
+        if max(self._degree_bound(side) for side in unevaluated) > self.MAX_EQUATION_DEGREE:
+            return None
+
+        expr = lhs - rhs
+        if expr.has(sympy.zoo, sympy.nan, sympy.oo, -sympy.oo):
+            return None
+        if len(expr.free_symbols) != 1:
+            return None
+        var = next(iter(expr.free_symbols))
+        if not expr.is_polynomial(var) or sympy.degree(expr, var) > self.MAX_EQUATION_DEGREE:
+            return None
+
+        solutions = [s for s in sympy.solve(sympy.Eq(lhs, rhs), var) if s.is_real]
+        if not solutions:
+            return f"{self._format(lhs)} = {self._format(rhs)} has no real solution"
+        formatted = [self._format_number(s) for s in solutions]
+        if None in formatted:
+            return None
+        answers = " or ".join(f"{var} = {f}" for f in formatted)
+        return f"Solving {self._format(lhs)} = {self._format(rhs)}: {answers}"
+
+    def _solve_arithmetic(self, text: str) -> Optional[str]:
+        expr = self._parse_safe(text)
+        if expr is None or expr.free_symbols or not expr.is_number:
+            return None
+        if expr.has(sympy.zoo, sympy.nan, sympy.oo) or not expr.is_real:
+            return None
+        value = sympy.nsimplify(expr) if expr.is_Float else expr
+        if self._format(value) == text:
+            approx = self._approx(value)
+            return f"{text} ≈ {approx:.10g}" if approx is not None else None
+        formatted = self._format_number(value)
+        return f"{text} = {formatted}" if formatted is not None else None
+
+    def solve(self, prompt: str) -> Optional[str]:
+        """Try to answer the prompt locally; None means fall through to the LLM"""
+        text = self._clean(prompt)
+        if not text or len(text) > self.MAX_PROMPT_LENGTH:
+            return None
+        try:
+            answer = self._solve_derivative(text)
+            if answer:
+                return answer
+
+            text = PREFIX.sub("", text)
+            if text.count("=") == 1:
+                return self._solve_equation(text)
+            if "=" not in text:
+                return self._solve_arithmetic(text)
+        except Exception as e:
+            logging.debug(f"Local solver could not handle prompt: {str(e)}")
+        return None
+
+    async def try_solve(self, prompt: str) -> Optional[str]:
+        """Run the solver in its own pool, giving up after the configured timeout"""
+        if not self.enabled:
+            return None
+
+        self.stats['attempts'] += 1
+        answer = None
+        if not self._slots.acquire(blocking=False):
+            # Every worker is still busy with an abandoned solve; leave this one to the LLM
+            self.stats['saturated'] += 1
+        else:
+            future = self._executor.submit(self.solve, prompt)
+            # The slot frees when the solve really ends, not when we stop waiting for it
+            future.add_done_callback(lambda _: self._slots.release())
+            try:
+                answer = await asyncio.wait_for(asyncio.wrap_future(future), self.timeout)
+            except asyncio.TimeoutError:
+                self.stats['timeouts'] += 1
+
+        if answer is None:
+            self.stats['fell_through'] += 1
+        else:
+            self.stats['solved'] += 1
+        return answer
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Get solver counters and the fraction of chat traffic it absorbed"""
+        attempts = self.stats['attempts']
+        return {
+            **self.stats,
+            'absorbed_fraction': self.stats['solved'] / attempts if attempts else 0.0,
+            'parse_cache': self._parse.cache_info()._asdict(),
+            'max_workers': self.max_workers,
+            'enabled': self.enabled
+        }
+
+# Initialize local math solver
+math_solver = LocalMathSolver()
@@ -0,0 +1,187 @@
+from datetime import datetime, timedelta
+from typing import Any, Dict, Optional, Tuple
+import logging
+import math
+import os
+import time
+import uuid
+from dotenv import load_dotenv
+from redis.exceptions import NoScriptError
+
+load_dotenv()
+
+# KEYS[1] = anonymous:<token>, ARGV[1] = cost
+# Returns {status, remaining}: 1 consumed, 0 quota exceeded, -1 unknown token.
+# A cost of 0 validates the token and checks the quota without spending any.
+CHECK_AND_DECREMENT_LUA = """
+local quota = redis.call('HGET', KEYS[1], 'quota_remaining')
+if not quota then
+    return {-1, 0}
+end
+quota = tonumber(quota)
+local cost = tonumber(ARGV[1])
+if quota <= 0 or quota < cost then
+    return {0, quota}
+end
+if cost == 0 then
+    return {1, quota}
+end
+return {1, redis.call('HINCRBY', KEYS[1], 'quota_remaining', -cost)}
+"""
+
+# KEYS[1] = anonymous_issued:<day>, KEYS[2] = anonymous:<token>
+# ARGV: daily_limit, quota, quota_reset_at, expire_at (unix), counter_ttl
+# Returns {issued, count}: the token is created only when issued is 1.
+ISSUE_TOKEN_LUA = """
+local count = tonumber(redis.call('GET', KEYS[1]) or '0')
+if count >= tonumber(ARGV[1]) then
+    return {0, count}
+end
+count = redis.call('INCR', KEYS[1])
+redis.call('EXPIRE', KEYS[1], tonumber(ARGV[5]))
+redis.call('HSET', KEYS[2], 'quota_remaining', ARGV[2], 'quota_reset_at', ARGV[3])
+redis.call('EXPIREAT', KEYS[2], tonumber(ARGV[4]))
+return {1, count}
+"""
+
+# KEYS[1] = anon_usage:<day>:<ip>
+# ARGV: daily_limit, minimum, wanted, ttl
+# Holds min(wanted, what's left) of the day's tokens, or nothing if less than
+# `minimum` is left. Returns {granted, used}.
+RESERVE_IP_TOKENS_LUA = """
+local used = tonumber(redis.call('GET', KEYS[1]) or '0')
+local available = tonumber(ARGV[1]) - used
+if available < tonumber(ARGV[2]) then
+    return {0, used}
+end
+local granted = math.min(available, tonumber(ARGV[3]))
+used = redis.call('INCRBY', KEYS[1], granted)
+redis.call('EXPIRE', KEYS[1], tonumber(ARGV[4]))
+return {granted, used}
+"""
+
+class AnonymousQuota:
+    """Atomic check-and-decrement of anonymous token quotas in one Redis round trip"""
+
+    CONSUMED = 1
+    EXCEEDED = 0
+    INVALID = -1
+
+    def __init__(self):
+        # Prompt tokens covered by one quota unit; short prompts always cost 1
+        self.tokens_per_unit = int(os.getenv('ANONYMOUS_TOKENS_PER_QUOTA_UNIT', 100))
+        # Tokens issued per UTC day across all workers, and the quota each one starts with
+        self.daily_token_limit = int(os.getenv('MAX_ANONYMOUS_TOKENS', 30))
+        self.initial_quota = int(os.getenv('ANONYMOUS_DAILY_QUOTA', 1000))
+        # Tokens per UTC day for token-less anonymous chat, keyed by client IP
+        self.ip_daily_limit = int(os.getenv('ANONYMOUS_IP_DAILY_TOKENS', 1000))
+        # Completion tokens held per request, so one caller can't hold the whole allowance
+        self.ip_max_completion = int(os.getenv('ANONYMOUS_IP_MAX_COMPLETION_TOKENS', 256))
+        self.sha: Optional[str] = None
+        self.issue_sha: Optional[str] = None
+        self.ip_sha: Optional[str] = None
+        self.stats = {
+            'consumed': 0,
+            'exceeded': 0,
+            'invalid': 0,
+            'units_consumed': 0,
+            'issued': 0,
+            'issue_rejected': 0,
+            'ip_reserved': 0,
+            'ip_rejected': 0,
+            'script_loads': 0
+        }
+
+    def cost_for_tokens(self, tokens: int) -> int:
+        """Quota units charged for a prompt of the given size"""
+        return max(1, math.ceil(tokens / self.tokens_per_unit))
+
+    async def load(self, client) -> str:
+        """Load the scripts into Redis and remember their SHAs"""
+        self.sha = await client.script_load(CHECK_AND_DECREMENT_LUA)
+        self.issue_sha = await client.script_load(ISSUE_TOKEN_LUA)
+        self.ip_sha = await client.script_load(RESERVE_IP_TOKENS_LUA)
+        self.stats['script_loads'] += 1
+        return self.sha
+
+    async def _evalsha(self, client, script: str, keys: list, args: list):
+        """Run one of the loaded scripts by SHA, reloading once if Redis lost it"""
+        if getattr(self, script) is None:
+            await self.load(client)
+        try:
+            return await client.evalsha(getattr(self, script), len(keys), *keys, *args)
+        except NoScriptError:
+            # Redis restarted or was flushed; reload once and retry
+            logging.warning("Anonymous quota scripts missing from Redis, reloading")
+            await self.load(client)
+            return await client.evalsha(getattr(self, script), len(keys), *keys, *args)
+
+    async def consume(self, client, token: str, cost: int = 1) -> Tuple[int, int]:
+        """Spend `cost` units of a token's quota, returning (status, remaining)"""
+        status, remaining = await self._evalsha(client, "sha", [f"anonymous:{token}"], [cost])
+        status, remaining = int(status), int(remaining)
+        if status == self.CONSUMED:
+            self.stats['consumed'] += 1
+            self.stats['units_consumed'] += cost
+        elif status == self.EXCEEDED:
+            self.stats['exceeded'] += 1
+        else:
+            self.stats['invalid'] += 1
+        return status, remaining
+
+    async def issue(self, client) -> Tuple[Optional[Dict[str, Any]], int]:
+        """Create a token if today's issuance limit allows it, returning (token info or None, issued today)"""
+        now = datetime.utcnow()
+        reset_at = now + timedelta(days=1)
+        token = str(uuid.uuid4())
+        keys = [f"anonymous_issued:{now.strftime('%Y%m%d')}", f"anonymous:{token}"]
+        # Keep the counter past midnight so late reads of yesterday still work
+        args = [self.daily_token_limit, self.initial_quota, reset_at.isoformat(), int(time.time()) + 86400, 2 * 86400]
+        issued, count = await self._evalsha(client, "issue_sha", keys, args)
+
+        if not int(issued):
+            self.stats['issue_rejected'] += 1
+            return None, int(count)
+        self.stats['issued'] += 1
+        return {
+            "token": token,
+            "quota_remaining": self.initial_quota,
+            "quota_reset_at": reset_at.isoformat()
+        }, int(count)
+
+    @staticmethod
+    def _ip_key(client_ip: str) -> str:
+        return f"anon_usage:{datetime.utcnow().strftime('%Y-%m-%d')}:{client_ip}"
+
+    async def reserve_ip_tokens(self, client, client_ip: str, minimum: int, wanted: int) -> Tuple[int, int, str]:
+        """Atomically hold up to `wanted` of an IP's daily tokens, returning (granted, used today, key).
+
+        Nothing is held, and granted is 0, when fewer than `minimum` tokens are left.
+        Pass the key back to settle_ip_tokens so the hold is settled on the day it was taken.
+        """
+        key = self._ip_key(client_ip)
+        granted, used = await self._evalsha(client, "ip_sha", [key], [self.ip_daily_limit, minimum, wanted, 86400])
+        granted, used = int(granted), int(used)
+        self.stats['ip_reserved' if granted else 'ip_rejected'] += 1
+        return granted, used, key
+
+    async def settle_ip_tokens(self, client, key: str, granted: int, spent: int) -> int:
+        """Replace a hold with the tokens actually spent, returning that day's usage for the IP"""
+        async with client.pipeline(transaction=True) as pipe:
+            pipe.incrby(key, spent - granted)
+            pipe.expire(key, 86400)
+            usage, _ = await pipe.execute()
+        return int(usage)
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Get quota decision counters"""
+        return {
+            **self.stats,
+            'tokens_per_unit': self.tokens_per_unit,
+            'daily_token_limit': self.daily_token_limit,
+            'ip_daily_limit': self.ip_daily_limit,
+            'script_loaded': self.sha is not None
+        }
+
+# Initialize anonymous quota script
+anonymous_quota = AnonymousQuota()
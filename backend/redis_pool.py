@@ -0,0 +1,61 @@
+from typing import Any, Dict
+import os
+import time
+import redis.asyncio as aioredis
+from dotenv import load_dotenv
+
+load_dotenv()
+
+class InstrumentedConnectionPool(aioredis.BlockingConnectionPool):
+    """Blocking Redis pool shared by the whole app, with checkout metrics.
+
+    When every connection is busy, callers wait up to `timeout` seconds for one
+    to be released rather than opening another socket.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._checked_out = set()
+        self.stats = {'checkouts': 0, 'checkout_errors': 0, 'max_wait_ms': 0.0, 'total_wait_ms': 0.0}
+
+    async def get_connection(self, command_name, *keys, **options):
+        start = time.perf_counter()
+        try:
+            connection = await super().get_connection(command_name, *keys, **options)
+        except Exception:
+            # Pool exhausted for `timeout` seconds, or Redis unreachable
+            self.stats['checkout_errors'] += 1
+            raise
+        waited = (time.perf_counter() - start) * 1000
+        self.stats['checkouts'] += 1
+        self.stats['total_wait_ms'] += waited
+        self.stats['max_wait_ms'] = max(self.stats['max_wait_ms'], waited)
+        self._checked_out.add(connection)
+        return connection
+
+    async def release(self, connection) -> None:
+        self._checked_out.discard(connection)
+        await super().release(connection)
+
+    def get_stats(self) -> Dict[str, Any]:
+        checkouts = self.stats['checkouts']
+        return {
+            **self.stats,
+            'max_connections': self.max_connections,
+            'created_connections': len(self._connections),
+            'in_use_connections': len(self._checked_out),
+            'avg_wait_ms': self.stats['total_wait_ms'] / checkouts if checkouts else 0.0
+        }
+
+def create_redis_pool() -> InstrumentedConnectionPool:
+    """Create the app-wide pool for REDIS_URL; connections are opened on demand"""
+    return InstrumentedConnectionPool.from_url(
+        os.getenv('REDIS_URL', 'redis://localhost:6379'),
+        max_connections=int(os.getenv('REDIS_MAX_CONNECTIONS', 50)),
+        timeout=float(os.getenv('REDIS_POOL_TIMEOUT', 5)),
+        socket_connect_timeout=float(os.getenv('REDIS_CONNECT_TIMEOUT', 5)),
+        socket_timeout=float(os.getenv('REDIS_SOCKET_TIMEOUT', 5)),
+        health_check_interval=int(os.getenv('REDIS_HEALTH_CHECK_INTERVAL', 30)),
+        retry_on_timeout=True,
+        decode_responses=True
+    )
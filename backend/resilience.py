@@ -0,0 +1,232 @@
+from collections import deque
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Optional
+import asyncio
+import logging
+import os
+import random
+import time
+from dotenv import load_dotenv
+import httpx
+
+load_dotenv()
+
+RETRYABLE_STATUS_CODES = (429, 500, 502, 503, 504)
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling the upstream while the breaker is open"""
+
+    def __init__(self, retry_after: int):
+        super().__init__("Upstream circuit breaker is open")
+        self.retry_after = retry_after
+
+def is_retryable(exc: BaseException) -> bool:
+    """Transient upstream failures that are safe to retry and count against the breaker"""
+    if isinstance(exc, (httpx.TransportError, asyncio.TimeoutError)):
+        return True
+    if isinstance(exc, httpx.HTTPStatusError):
+        return exc.response.status_code in RETRYABLE_STATUS_CODES
+    return False
+
+class CircuitBreaker:
+    """Closed/open/half-open breaker that fails fast while the upstream is unhealthy"""
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self):
+        self.failure_threshold = int(os.getenv('BREAKER_FAILURE_THRESHOLD', 5))
+        self.recovery_timeout = float(os.getenv('BREAKER_RECOVERY_TIMEOUT', 30.0))
+        self.state = self.CLOSED
+        self.consecutive_failures = 0
+        self.opened_at: Optional[float] = None
+        self._probe_in_flight = False
+        self.stats = {
+            'opened': 0,
+            'rejected': 0
+        }
+
+    def _retry_after(self) -> int:
+        if self.opened_at is None:
+            return 1
+        remaining = self.recovery_timeout - (time.monotonic() - self.opened_at)
+        return max(1, int(remaining + 0.999))
+
+    def before_call(self) -> None:
+        """Raise CircuitOpenError unless a call may proceed"""
+        if self.state == self.OPEN:
+            if time.monotonic() - self.opened_at < self.recovery_timeout:
+                self.stats['rejected'] += 1
+                raise CircuitOpenError(self._retry_after())
+            self.state = self.HALF_OPEN
+            self._probe_in_flight = False
+
+        if self.state == self.HALF_OPEN:
+            # Only one probe is allowed through while half open
+            if self._probe_in_flight:
+                self.stats['rejected'] += 1
+                raise CircuitOpenError(1)
+            self._probe_in_flight = True
+
+    def release_probe(self) -> None:
+        """Let another half-open probe through after a call ended without a verdict"""
+        self._probe_in_flight = False
+
+    def record_success(self) -> None:
+        if self.state != self.CLOSED:
+            logging.info("Upstream circuit breaker closed")
+        self.state = self.CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = None
+        self._probe_in_flight = False
+
+    def record_failure(self) -> None:
+        self.consecutive_failures += 1
+        if self.state == self.HALF_OPEN or self.consecutive_failures >= self.failure_threshold:
+            if self.state != self.OPEN:
+                self.stats['opened'] += 1
+                logging.warning(f"Upstream circuit breaker opened after {self.consecutive_failures} failures")
+            self.state = self.OPEN
+            self.opened_at = time.monotonic()
+            self._probe_in_flight = False
+
+    def get_state(self) -> Dict[str, Any]:
+        """Get breaker state for the status endpoint"""
+        return {
+            **self.stats,
+            'state': self.state,
+            'consecutive_failures': self.consecutive_failures,
+            'failure_threshold': self.failure_threshold,
+            'retry_after': self._retry_after() if self.state == self.OPEN else 0
+        }
+
+class ResilientCaller:
+    """Jittered retries, optional p95 hedging and a circuit breaker around upstream calls"""
+
+    LATENCY_WINDOW = 200
+    MIN_HEDGE_SAMPLES = 20
+
+    def __init__(self):
+        self.max_attempts = int(os.getenv('DEEPSEEK_RETRY_ATTEMPTS', 3))
+        self.base_delay = float(os.getenv('DEEPSEEK_RETRY_BASE_DELAY', 0.2))
+        self.max_delay = float(os.getenv('DEEPSEEK_RETRY_MAX_DELAY', 2.0))
+        self.hedge_enabled = os.getenv('DEEPSEEK_HEDGE_ENABLED', 'false').lower() == 'true'
+        self.hedge_default_delay = float(os.getenv('DEEPSEEK_HEDGE_DEFAULT_DELAY', 2.0))
+        self.breaker = CircuitBreaker()
+        self._latencies: deque = deque(maxlen=self.LATENCY_WINDOW)
+        self.stats = {
+            'calls': 0,
+            'retries': 0,
+            'hedges': 0,
+            'hedge_wins': 0
+        }
+
+    def p95_latency(self) -> Optional[float]:
+        if len(self._latencies) < self.MIN_HEDGE_SAMPLES:
+            return None
+        latencies = sorted(self._latencies)
+        return latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+
+    def hedge_delay(self) -> float:
+        """Delay before sending a hedge: the recent p95 latency once enough samples exist"""
+        p95 = self.p95_latency()
+        return p95 if p95 is not None else self.hedge_default_delay
+
+    def _backoff(self, attempt: int, exc: BaseException) -> float:
+        # Honour the upstream's Retry-After when it asks for a short pause
+        if isinstance(exc, httpx.HTTPStatusError):
+            retry_after = exc.response.headers.get("Retry-After")
+            if retry_after and retry_after.isdigit():
+                return min(self.max_delay, float(retry_after))
+        # Full jitter exponential backoff
+        return random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+
+    async def _timed(self, fn: Callable[[], Awaitable[Any]]) -> Any:
+        start = time.monotonic()
+        result = await fn()
+        self._latencies.append(time.monotonic() - start)
+        return result
+
+    async def _hedged(self, fn: Callable[[], Awaitable[Any]]) -> Any:
+        primary = asyncio.ensure_future(self._timed(fn))
+        pending = {primary}
+        try:
+            done, _ = await asyncio.wait(pending, timeout=self.hedge_delay())
+            if not done:
+                self.stats['hedges'] += 1
+                pending.add(asyncio.ensure_future(self._timed(fn)))
+
+            error = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is not primary:
+                            self.stats['hedge_wins'] += 1
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def call(self, fn: Callable[[], Awaitable[Any]], retryable: Callable[[BaseException], bool] = is_retryable) -> Any:
+        """Call fn through the breaker, retrying transient failures with jittered backoff"""
+        self.stats['calls'] += 1
+        for attempt in range(self.max_attempts):
+            self.breaker.before_call()
+            try:
+                if self.hedge_enabled:
+                    result = await self._hedged(fn)
+                else:
+                    result = await self._timed(fn)
+            except Exception as e:
+                if not retryable(e):
+                    raise
+                self.breaker.record_failure()
+                if attempt + 1 >= self.max_attempts:
+                    raise
+                self.stats['retries'] += 1
+                await asyncio.sleep(self._backoff(attempt, e))
+                continue
+            finally:
+                self.breaker.release_probe()
+            self.breaker.record_success()
+            return result
+
+    async def stream(self, fn: Callable[[], AsyncIterator[Any]], retryable: Callable[[BaseException], bool] = is_retryable) -> AsyncIterator[Any]:
+        """Stream through the breaker, retrying only until the first chunk arrives"""
+        self.stats['calls'] += 1
+        for attempt in range(self.max_attempts):
+            self.breaker.before_call()
+            started = False
+            try:
+                async for chunk in fn():
+                    started = True
+                    yield chunk
+            except Exception as e:
+                if not retryable(e):
+                    raise
+                self.breaker.record_failure()
+                if started or attempt + 1 >= self.max_attempts:
+                    raise
+                self.stats['retries'] += 1
+                await asyncio.sleep(self._backoff(attempt, e))
+                continue
+            finally:
+                self.breaker.release_probe()
+            self.breaker.record_success()
+            return
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Get retry/hedge counters and the latency that drives hedging"""
+        return {
+            **self.stats,
+            'hedge_enabled': self.hedge_enabled,
+            'hedge_delay': self.hedge_delay(),
+            'p95_latency': self.p95_latency(),
+            'breaker': self.breaker.get_state()
+        }
+
+# Initialize upstream resilience policy
+deepseek_resilience = ResilientCaller()
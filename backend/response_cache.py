@@ -0,0 +1,172 @@
+from collections import OrderedDict
+from typing import Dict, Any, Optional
+import hashlib
+import json
+import logging
+import os
+import re
+import time
+from dotenv import load_dotenv
+
+load_dotenv()
+
+class ResponseCache:
+    """Two-tier cache for DeepSeek completions: in-process LRU with TTL, backed by Redis"""
+
+    KEY_PREFIX = "response_cache:"
+    # Bumped on every invalidation so other workers drop their local tier; kept outside
+    # KEY_PREFIX so a full invalidation doesn't delete it
+    GENERATION_KEY = "response_cache_generation"
+
+    def __init__(self):
+        self.max_entries = int(os.getenv('RESPONSE_CACHE_SIZE', 1024))
+        self.ttl = int(os.getenv('RESPONSE_CACHE_TTL', 3600))
+        self.enabled = os.getenv('RESPONSE_CACHE_ENABLED', 'true').lower() == 'true'
+        # Fraction of the original token cost charged on a cache hit (0 = free)
+        self.hit_charge_rate = float(os.getenv('RESPONSE_CACHE_HIT_CHARGE_RATE', 0.0))
+        # How often local hits re-read the shared generation, bounding how long another
+        # worker's invalidation can be missed
+        self.generation_check_interval = float(os.getenv('RESPONSE_CACHE_GENERATION_CHECK_MS', 1000)) / 1000
+        self.redis = None
+        self._local: "OrderedDict[str, tuple]" = OrderedDict()
+        self._generation: Optional[str] = None
+        self._generation_checked_at = float("-inf")
+        self.stats = {
+            'local_hits': 0,
+            'redis_hits': 0,
+            'misses': 0,
+            'invalidations': 0,
+            'remote_invalidations': 0
+        }
+
+    @staticmethod
+    def normalize_prompt(prompt: str) -> str:
+        """Normalize a prompt so trivially different phrasings share a key"""
+        return re.sub(r"\s+", " ", prompt).strip().casefold()
+
+    def make_key(self, prompt: str, model: str, temperature: float, tone: str, language: str) -> str:
+        """Build the cache key from the normalized prompt and generation settings"""
+        raw = json.dumps(
+            [self.normalize_prompt(prompt), model, temperature, tone, language],
+            ensure_ascii=False
+        )
+        return self.KEY_PREFIX + hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def _get_local(self, key: str) -> Optional[Dict[str, Any]]:
+        entry = self._local.get(key)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if expires_at < time.monotonic():
+            del self._local[key]
+            return None
+        self._local.move_to_end(key)
+        return value
+
+    def _set_local(self, key: str, value: Dict[str, Any]) -> None:
+        self._local[key] = (time.monotonic() + self.ttl, value)
+        self._local.move_to_end(key)
+        while len(self._local) > self.max_entries:
+            self._local.popitem(last=False)
+
+    async def _sync_generation(self) -> None:
+        """Drop the local tier if another worker invalidated since the last check"""
+        now = time.monotonic()
+        if self.redis is None or now - self._generation_checked_at < self.generation_check_interval:
+            return
+        try:
+            generation = await self.redis.get(self.GENERATION_KEY)
+        except Exception as e:
+            logging.error(f"Response cache generation read error: {str(e)}")
+            return
+        if generation != self._generation:
+            if self._local:
+                self.stats['remote_invalidations'] += 1
+            self._local.clear()
+            self._generation = generation
+        self._generation_checked_at = now
+
+    async def get(self, key: str) -> Optional[Dict[str, Any]]:
+        """Look up a cached response, checking the local tier before Redis"""
+        if not self.enabled:
+            return None
+
+        await self._sync_generation()
+        value = self._get_local(key)
+        if value is not None:
+            self.stats['local_hits'] += 1
+            return value
+
+        if self.redis is not None:
+            try:
+                raw = await self.redis.get(key)
+                if raw:
+                    value = json.loads(raw)
+                    self._set_local(key, value)
+                    self.stats['redis_hits'] += 1
+                    return value
+            except Exception as e:
+                logging.error(f"Response cache read error: {str(e)}")
+
+        self.stats['misses'] += 1
+        return None
+
+    async def set(self, key: str, value: Dict[str, Any]) -> None:
+        """Store a response in both tiers"""
+        if not self.enabled:
+            return
+
+        self._set_local(key, value)
+        if self.redis is not None:
+            try:
+                await self.redis.setex(key, self.ttl, json.dumps(value))
+            except Exception as e:
+                logging.error(f"Response cache write error: {str(e)}")
+
+    async def invalidate(self, key: Optional[str] = None) -> int:
+        """Drop one cached response, or every cached response when no key is given"""
+        if key is not None:
+            removed = 1 if self._local.pop(key, None) is not None else 0
+            if self.redis is not None:
+                removed = max(removed, await self.redis.delete(key))
+        else:
+            removed = len(self._local)
+            self._local.clear()
+            if self.redis is not None:
+                batch = []
+                async for redis_key in self.redis.scan_iter(match=f"{self.KEY_PREFIX}*", count=500):
+                    batch.append(redis_key)
+                    if len(batch) >= 500:
+                        removed += await self.redis.delete(*batch)
+                        batch = []
+                if batch:
+                    removed += await self.redis.delete(*batch)
+
+        if self.redis is not None:
+            # Tell other workers to drop their local copies on their next lookup
+            self._generation = str(await self.redis.incr(self.GENERATION_KEY))
+            self._generation_checked_at = time.monotonic()
+
+        self.stats['invalidations'] += removed
+        return removed
+
+    def billable_tokens(self, tokens: int, cache_hit: bool) -> int:
+        """Tokens to charge the user, discounted when the response came from cache"""
+        if cache_hit:
+            return int(tokens * self.hit_charge_rate)
+        return tokens
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Get hit/miss counters and hit rate"""
+        hits = self.stats['local_hits'] + self.stats['redis_hits']
+        lookups = hits + self.stats['misses']
+        return {
+            **self.stats,
+            'hits': hits,
+            'hit_rate': hits / lookups if lookups else 0.0,
+            'local_entries': len(self._local),
+            'enabled': self.enabled
+        }
+
+# Initialize response cache
+response_cache = ResponseCache()
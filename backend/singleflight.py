@@ -0,0 +1,92 @@
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional
+import asyncio
+
+class _StreamFlight:
+    """Buffered chunks of one in-flight upstream stream, replayable by late joiners"""
+
+    def __init__(self):
+        self.chunks: List[Any] = []
+        self.done = False
+        self.error: Optional[BaseException] = None
+        self.cond = asyncio.Condition()
+
+class SingleFlight:
+    """Coalesce concurrent identical upstream calls into a single in-flight request"""
+
+    def __init__(self):
+        self._calls: Dict[str, asyncio.Future] = {}
+        self._streams: Dict[str, _StreamFlight] = {}
+        self.stats = {
+            'leaders': 0,
+            'joined': 0,
+            'stream_leaders': 0,
+            'stream_joined': 0
+        }
+
+    async def do(self, key: str, fn: Callable[[], Awaitable[Any]]) -> Any:
+        """Run fn once per key; concurrent callers with the same key share its result"""
+        task = self._calls.get(key)
+        if task is None:
+            self.stats['leaders'] += 1
+            task = asyncio.ensure_future(fn())
+            self._calls[key] = task
+            task.add_done_callback(lambda _: self._calls.pop(key, None))
+        else:
+            self.stats['joined'] += 1
+
+        # Shield so one caller disconnecting does not cancel the shared upstream call
+        return await asyncio.shield(task)
+
+    async def stream(self, key: str, fn: Callable[[], AsyncIterator[Any]]) -> AsyncIterator[Any]:
+        """Share one upstream stream per key; joiners replay chunks they missed"""
+        flight = self._streams.get(key)
+        if flight is None:
+            self.stats['stream_leaders'] += 1
+            flight = _StreamFlight()
+            self._streams[key] = flight
+            asyncio.ensure_future(self._pump(key, flight, fn()))
+        else:
+            self.stats['stream_joined'] += 1
+
+        index = 0
+        while True:
+            async with flight.cond:
+                await flight.cond.wait_for(lambda: len(flight.chunks) > index or flight.done)
+                pending = flight.chunks[index:]
+                done = flight.done
+            index += len(pending)
+
+            for chunk in pending:
+                yield chunk
+
+            if done:
+                if flight.error is not None:
+                    raise flight.error
+                return
+
+    async def _pump(self, key: str, flight: _StreamFlight, upstream: AsyncIterator[Any]) -> None:
+        """Drain the upstream iterator into the shared buffer"""
+        try:
+            async for chunk in upstream:
+                async with flight.cond:
+                    flight.chunks.append(chunk)
+                    flight.cond.notify_all()
+        except Exception as e:
+            flight.error = e
+        finally:
+            if self._streams.get(key) is flight:
+                del self._streams[key]
+            async with flight.cond:
+                flight.done = True
+                flight.cond.notify_all()
+
+    def get_stats(self) -> Dict[str, int]:
+        """Get coalescing counters and current in-flight counts"""
+        return {
+            **self.stats,
+            'in_flight': len(self._calls),
+            'streams_in_flight': len(self._streams)
+        }
+
+# Initialize single-flight coalescer
+single_flight = SingleFlight()
@@ -0,0 +1,234 @@
+import asyncio
+import json
+import os
+
+# Run the app against the in-process stub backend and in-memory stores
+os.environ.setdefault("LLM_BACKEND", "stub")
+os.environ.setdefault("TOKEN_STORE", "memory")
+os.environ.setdefault("USAGE_HISTORY_STORE", "memory")
+os.environ.setdefault("USAGE_ROLLUP_STORE", "memory")
+os.environ.setdefault("TOKENIZER_ALLOW_DOWNLOAD", "false")
+
+import pytest
+from fastapi.testclient import TestClient
+from concurrency import ConcurrencyLimitExceeded
+from usage_rollups import InMemoryUsageRollups
+from users import SQLUserRepository
+import main
+
+PROMPTS = ["Explain photosynthesis", "Name three rivers", "Write a haiku about rain"]
+
+@pytest.fixture
+def client(monkeypatch):
+    """Authenticated client with a fresh usage tracker and no Redis-backed dependencies"""
+    async def free_tier(username):
+        return main.UserTier.FREE
+
+    async def authenticated():
+        return {"sub": "alice", "tier": "free"}
+
+    async def current_user(request):
+        return await authenticated()
+
+    tracker = main.TokenTracker(tier_of=free_tier)
+    updates = []
+    add_usage = tracker.add_usage
+
+    async def spy_add_usage(username, tokens_used, tier=None):
+        updates.append((username, tokens_used))
+        return await add_usage(username, tokens_used, tier)
+
+    monkeypatch.setattr(tracker, "add_usage", spy_add_usage)
+    monkeypatch.setattr(main, "token_tracker", tracker)
+    monkeypatch.setattr(main, "get_user_tier", free_tier)
+    monkeypatch.setattr(main, "get_current_user", current_user)
+    monkeypatch.setattr(main.response_cache, "enabled", False)
+
+    overrides = {main.get_user_or_anonymous: authenticated}
+    for route in main.app.routes:
+        # Rate limiters need Redis; they are exercised in the live smoke tests
+        for dependency in getattr(route, "dependencies", []):
+            if isinstance(dependency.dependency, main.RateLimiter):
+                overrides[dependency.dependency] = lambda: None
+    main.app.dependency_overrides.update(overrides)
+    test_client = TestClient(main.app)
+    test_client.updates = updates
+    yield test_client
+    main.app.dependency_overrides.clear()
+
+def batch_body():
+    return {"items": [{"prompt": p, "tokens_needed": 0} for p in PROMPTS]}
+
+def sse_frames(text):
+    """Split an SSE body into (event, data) pairs"""
+    frames = []
+    for block in text.strip().split("\n\n"):
+        event, data = None, None
+        for line in block.splitlines():
+            if line.startswith("event: "):
+                event = line[len("event: "):]
+            elif line.startswith("data: "):
+                data = json.loads(line[len("data: "):])
+        frames.append((event, data))
+    return frames
+
+def test_batch_results_in_request_order(client):
+    """Buffered batches return one result per item, in the order they were sent"""
+    response = client.post("/chat/batch", json=batch_body())
+
+    assert response.status_code == 200
+    body = response.json()
+    assert [r["index"] for r in body["results"]] == [0, 1, 2]
+    assert all(p in r["response"] for p, r in zip(PROMPTS, body["results"]))
+    assert body["tokens_used"] == sum(r["tokens_used"] for r in body["results"]) > 0
+
+def test_batch_charges_usage_once(client):
+    """The whole batch is reserved up front and charged in one aggregated update"""
+    body = client.post("/chat/batch", json=batch_body()).json()
+
+    assert client.updates == [("alice", body["tokens_used"])]
+    stats = main.token_tracker.get_reservation_stats()
+    assert stats["reserved"] == 1 and stats["reconciled"] == 1
+    assert asyncio.run(main.token_tracker.store.get("alice"))["held"] == 0
+
+def test_batch_rejected_without_budget(client):
+    """A batch that can't be covered is refused before any upstream call"""
+    asyncio.run(main.token_tracker.add_usage("alice", 9990))
+    response = client.post("/chat/batch", json=batch_body())
+
+    assert response.status_code == 402
+    assert len(client.updates) == 1
+
+def test_batch_ndjson_framing(client):
+    """NDJSON batches stream one line per item, then a summary line"""
+    response = client.post("/chat/batch?stream=true", json=batch_body())
+
+    assert response.headers["content-type"].startswith("application/x-ndjson")
+    lines = [json.loads(line) for line in response.text.strip().split("\n")]
+    assert sorted(line["index"] for line in lines[:-1]) == [0, 1, 2]
+    assert lines[-1]["done"] is True
+    assert lines[-1]["tokens_used"] == sum(line["tokens_used"] for line in lines[:-1])
+    assert len(client.updates) == 1
+
+def test_chat_stream_ends_with_done(client):
+    """SSE chat streams deltas and finishes with a done frame carrying exact usage"""
+    response = client.post("/chat", json={"message": "Explain photosynthesis", "stream": True})
+
+    assert response.headers["content-type"].startswith("text/event-stream")
+    frames = sse_frames(response.text)
+    assert all(event is None for event, _ in frames)
+    assert "".join(data.get("delta", "") for _, data in frames[:-1]).startswith("Stub answer")
+    assert frames[-1][1]["done"] is True
+    assert frames[-1][1]["tokens_used"] > 0
+
+def test_chat_stream_reports_busy_upstream(client, monkeypatch):
+    """Load shedding mid-request becomes an error frame with a retry hint"""
+    async def busy(*args, **kwargs):
+        raise ConcurrencyLimitExceeded("Upstream queue is full", 3)
+        yield
+
+    monkeypatch.setattr(main, "stream_deepseek_api", busy)
+    response = client.post("/chat", json={"message": "Explain photosynthesis", "stream": True})
+
+    event, data = sse_frames(response.text)[-1]
+    assert event == "error"
+    assert data["retry_after"] == 3
+    assert not any(d.get("done") for _, d in sse_frames(response.text))
+
+def test_chat_stream_charges_exact_usage(client):
+    """Streams charge the upstream's exact usage without counting deltas on the loop"""
+    frames = sse_frames(client.post("/chat", json={"message": "Name three rivers", "stream": True}).text)
+
+    usage = asyncio.run(main.token_tracker.store.get("alice"))
+    assert usage["daily_used"] == frames[-1][1]["tokens_used"]
+
+def test_concurrent_reserves_never_overshoot(client):
+    """Every grant is held in full, so granted budgets never add up past the limit"""
+    tracker = main.token_tracker
+
+    async def scenario():
+        await tracker.add_usage("alice", 8000)
+        grants = []
+        for _ in range(3):
+            try:
+                grants.append(await tracker.reserve("alice", main.UserTier.FREE, 100, 32, 8192))
+            except main.HTTPException:
+                grants.append(None)
+        return grants
+
+    grants = asyncio.run(scenario())
+    granted = [budget + 100 for _, budget in filter(None, grants)]
+    assert sum(granted) <= 2000
+    assert grants[-1] is None
+
+def test_reconcile_replaces_hold_with_usage(client):
+    tracker = main.token_tracker
+
+    async def scenario():
+        reservation_id, _ = await tracker.reserve("alice", main.UserTier.FREE, 100, 32, 500)
+        held = (await tracker.store.get("alice"))["held"]
+        await tracker.reconcile("alice", reservation_id, 250)
+        await tracker.release("alice", reservation_id)
+        return held, await tracker.store.get("alice")
+
+    held, after = asyncio.run(scenario())
+    assert held == 600
+    assert after["held"] == 0 and after["daily_used"] == 250
+    assert tracker.get_reservation_stats()["released"] == 0
+
+def test_stream_releases_hold_when_closed_early(client):
+    """A client that disconnects mid-stream doesn't leave its reservation behind"""
+    tracker = main.token_tracker
+
+    async def scenario():
+        reservation_id, budget = await tracker.reserve("alice", main.UserTier.FREE, 10, 32, 500)
+        stream = main.process_chat_message_stream(
+            "Explain photosynthesis", "alice", max_tokens=budget, reservation_id=reservation_id
+        )
+        await stream.__anext__()
+        await stream.aclose()
+        return await tracker.store.get("alice")
+
+    assert asyncio.run(scenario())["held"] == 0
+    assert main.token_tracker.get_reservation_stats()["released"] == 1
+
+def test_ndjson_batch_charges_delivered_items_when_closed_early(client):
+    """A client that disconnects before the summary still pays for the answers it received"""
+    tracker = main.token_tracker
+
+    async def scenario():
+        response = await main.chat_batch(
+            main.Request({"type": "http", "query_string": b"stream=true", "headers": []}),
+            main.BatchChatRequest(**batch_body()),
+            {"sub": "alice", "tier": "free"}
+        )
+        stream = response.body_iterator
+        delivered = [json.loads(await stream.__anext__()) for _ in PROMPTS]
+        await stream.aclose()
+        return delivered, await tracker.store.get("alice")
+
+    delivered, usage = asyncio.run(scenario())
+    assert usage["daily_used"] == sum(item["tokens_used"] for item in delivered) > 0
+    assert usage["held"] == 0
+    stats = tracker.get_reservation_stats()
+    assert stats["reconciled"] == 1 and stats["released"] == 0
+
+def test_usage_history_total_covers_every_page(client, tmp_path, monkeypatch):
+    """total_used comes from the rollups, not from the page that was returned"""
+    repository = SQLUserRepository(f"sqlite+aiosqlite:///{tmp_path / 'users.db'}")
+
+    async def create_user():
+        await repository.init()
+        await repository.create("bob", hashed_password="x")
+
+    asyncio.run(create_user())
+    monkeypatch.setattr(main, "user_repository", repository)
+    monkeypatch.setattr(main.token_tracker, "rollups", InMemoryUsageRollups({"hour": 24, "day": 7}))
+    for tokens in (10, 20, 30):
+        client.post("/track-usage", json={"user_id": "bob", "tokens_used": tokens, "operation": "chat"})
+
+    body = client.get("/usage-history/bob", params={"limit": 1}).json()
+    assert [e["tokens_used"] for e in body["history"]] == [30]
+    assert body["total_used"] == 60
+    assert body["next_cursor"] is not None
+    asyncio.run(repository.aclose())
@@ -0,0 +1,122 @@
+import asyncio
+import httpx
+import pytest
+from concurrency import AdaptiveConcurrencyLimiter, ConcurrencyLimitExceeded
+
+@pytest.fixture
+def limiter():
+    """Small limiter so queueing and rejection are easy to trigger"""
+    limiter = AdaptiveConcurrencyLimiter()
+    limiter.limit = 2
+    limiter.min_limit = 1
+    limiter.max_limit = 10
+    limiter.max_queue = 2
+    limiter.queue_timeout = 0.5
+    return limiter
+
+def overload_error():
+    request = httpx.Request("POST", "https://api.deepseek.com/v1/chat/completions")
+    response = httpx.Response(429, request=request)
+    return httpx.HTTPStatusError("Too Many Requests", request=request, response=response)
+
+def test_limits_in_flight_calls(limiter):
+    """No more than `limit` calls run at once; the rest queue"""
+    peak = []
+
+    async def call():
+        async with limiter.acquire():
+            peak.append(limiter.in_flight)
+            await asyncio.sleep(0.02)
+
+    async def run():
+        await asyncio.gather(*(call() for _ in range(4)))
+
+    asyncio.run(run())
+    assert max(peak) <= 2
+    assert limiter.in_flight == 0
+    assert limiter.get_stats()["queued"] == 2
+
+def test_rejects_when_queue_full(limiter):
+    """Calls beyond the queue capacity are rejected immediately"""
+    async def call():
+        async with limiter.acquire():
+            await asyncio.sleep(0.05)
+
+    async def run():
+        return await asyncio.gather(*(call() for _ in range(5)), return_exceptions=True)
+
+    results = asyncio.run(run())
+    rejected = [r for r in results if isinstance(r, ConcurrencyLimitExceeded)]
+    assert len(rejected) == 1
+    assert rejected[0].retry_after >= 1
+
+def test_rejects_after_queue_timeout(limiter):
+    """Queued calls give up after queue_timeout"""
+    limiter.queue_timeout = 0.01
+
+    async def call():
+        async with limiter.acquire():
+            await asyncio.sleep(0.05)
+
+    async def run():
+        return await asyncio.gather(*(call() for _ in range(3)), return_exceptions=True)
+
+    results = asyncio.run(run())
+    assert sum(isinstance(r, ConcurrencyLimitExceeded) for r in results) == 1
+    assert limiter.get_stats()["rejected_queue_timeout"] == 1
+    assert limiter.in_flight == 0
+
+def test_aimd_adjusts_limit(limiter):
+    """Successes grow the limit additively, overloads shrink it multiplicatively"""
+    async def succeed():
+        async with limiter.acquire():
+            pass
+
+    async def overload():
+        async with limiter.acquire():
+            raise overload_error()
+
+    asyncio.run(succeed())
+    assert limiter.limit == pytest.approx(2.5)
+
+    with pytest.raises(httpx.HTTPStatusError):
+        asyncio.run(overload())
+    assert limiter.limit == pytest.approx(2.5 * limiter.backoff_ratio)
+
+def test_non_overload_errors_are_neutral(limiter):
+    """Client errors neither grow nor shrink the limit"""
+    async def fail():
+        async with limiter.acquire():
+            raise ValueError("bad request")
+
+    with pytest.raises(ValueError):
+        asyncio.run(fail())
+    assert limiter.limit == 2
+    assert limiter.in_flight == 0
+
+def test_long_successful_calls_grow_limit(limiter):
+    """A slow but healthy completion is not mistaken for congestion"""
+    limiter.target_latency = 0.01
+
+    async def long_stream():
+        async with limiter.acquire() as slot:
+            slot.mark_first_chunk()
+            await asyncio.sleep(0.03)
+
+    for _ in range(3):
+        asyncio.run(long_stream())
+    assert limiter.limit > 2
+    assert limiter.get_stats()["overloads"] == 0
+
+def test_slow_first_chunk_shrinks_limit(limiter):
+    """Waiting too long for the first streamed chunk counts as an overload"""
+    limiter.target_latency = 0.01
+
+    async def slow_start():
+        async with limiter.acquire() as slot:
+            await asyncio.sleep(0.03)
+            slot.mark_first_chunk()
+
+    asyncio.run(slow_start())
+    assert limiter.limit == pytest.approx(2 * limiter.backoff_ratio)
+    assert limiter.get_stats()["slow_first_chunks"] == 1
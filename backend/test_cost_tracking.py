@@ -0,0 +1,56 @@
+import pytest
+from cost_tracking import CostTracker
+
+USAGE = {
+    "prompt_tokens": 200,
+    "prompt_cache_hit_tokens": 128,
+    "prompt_cache_miss_tokens": 72,
+    "completion_tokens": 50,
+    "total_tokens": 250
+}
+
+@pytest.fixture
+def tracker():
+    """Cost tracker with fixed daytime pricing and a large budget"""
+    tracker = CostTracker()
+    tracker.budget = 100.0
+    tracker._get_pricing = lambda: {
+        'input_cache_hit': 0.07,
+        'input_cache_miss': 0.27,
+        'output': 1.10
+    }
+    return tracker
+
+def test_track_api_usage_bills_cache_hits_separately(tracker):
+    """Context-cache hit and miss tokens are billed at their own rates"""
+    tracker.track_api_usage(USAGE)
+
+    expected = (128 * 0.07 + 72 * 0.27 + 50 * 1.10) / 1000000
+    assert tracker.total_cost == pytest.approx(expected)
+    assert tracker.usage['input_cache_hit_tokens'] == 128
+    assert tracker.usage['input_cache_miss_tokens'] == 72
+    assert tracker.usage['cache_hits'] == 1
+
+def test_track_api_usage_without_cache_fields(tracker):
+    """Usage blocks without cache fields are billed as misses"""
+    tracker.track_api_usage({"prompt_tokens": 100, "completion_tokens": 10})
+
+    assert tracker.usage['input_cache_miss_tokens'] == 100
+    assert tracker.usage['cache_misses'] == 1
+
+def test_context_cache_stats(tracker):
+    """Stats report the token hit rate and estimated savings"""
+    tracker.track_api_usage(USAGE)
+    stats = tracker.get_context_cache_stats()
+
+    assert stats['token_hit_rate'] == pytest.approx(0.64)
+    assert stats['estimated_savings'] == pytest.approx((0.27 - 0.07) * 128 / 1000000)
+
+def test_track_api_usage_never_raises_over_budget(tracker):
+    """Spend past the budget is recorded and reported, not raised into the request"""
+    tracker.budget = 0.0001
+    for _ in range(3):
+        tracker.track_api_usage(USAGE)
+
+    assert tracker.usage['cache_hits'] == 3
+    assert tracker.get_context_cache_stats()['over_budget'] is True
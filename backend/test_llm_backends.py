@@ -0,0 +1,53 @@
+import asyncio
+import pytest
+from llm_backends import LLMBackend, StubBackend, create_backend
+
+MESSAGES = [
+    {"role": "system", "content": "You are a math tutor"},
+    {"role": "user", "content": "Solve x + 1 = 3"}
+]
+
+def test_stub_complete_is_deterministic():
+    """The stub returns the same answer and usage for the same prompt"""
+    backend = StubBackend()
+    first = asyncio.run(backend.complete(MESSAGES, "deepseek-chat", 0.7))
+    second = asyncio.run(backend.complete(MESSAGES, "deepseek-chat", 0.7))
+    assert first == second
+    assert first["choices"][0]["message"]["content"]
+    assert first["usage"]["total_tokens"] == first["usage"]["prompt_tokens"] + first["usage"]["completion_tokens"]
+    assert backend.requests == 2
+
+def test_stub_stream_matches_complete():
+    """Streamed deltas join to the full answer and the last chunk carries usage"""
+    backend = StubBackend()
+
+    async def consume():
+        return [chunk async for chunk in backend.stream(MESSAGES, "deepseek-chat", 0.7)]
+
+    chunks = asyncio.run(consume())
+    text = "".join(c["choices"][0]["delta"]["content"] for c in chunks if c["choices"])
+    completion = asyncio.run(backend.complete(MESSAGES, "deepseek-chat", 0.7))
+    assert text == completion["choices"][0]["message"]["content"]
+    assert chunks[-1]["usage"] == completion["usage"]
+
+def test_stub_honours_max_tokens():
+    """max_tokens truncates the stub answer"""
+    completion = asyncio.run(StubBackend().complete(MESSAGES, "deepseek-chat", 0.7, max_tokens=3))
+    assert completion["usage"]["completion_tokens"] == 3
+    assert completion["choices"][0]["finish_reason"] == "length"
+
+def test_create_backend_by_name(monkeypatch):
+    """LLM_BACKEND selects the backend and unknown names are rejected"""
+    monkeypatch.setenv("LLM_BACKEND", "stub")
+    assert create_backend().name == "stub"
+    with pytest.raises(ValueError):
+        create_backend("nope")
+
+def test_incomplete_backend_fails_at_creation():
+    """A backend missing stream() is rejected when built, not on its first request"""
+    class CompleteOnly(LLMBackend):
+        async def complete(self, messages, model, temperature, max_tokens=None):
+            return {}
+
+    with pytest.raises(TypeError):
+        CompleteOnly()
@@ -0,0 +1,100 @@
+import asyncio
+import threading
+import time
+import pytest
+from math_solver import LocalMathSolver
+
+@pytest.fixture
+def solver():
+    """Fresh solver with a generous timeout for cold sympy caches"""
+    solver = LocalMathSolver()
+    solver.enabled = True
+    solver.timeout = 5.0
+    return solver
+
+@pytest.mark.parametrize("prompt, expected", [
+    ("What is 2 + 3*4?", "2 + 3*4 = 14"),
+    ("1/3 + 1/6", "1/3 + 1/6 = 1/2 ≈ 0.5"),
+    ("solve 2x + 3 = 7", "Solving 2*x + 3 = 7: x = 2"),
+    ("x^2 - 4 = 0", "Solving x^2 - 4 = 0: x = -2 or x = 2"),
+    ("derivative of x^3 + 2x", "d/dx (x^3 + 2*x) = 3*x^2 + 2"),
+    ("differentiate y^2 with respect to y", "d/dy (y^2) = 2*y"),
+    ("sin(pi/6)", "sin(pi/6) = 1/2 ≈ 0.5"),
+    ("derivative of sin(2x)", "d/dx (sin(2*x)) = 2*cos(2*x)"),
+    ("2 x + 3 = 7", "Solving 2*x + 3 = 7: x = 2"),
+])
+def test_solves_simple_problems(solver, prompt, expected):
+    """Arithmetic, low-degree equations and derivatives are answered locally"""
+    assert solver.solve(prompt) == expected
+
+@pytest.mark.parametrize("prompt", [
+    "What is the capital of France?",
+    "Explain the quadratic formula",
+    "__import__('os').system('ls')",
+    "9^9^9",
+    "(((9^999)^999)^999)",
+    "1/0",
+    "x^5 + x - 1 = 0",
+    "What is 10!",
+    "3!",
+    "2^3!",
+    "e^1000",
+    "exp(800)",
+    "10^-1000",
+    "(x+1)^999 = 0",
+    "(x+1)^999*(x+2)^999 = 0",
+    "sin(30)",
+    "cos 60",
+    "log(100)",
+    "log(2 * 50)",
+    "x/0 = 1",
+    "1/(x - x) = 2",
+    "2 3",
+    "x = 1 2",
+])
+def test_falls_through(solver, prompt):
+    """Prose, unsafe input and out-of-scope problems are left to the LLM"""
+    assert solver.solve(prompt) is None
+
+def test_absorbed_fraction(solver):
+    """Stats report the share of traffic answered locally"""
+    asyncio.run(solver.try_solve("2 + 2"))
+    asyncio.run(solver.try_solve("Tell me a story"))
+
+    stats = solver.get_stats()
+    assert stats["attempts"] == 2
+    assert stats["solved"] == 1
+    assert stats["fell_through"] == 1
+    assert stats["absorbed_fraction"] == 0.5
+
+def test_high_degree_rejected_before_expansion(solver):
+    """Huge degrees are refused from the unexpanded tree instead of stalling sympy"""
+    start = time.perf_counter()
+    assert solver.solve("(x+1)^999*(x+2)^999 = 0") is None
+    assert time.perf_counter() - start < 1
+
+def test_stuck_solves_stay_in_own_pool(monkeypatch):
+    """Abandoned solves hold only the solver's workers; later prompts fall through at once"""
+    monkeypatch.setenv("LOCAL_SOLVER_WORKERS", "1")
+    solver = LocalMathSolver()
+    solver.enabled = True
+    solver.timeout = 0.05
+    release = threading.Event()
+    monkeypatch.setattr(solver, "solve", lambda prompt: release.wait() and None)
+
+    async def scenario():
+        first = await solver.try_solve("2 + 2")
+        second = await solver.try_solve("2 + 2")
+        return first, second
+
+    assert asyncio.run(scenario()) == (None, None)
+    release.set()
+    stats = solver.get_stats()
+    assert stats["timeouts"] == 1
+    assert stats["saturated"] == 1
+
+def test_disabled_solver_skips(solver):
+    """A disabled solver never answers"""
+    solver.enabled = False
+    assert asyncio.run(solver.try_solve("2 + 2")) is None
+    assert solver.get_stats()["attempts"] == 0
@@ -0,0 +1,141 @@
+import asyncio
+import hashlib
+import pytest
+from conftest import make_fake_redis
+from quota import AnonymousQuota, CHECK_AND_DECREMENT_LUA
+
+def run_with_tokens(quotas, scenario):
+    """Run a scenario in one event loop against the real scripts, seeded with token quotas"""
+    client = make_fake_redis()
+
+    async def wrapped():
+        for token, quota in quotas.items():
+            await client.hset(f"anonymous:{token}", "quota_remaining", quota)
+        return await scenario(client)
+
+    return asyncio.run(wrapped())
+
+@pytest.fixture
+def quota():
+    return AnonymousQuota()
+
+def test_consumes_weighted_cost(quota):
+    """One call checks and decrements by the requested cost"""
+    async def scenario(client):
+        await quota.load(client)
+        return await quota.consume(client, "t", 3)
+
+    assert run_with_tokens({"t": 10}, scenario) == (AnonymousQuota.CONSUMED, 7)
+    assert quota.get_stats()["units_consumed"] == 3
+
+def test_rejects_when_cost_exceeds_quota(quota):
+    """Nothing is spent when the remaining quota can't cover the cost"""
+    async def scenario(client):
+        return await quota.consume(client, "t", 3), await client.hget("anonymous:t", "quota_remaining")
+
+    assert run_with_tokens({"t": 2}, scenario) == ((AnonymousQuota.EXCEEDED, 2), "2")
+
+def test_zero_cost_checks_without_spending(quota):
+    async def scenario(client):
+        return await quota.consume(client, "t", 0), await quota.consume(client, "empty", 0)
+
+    full, empty = run_with_tokens({"t": 5, "empty": 0}, scenario)
+    assert full == (AnonymousQuota.CONSUMED, 5)
+    assert empty[0] == AnonymousQuota.EXCEEDED
+
+def test_unknown_token_is_invalid(quota):
+    async def scenario(client):
+        return await quota.consume(client, "missing")
+
+    assert run_with_tokens({}, scenario)[0] == AnonymousQuota.INVALID
+
+def test_reloads_script_after_redis_restart(quota):
+    """A NOSCRIPT error reloads the script once and retries by SHA"""
+    async def scenario(client):
+        await quota.load(client)
+        await client.script_flush()
+        return await quota.consume(client, "t")
+
+    assert run_with_tokens({"t": 5}, scenario) == (AnonymousQuota.CONSUMED, 4)
+    assert quota.get_stats()["script_loads"] == 2
+
+def test_sha_matches_script(quota):
+    """The SHA used for EVALSHA is the script's SHA1"""
+    run_with_tokens({}, quota.load)
+    assert quota.sha == hashlib.sha1(CHECK_AND_DECREMENT_LUA.encode()).hexdigest()
+
+def test_cost_for_tokens(quota):
+    quota.tokens_per_unit = 100
+    assert quota.cost_for_tokens(0) == 1
+    assert quota.cost_for_tokens(100) == 1
+    assert quota.cost_for_tokens(101) == 2
+
+def test_issue_creates_token_and_counts(quota):
+    """Issuing creates the quota hash and bumps the daily counter in one script"""
+    client = make_fake_redis()
+
+    async def scenario():
+        token, count = await quota.issue(client)
+        stored = await client.hgetall(f"anonymous:{token['token']}")
+        ttl = await client.ttl(f"anonymous:{token['token']}")
+        return token, count, stored, ttl, await quota.consume(client, token["token"], 10)
+
+    token, count, stored, ttl, consumed = asyncio.run(scenario())
+    assert count == 1
+    assert stored["quota_remaining"] == str(quota.initial_quota)
+    assert 0 < ttl <= 86400
+    assert consumed == (AnonymousQuota.CONSUMED, quota.initial_quota - 10)
+
+def test_issue_stops_at_daily_limit(quota):
+    """Tokens past the daily limit are refused without creating anything"""
+    client = make_fake_redis()
+    quota.daily_token_limit = 2
+
+    async def scenario():
+        results = [await quota.issue(client) for _ in range(3)]
+        return results, len(await client.keys("anonymous:*"))
+
+    results, stored = asyncio.run(scenario())
+    assert [token is not None for token, _ in results] == [True, True, False]
+    assert results[-1][1] == 2
+    assert stored == 2
+    assert quota.get_stats()["issue_rejected"] == 1
+
+def test_ip_reservations_never_overshoot(quota):
+    """Concurrent holds share the daily allowance instead of all passing a stale check"""
+    client = make_fake_redis()
+    quota.ip_daily_limit = 1000
+
+    async def scenario():
+        holds = await asyncio.gather(*(
+            quota.reserve_ip_tokens(client, "1.2.3.4", 100, 400) for _ in range(4)
+        ))
+        return [granted for granted, _, _ in holds]
+
+    granted = asyncio.run(scenario())
+    assert sorted(granted) == [0, 200, 400, 400]
+    assert quota.get_stats()["ip_rejected"] == 1
+
+def test_ip_settle_replaces_hold_with_spend(quota):
+    client = make_fake_redis()
+
+    async def scenario():
+        granted, _, key = await quota.reserve_ip_tokens(client, "1.2.3.4", 10, 500)
+        return await quota.settle_ip_tokens(client, key, granted, 120)
+
+    assert asyncio.run(scenario()) == 120
+
+def test_ip_settle_after_midnight_lands_on_reserved_day(quota, monkeypatch):
+    """A request that crosses midnight settles yesterday's hold, not a fresh key for today"""
+    client = make_fake_redis()
+
+    async def scenario():
+        granted, _, key = await quota.reserve_ip_tokens(client, "1.2.3.4", 10, 500)
+        monkeypatch.setattr(quota, "_ip_key", lambda ip: f"anon_usage:tomorrow:{ip}")
+        usage = await quota.settle_ip_tokens(client, key, granted, 120)
+        return usage, await client.ttl(key), await client.exists("anon_usage:tomorrow:1.2.3.4")
+
+    usage, ttl, tomorrow = asyncio.run(scenario())
+    assert usage == 120
+    assert ttl > 0
+    assert tomorrow == 0
@@ -0,0 +1,49 @@
+import asyncio
+import fakeredis
+import pytest
+import redis.asyncio as aioredis
+from redis.exceptions import ConnectionError
+from redis_pool import InstrumentedConnectionPool
+
+def make_pool(max_connections=2, timeout=0.05):
+    return InstrumentedConnectionPool(
+        connection_class=fakeredis.aioredis.FakeConnection,
+        server=fakeredis.FakeServer(),
+        max_connections=max_connections,
+        timeout=timeout,
+        decode_responses=True
+    )
+
+def test_requests_reuse_pooled_connections():
+    """Many sequential commands share one connection instead of opening new ones"""
+    pool = make_pool()
+
+    async def scenario():
+        client = aioredis.Redis(connection_pool=pool)
+        for i in range(20):
+            await client.set(f"k{i}", i)
+        return await client.get("k19")
+
+    assert asyncio.run(scenario()) == "19"
+    stats = pool.get_stats()
+    assert stats["checkouts"] == 21
+    assert stats["created_connections"] == 1
+    assert stats["in_use_connections"] == 0
+
+def test_exhausted_pool_times_out():
+    """With every connection checked out, callers wait then fail instead of opening more"""
+    pool = make_pool(max_connections=1)
+
+    async def scenario():
+        held = await pool.get_connection("PING")
+        with pytest.raises(ConnectionError):
+            await pool.get_connection("PING")
+        in_use = pool.get_stats()["in_use_connections"]
+        await pool.release(held)
+        return in_use
+
+    assert asyncio.run(scenario()) == 1
+    stats = pool.get_stats()
+    assert stats["checkout_errors"] == 1
+    assert stats["in_use_connections"] == 0
+    assert stats["created_connections"] == 1
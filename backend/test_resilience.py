@@ -0,0 +1,114 @@
+import asyncio
+import httpx
+import pytest
+from resilience import ResilientCaller, CircuitBreaker, CircuitOpenError
+
+STUB_URL = "http://stub.local/v1/chat/completions"
+COMPLETION = {"choices": [{"message": {"content": "4"}}], "usage": {"total_tokens": 3}}
+
+class StubUpstream:
+    """In-process stand-in for the DeepSeek server replaying scripted responses"""
+
+    def __init__(self, *responses, delay: float = 0.0):
+        self.responses = list(responses)
+        self.delay = delay
+        self.requests = 0
+
+    async def handler(self, request: httpx.Request) -> httpx.Response:
+        self.requests += 1
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        status_code = self.responses.pop(0) if len(self.responses) > 1 else self.responses[0]
+        if status_code == "timeout":
+            raise httpx.ReadTimeout("stub timeout", request=request)
+        return httpx.Response(status_code, json=COMPLETION, request=request)
+
+    def call(self):
+        async def attempt():
+            async with httpx.AsyncClient(transport=httpx.MockTransport(self.handler)) as client:
+                response = await client.post(STUB_URL, json={})
+                response.raise_for_status()
+                return response.json()
+        return attempt
+
+@pytest.fixture
+def caller():
+    """Caller with fast backoff and a low breaker threshold"""
+    caller = ResilientCaller()
+    caller.max_attempts = 3
+    caller.base_delay = 0.001
+    caller.max_delay = 0.01
+    caller.hedge_enabled = False
+    caller.breaker.failure_threshold = 3
+    caller.breaker.recovery_timeout = 60
+    return caller
+
+def test_retries_transient_failures(caller):
+    """5xx and timeouts are retried until the upstream succeeds"""
+    stub = StubUpstream(503, "timeout", 200)
+    assert asyncio.run(caller.call(stub.call())) == COMPLETION
+    assert stub.requests == 3
+    assert caller.get_stats()["retries"] == 2
+    assert caller.breaker.state == CircuitBreaker.CLOSED
+
+def test_does_not_retry_client_errors(caller):
+    """4xx responses fail immediately without touching the breaker"""
+    stub = StubUpstream(400)
+    with pytest.raises(httpx.HTTPStatusError):
+        asyncio.run(caller.call(stub.call()))
+    assert stub.requests == 1
+    assert caller.breaker.consecutive_failures == 0
+
+def test_breaker_opens_and_fails_fast(caller):
+    """Consecutive failures open the breaker, which then rejects without calling upstream"""
+    stub = StubUpstream(500)
+    with pytest.raises(httpx.HTTPStatusError):
+        asyncio.run(caller.call(stub.call()))
+    assert caller.breaker.state == CircuitBreaker.OPEN
+
+    with pytest.raises(CircuitOpenError) as exc_info:
+        asyncio.run(caller.call(stub.call()))
+    assert exc_info.value.retry_after > 0
+    assert stub.requests == 3
+
+def test_breaker_half_open_probe_closes(caller):
+    """After the recovery timeout a successful probe closes the breaker"""
+    asyncio.run(caller.call(StubUpstream(200).call()))
+    caller.breaker.state = CircuitBreaker.OPEN
+    caller.breaker.opened_at = 0
+    caller.breaker.recovery_timeout = 0
+
+    asyncio.run(caller.call(StubUpstream(200).call()))
+    assert caller.breaker.get_state()["state"] == CircuitBreaker.CLOSED
+
+def test_hedge_wins_over_slow_primary(caller):
+    """A hedged request is sent after the hedge delay and the faster one wins"""
+    caller.hedge_enabled = True
+    caller.hedge_default_delay = 0.01
+    delays = [0.5, 0.0]
+
+    async def attempt():
+        await asyncio.sleep(delays.pop(0))
+        return COMPLETION
+
+    assert asyncio.run(caller.call(attempt)) == COMPLETION
+    stats = caller.get_stats()
+    assert stats["hedges"] == 1
+    assert stats["hedge_wins"] == 1
+
+def test_stream_retries_before_first_chunk(caller):
+    """Streams are retried only if nothing was yielded yet"""
+    attempts = []
+
+    async def upstream():
+        attempts.append(1)
+        if len(attempts) == 1:
+            raise httpx.ConnectError("refused")
+        for chunk in ("a", "b"):
+            yield chunk
+
+    async def consume():
+        return [chunk async for chunk in caller.stream(upstream)]
+
+    assert asyncio.run(consume()) == ["a", "b"]
+    assert len(attempts) == 2
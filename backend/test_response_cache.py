@@ -0,0 +1,94 @@
+import asyncio
+import pytest
+from conftest import make_fake_redis
+from response_cache import ResponseCache
+
+MODEL = "deepseek-chat"
+RESPONSE = {
+    "choices": [{"message": {"content": "x = 2"}}],
+    "usage": {"prompt_tokens": 10, "completion_tokens": 5, "total_tokens": 15}
+}
+
+@pytest.fixture
+def cache():
+    """Fresh in-process cache without a Redis tier"""
+    cache = ResponseCache()
+    cache.enabled = True
+    cache.ttl = 60
+    cache.max_entries = 2
+    cache.hit_charge_rate = 0.0
+    return cache
+
+def test_key_normalizes_prompt(cache):
+    """Whitespace and case differences share a key, settings do not"""
+    key = cache.make_key("Solve  2x = 4 ", MODEL, 0.7, "friendly", "en")
+    assert key == cache.make_key("solve 2x = 4", MODEL, 0.7, "friendly", "en")
+    assert key != cache.make_key("solve 2x = 4", MODEL, 0.7, "formal", "en")
+    assert key != cache.make_key("solve 2x = 4", MODEL, 0.2, "friendly", "en")
+
+def test_hit_and_miss_counters(cache):
+    """Lookups are counted as hits or misses"""
+    key = cache.make_key("solve 2x = 4", MODEL, 0.7, "friendly", "en")
+
+    assert asyncio.run(cache.get(key)) is None
+    asyncio.run(cache.set(key, RESPONSE))
+    assert asyncio.run(cache.get(key)) == RESPONSE
+
+    stats = cache.get_stats()
+    assert stats["misses"] == 1
+    assert stats["local_hits"] == 1
+    assert stats["hit_rate"] == 0.5
+
+def test_lru_eviction(cache):
+    """Least recently used entries are evicted past max_entries"""
+    asyncio.run(cache.set("a", RESPONSE))
+    asyncio.run(cache.set("b", RESPONSE))
+    asyncio.run(cache.get("a"))
+    asyncio.run(cache.set("c", RESPONSE))
+
+    assert asyncio.run(cache.get("b")) is None
+    assert asyncio.run(cache.get("a")) == RESPONSE
+
+def test_ttl_expiry(cache):
+    """Expired entries are treated as misses"""
+    cache.ttl = -1
+    asyncio.run(cache.set("a", RESPONSE))
+    assert asyncio.run(cache.get("a")) is None
+
+def test_invalidate(cache):
+    """Invalidation drops one key or the whole cache"""
+    asyncio.run(cache.set("a", RESPONSE))
+    asyncio.run(cache.set("b", RESPONSE))
+
+    assert asyncio.run(cache.invalidate("a")) == 1
+    assert asyncio.run(cache.get("a")) is None
+    assert asyncio.run(cache.invalidate()) == 1
+    assert cache.get_stats()["local_entries"] == 0
+
+def test_billable_tokens(cache):
+    """Cache hits are free by default and discounted when configured"""
+    assert cache.billable_tokens(100, cache_hit=False) == 100
+    assert cache.billable_tokens(100, cache_hit=True) == 0
+
+    cache.hit_charge_rate = 0.25
+    assert cache.billable_tokens(100, cache_hit=True) == 25
+
+def test_invalidation_reaches_other_workers():
+    """Local copies in other workers are dropped once the shared generation moves"""
+    client = make_fake_redis()
+    workers = [ResponseCache(), ResponseCache()]
+    for worker in workers:
+        worker.enabled = True
+        worker.generation_check_interval = 0
+        worker.redis = client
+
+    async def scenario():
+        await workers[0].set("response_cache:a", RESPONSE)
+        warmed = await workers[1].get("response_cache:a")
+        await workers[0].invalidate()
+        return warmed, await workers[1].get("response_cache:a")
+
+    warmed, after = asyncio.run(scenario())
+    assert warmed == RESPONSE
+    assert after is None
+    assert workers[1].get_stats()["remote_invalidations"] == 1
@@ -1,20 +1,21 @@
 from fastapi import FastAPI, Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 from fastapi.testclient import TestClient
+import asyncio
 import pytest
 from datetime import timedelta
+import main
 from main import (
     app, 
     authenticate_user, 
     create_access_token, 
     ACCESS_TOKEN_EXPIRE_MINUTES, 
-    users_db, 
     pwd_context,
     UserCreate,  
-    UserInDB, 
-    call_deepseek_api,
-    cost_tracker
+    call_deepseek_api
 )
+from cost_tracking import cost_tracker
+from users import SQLUserRepository
 
 app = FastAPI()
 
@@ -29,7 +30,7 @@ async def protected_endpoint(token: str = Depends(oauth2_scheme)):
 # Define token endpoint
 @app.post("/auth/token")
 async def login(form_data: OAuth2PasswordRequestForm = Depends()):
-    user = authenticate_user(form_data.username, form_data.password)
+    user = await authenticate_user(form_data.username, form_data.password)
     if not user:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -56,17 +57,19 @@ CHAT_REQUEST = {
 
 # Test fixture for setting up test user
 @pytest.fixture(autouse=True)
-def setup_test_user():
-    """Setup test user before each test"""
-    # Clear existing users
-    users_db.clear()
-    
-    # Create test user
-    hashed_password = pwd_context.hash(TEST_USER["password"])
-    users_db[TEST_USER["username"]] = {
-        "username": TEST_USER["username"],
-        "hashed_password": hashed_password
-    }
+def setup_test_user(tmp_path, monkeypatch):
+    """Setup test user in a fresh repository before each test"""
+    repository = SQLUserRepository(f"sqlite+aiosqlite:///{tmp_path / 'users.db'}")
+
+    async def create_test_user():
+        await repository.init()
+        await repository.create(
+            TEST_USER["username"],
+            hashed_password=pwd_context.hash(TEST_USER["password"])
+        )
+
+    asyncio.run(create_test_user())
+    monkeypatch.setattr(main, "user_repository", repository)
     
     # Reset cost tracker
     cost_tracker.reset()
@@ -74,7 +77,7 @@ def setup_test_user():
     yield
     
     # Cleanup
-    users_db.clear()
+    asyncio.run(repository.aclose())
     cost_tracker.reset()
 
 # Helper function to get token
@@ -121,13 +124,13 @@ def test_invalid_credentials():
 # User authentication tests
 def test_authenticate_user_valid():
     """Test successful user authentication"""
-    user = authenticate_user(TEST_USER["username"], TEST_USER["password"])
+    user = asyncio.run(authenticate_user(TEST_USER["username"], TEST_USER["password"]))
     assert user is not None
     assert user.username == TEST_USER["username"]
 
 def test_authenticate_user_invalid():
     """Test failed user authentication"""
-    user = authenticate_user(INVALID_USER["username"], INVALID_USER["password"])
+    user = asyncio.run(authenticate_user(INVALID_USER["username"], INVALID_USER["password"]))
     assert user is None
 
 # Protected endpoint tests
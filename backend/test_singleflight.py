@@ -0,0 +1,81 @@
+import asyncio
+import pytest
+from singleflight import SingleFlight
+
+def test_concurrent_calls_share_one_upstream():
+    """Concurrent calls with the same key run the upstream once"""
+    flight = SingleFlight()
+    calls = []
+
+    async def upstream():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return {"answer": 4}
+
+    async def run():
+        return await asyncio.gather(*(flight.do("k", upstream) for _ in range(5)))
+
+    results = asyncio.run(run())
+    assert results == [{"answer": 4}] * 5
+    assert len(calls) == 1
+    assert flight.get_stats()["joined"] == 4
+    assert flight.get_stats()["in_flight"] == 0
+
+def test_errors_propagate_to_all_callers():
+    """An upstream failure is raised to every waiting caller"""
+    flight = SingleFlight()
+
+    async def upstream():
+        await asyncio.sleep(0.01)
+        raise RuntimeError("upstream down")
+
+    async def run():
+        return await asyncio.gather(
+            *(flight.do("k", upstream) for _ in range(3)),
+            return_exceptions=True
+        )
+
+    results = asyncio.run(run())
+    assert all(isinstance(r, RuntimeError) for r in results)
+
+def test_stream_late_joiner_replays_missed_chunks():
+    """A joiner arriving mid-stream still receives every chunk"""
+    flight = SingleFlight()
+    started = []
+
+    async def upstream():
+        started.append(1)
+        for i in range(4):
+            await asyncio.sleep(0.01)
+            yield i
+
+    async def consume():
+        return [chunk async for chunk in flight.stream("k", upstream)]
+
+    async def run():
+        first = asyncio.ensure_future(consume())
+        await asyncio.sleep(0.025)
+        second = asyncio.ensure_future(consume())
+        return await asyncio.gather(first, second)
+
+    first, second = asyncio.run(run())
+    assert first == second == [0, 1, 2, 3]
+    assert len(started) == 1
+    assert flight.get_stats()["stream_joined"] == 1
+
+def test_stream_error_propagates():
+    """Upstream stream errors are raised after the buffered chunks"""
+    flight = SingleFlight()
+
+    async def upstream():
+        yield "partial"
+        raise RuntimeError("stream broke")
+
+    async def consume(received):
+        async for chunk in flight.stream("k", upstream):
+            received.append(chunk)
+
+    received = []
+    with pytest.raises(RuntimeError):
+        asyncio.run(consume(received))
+    assert received == ["partial"]
@@ -0,0 +1,94 @@
+import asyncio
+import os
+import pytest
+import tiktoken
+from tokenizer import LazyTokenizer
+
+class FakeEncoding:
+    def encode_batch(self, texts):
+        return [text.split() for text in texts]
+
+@pytest.fixture
+def offline_tokenizer(tmp_path, monkeypatch):
+    """Tokenizer with an empty local cache and downloads disabled"""
+    monkeypatch.setenv("TOKENIZER_CACHE_DIR", str(tmp_path))
+    monkeypatch.delenv("DEEPSEEK_TOKENIZER_PATH", raising=False)
+    monkeypatch.delenv("TIKTOKEN_VOCAB_PATH", raising=False)
+    monkeypatch.setenv("TOKENIZER_ALLOW_DOWNLOAD", "false")
+    return LazyTokenizer()
+
+def test_loads_lazily(offline_tokenizer):
+    """Nothing is loaded until the first count"""
+    assert offline_tokenizer.get_stats()["backend"] is None
+    assert offline_tokenizer.get_stats()["load_seconds"] == 0.0
+
+def test_falls_back_when_vocab_missing(offline_tokenizer):
+    """Air-gapped hosts get approximate counts instead of a failed request"""
+    assert offline_tokenizer.count_tokens("abcdefgh") == 2
+    stats = offline_tokenizer.get_stats()
+    assert stats["backend"] == "approximate"
+    assert "downloads are disabled" in stats["load_error"]
+    assert stats["fallback_counts"] == 1
+    with pytest.raises(RuntimeError):
+        offline_tokenizer.encode_batch(["x"])
+
+def test_batch_counts_use_lru(offline_tokenizer):
+    """Only texts missing from the LRU are encoded, duplicates once"""
+    offline_tokenizer.backend = "tiktoken"
+    offline_tokenizer._encoding = FakeEncoding()
+    assert offline_tokenizer.count_tokens_batch(["x + 1 = 2", "y", "x + 1 = 2"]) == [5, 1, 5]
+    assert offline_tokenizer.count_tokens("x + 1 = 2") == 5
+    stats = offline_tokenizer.get_stats()
+    assert stats["count_cache_misses"] == 2
+    assert stats["count_cache_hits"] == 1
+
+def test_lru_is_bounded(offline_tokenizer):
+    """The least recently used counts are evicted first"""
+    offline_tokenizer.max_cache_size = 2
+    offline_tokenizer.count_tokens_batch(["a", "b", "c"])
+    assert list(offline_tokenizer._cache) == [LazyTokenizer._cache_key(t) for t in ("b", "c")]
+
+def test_loads_deepseek_vocab(offline_tokenizer, tmp_path):
+    """A local tokenizer.json is preferred and used for encode_batch"""
+    tokenizers = pytest.importorskip("tokenizers")
+    vocab = {"[UNK]": 0, "x": 1, "+": 2, "1": 3, "=": 4, "2": 5}
+    model = tokenizers.models.WordLevel(vocab, unk_token="[UNK]")
+    native = tokenizers.Tokenizer(model)
+    native.pre_tokenizer = tokenizers.pre_tokenizers.Whitespace()
+    native.save(str(tmp_path / "deepseek_tokenizer.json"))
+
+    tokenizer = LazyTokenizer()
+    assert tokenizer.encode_batch(["x + 1 = 2", "x"]) == [[1, 2, 3, 4, 5], [1]]
+    assert tokenizer.count_tokens("x + 1") == 3
+    assert tokenizer.get_stats()["backend"] == "deepseek"
+
+def test_async_counts_run_off_loop(offline_tokenizer):
+    """count_tokens_async resolves the vocab and counts from a worker thread"""
+    assert asyncio.run(offline_tokenizer.count_tokens_async(["abcd", "abcdefgh"])) == [1, 2]
+
+def test_downloads_disabled_by_default(tmp_path, monkeypatch):
+    """Without opting in, a missing vocab never triggers a network fetch"""
+    monkeypatch.setenv("TOKENIZER_CACHE_DIR", str(tmp_path))
+    monkeypatch.delenv("TOKENIZER_ALLOW_DOWNLOAD", raising=False)
+    assert LazyTokenizer().allow_download is False
+
+def test_startup_check_fails_without_vocab(offline_tokenizer):
+    """A deployment with no built vocab refuses to start instead of charging estimates"""
+    with pytest.raises(RuntimeError, match="python tokenizer.py"):
+        offline_tokenizer.check_vocab()
+
+    offline_tokenizer.require_vocab = False
+    offline_tokenizer.check_vocab()
+
+def test_exported_vocab_loads_without_touching_environ(offline_tokenizer):
+    """The build step's vocab file is loaded directly, leaving tiktoken's env alone"""
+    encoding = tiktoken.Encoding(
+        "bytes", pat_str=r"\S+|\s+", mergeable_ranks={bytes([i]): i for i in range(256)}, special_tokens={}
+    )
+    offline_tokenizer.export_tiktoken_vocab(encoding)
+    environ = dict(os.environ)
+
+    offline_tokenizer.check_vocab()
+    assert offline_tokenizer.count_tokens("ab c") == 4
+    assert offline_tokenizer.get_stats()["backend"] == "tiktoken"
+    assert dict(os.environ) == environ
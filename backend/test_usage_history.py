@@ -0,0 +1,73 @@
+import time
+import pytest
+from conftest import make_fake_redis, run
+from usage_history import InMemoryUsageHistory, RedisUsageHistory
+
+def make_history(backend, retention_seconds=3600):
+    if backend == "memory":
+        return InMemoryUsageHistory(retention_seconds)
+    return RedisUsageHistory(make_fake_redis(), retention_seconds)
+
+def test_pages_walk_history_newest_first(backend):
+    """Cursor pages cover every event exactly once, newest first"""
+    history = make_history(backend)
+
+    async def scenario():
+        for i in range(7):
+            await history.record("alice", i, "chat")
+        pages, cursor = [], None
+        while True:
+            page, cursor = await history.page("alice", 3, cursor)
+            pages.append(page)
+            if cursor is None:
+                return pages
+
+    pages = run(scenario())
+    assert [len(p) for p in pages] == [3, 3, 1]
+    assert [e["tokens_used"] for p in pages for e in p] == [6, 5, 4, 3, 2, 1, 0]
+
+def test_exact_page_has_no_cursor(backend):
+    """A page that reaches the oldest event doesn't hand out a cursor"""
+    history = make_history(backend)
+
+    async def scenario():
+        for i in range(3):
+            await history.record("alice", i, "chat")
+        return await history.page("alice", 3)
+
+    page, cursor = run(scenario())
+    assert len(page) == 3
+    assert cursor is None
+
+def test_users_are_isolated(backend):
+    """A user's page only contains their own events"""
+    history = make_history(backend)
+
+    async def scenario():
+        await history.record("alice", 10, "chat")
+        await history.record("bob", 20, "solve")
+        return await history.page("bob", 10), await history.page("carol", 10)
+
+    (bob, bob_cursor), (carol, _) = run(scenario())
+    assert [(e["user_id"], e["tokens_used"], e["operation"]) for e in bob] == [("bob", 20, "solve")]
+    assert bob_cursor is None
+    assert carol == []
+
+def test_retention_drops_old_events(backend):
+    """Events older than the retention window are not returned"""
+    history = make_history(backend, retention_seconds=0.05)
+
+    async def scenario():
+        await history.record("alice", 1, "chat")
+        time.sleep(0.1)
+        await history.record("alice", 2, "chat")
+        return await history.page("alice", 10)
+
+    page, _ = run(scenario())
+    assert [e["tokens_used"] for e in page] == [2]
+
+def test_invalid_cursor_rejected(backend):
+    """Malformed cursors raise ValueError before touching the store"""
+    history = make_history(backend)
+    with pytest.raises(ValueError):
+        run(history.page("alice", 10, "not-a-cursor"))
@@ -0,0 +1,64 @@
+import pytest
+from conftest import make_fake_redis, run
+from usage_rollups import InMemoryUsageRollups, RedisUsageRollups
+
+RETENTION = {"hour": 24, "day": 7}
+
+def make_rollups(backend, flush_interval=0):
+    if backend == "memory":
+        return InMemoryUsageRollups(RETENTION)
+    return RedisUsageRollups(make_fake_redis(), RETENTION, flush_interval)
+
+def test_events_fold_into_current_buckets(backend):
+    """Every event lands in the current hour and day, with a tier/model breakdown"""
+    rollups = make_rollups(backend)
+
+    async def scenario():
+        await rollups.record("alice", "free", "deepseek-chat", 100, 0.2)
+        await rollups.record("alice", "free", "deepseek-chat", 50, 0.1)
+        await rollups.record("alice", "pro", "deepseek-chat", 10, 0.02)
+        return await rollups.series("alice", "hour", 1), await rollups.series("alice", "day", 3)
+
+    hours, days = run(scenario())
+    assert hours[0]["tokens"] == 160
+    assert hours[0]["billed_cost"] == pytest.approx(0.32)
+    assert sorted((e["tier"], e["tokens"]) for e in hours[0]["breakdown"]) == [("free", 150), ("pro", 10)]
+    assert [d["tokens"] for d in days] == [160, 0, 0]
+    assert days[0]["bucket"] > days[1]["bucket"] > days[2]["bucket"]
+
+def test_global_scope_sums_all_users(backend):
+    """The global series covers every user while user series stay separate"""
+    rollups = make_rollups(backend)
+
+    async def scenario():
+        await rollups.record("alice", "free", "deepseek-chat", 100, 0.2)
+        await rollups.record("bob", "pro", "deepseek-chat", 40, 0.08)
+        return (
+            await rollups.series(None, "day", 1),
+            await rollups.series("bob", "day", 1),
+            await rollups.series("carol", "day", 1)
+        )
+
+    everyone, bob, carol = run(scenario())
+    assert everyone[0]["tokens"] == 140
+    assert bob[0]["tokens"] == 40
+    assert carol[0] == {"bucket": carol[0]["bucket"], "tokens": 0, "billed_cost": 0.0, "breakdown": []}
+
+def test_buffered_events_visible_and_flushed_on_close():
+    """Pending deltas show up in reads and reach Redis in one flush on close"""
+    rollups = make_rollups("redis", flush_interval=60)
+
+    async def scenario():
+        rollups.start()
+        for _ in range(5):
+            await rollups.record("alice", "free", "deepseek-chat", 10, 0.02)
+        before = (await rollups.series("alice", "hour", 1))[0]["tokens"], rollups.stats["flushes"]
+        await rollups.aclose()
+        stored = await rollups.redis.keys("rollup:*")
+        return before, stored, (await rollups.series("alice", "hour", 1))[0]["tokens"]
+
+    (pending_tokens, flushes), stored, after = run(scenario())
+    assert (pending_tokens, flushes) == (50, 0)
+    assert len(stored) == 4
+    assert after == 50
+    assert rollups.stats["flushes"] == 1
@@ -0,0 +1,232 @@
+import asyncio
+from datetime import datetime, timezone
+import pytest
+from conftest import make_fake_redis, run
+from usage_store import BufferedUsageStore, InMemoryUsageStore, RedisUsageStore, UsagePeriods
+
+def make_store(backend):
+    return InMemoryUsageStore() if backend == "memory" else RedisUsageStore(make_fake_redis())
+
+@pytest.fixture
+def store(backend):
+    return make_store(backend)
+
+def test_incr_updates_daily_and_monthly(store):
+    """One increment bumps both epoch counters"""
+    async def scenario():
+        await store.incr("alice", 5)
+        return await store.incr("alice", 7)
+
+    assert run(scenario()) == {"daily_used": 12, "monthly_used": 12}
+
+def test_get_many_batches_users(store):
+    """Counters for several users come back in order, unknown users as zero"""
+    async def scenario():
+        await store.incr("alice", 3)
+        return await store.get_many(["alice", "bob"])
+
+    alice, bob = run(scenario())
+    assert alice["daily_used"] == 3
+    assert bob == {"daily_used": 0, "monthly_used": 0, "held": 0}
+
+def test_reserve_holds_and_rejects(store):
+    """Holds count against the limit until released"""
+    async def scenario():
+        first = await store.reserve("alice", 1000, None, 100, 32, 400, 60)
+        second = await store.reserve("alice", 1000, None, 100, 32, 400, 60)
+        third = await store.reserve("alice", 1000, None, 100, 32, 400, 60)
+        held = (await store.get("alice"))["held"]
+        released = await store.release("alice", first[2])
+        return first, second, third, held, released, await store.get("alice")
+
+    first, second, third, held, released, after = run(scenario())
+    assert first[0] and first[1] == 400
+    assert second[0] and second[1] == 400
+    assert not third[0]
+    assert held == 1000
+    assert released
+    assert after["held"] == 500
+
+def test_reserve_uses_tightest_limit(store):
+    """Daily and monthly limits both bound the budget"""
+    async def scenario():
+        await store.incr("alice", 900)
+        return await store.reserve("alice", 10000, 1000, 50, 10, 8192, 60)
+
+    ok, budget, _ = run(scenario())
+    assert ok and budget == 50
+
+def test_holds_expire(store):
+    """A reservation that is never reconciled stops counting after its TTL"""
+    async def scenario():
+        await store.reserve("alice", 1000, None, 100, 10, 8192, 0.05)
+        await asyncio.sleep(0.1)
+        return await store.get("alice")
+
+    assert run(scenario())["held"] == 0
+
+class FailingStore(InMemoryUsageStore):
+    """Memory store whose batch writes fail until told otherwise"""
+
+    def __init__(self):
+        super().__init__()
+        self.fail = True
+
+    async def incr_many(self, deltas):
+        if self.fail:
+            raise ConnectionError("redis down")
+        return await super().incr_many(deltas)
+
+def make_buffered(inner=None, max_pending_users=100):
+    # A long interval so only explicit flushes write
+    return BufferedUsageStore(inner or InMemoryUsageStore(), 60, max_pending_users)
+
+def test_buffered_coalesces_increments():
+    """Many increments become one write per user, visible before the flush"""
+    inner = InMemoryUsageStore()
+    store = make_buffered(inner)
+
+    async def scenario():
+        store.start()
+        for _ in range(10):
+            await store.incr("alice", 5)
+        await store.incr("bob", 1)
+        before = (await inner.get("alice"), await store.get("alice"))
+        flushed = await store.flush()
+        after = await inner.get("alice")
+        await store.aclose()
+        return before, flushed, after
+
+    (inner_before, seen_before), flushed, inner_after = run(scenario())
+    assert inner_before["daily_used"] == 0
+    assert seen_before["daily_used"] == 50
+    assert flushed == 2
+    assert inner_after["daily_used"] == 50
+    stats = store.get_stats()
+    assert stats["increments"] == 11 and stats["flushes"] == 1 and stats["flushed_tokens"] == 51
+
+def test_buffered_reserve_sees_pending():
+    """Unflushed usage counts against the limit when reserving"""
+    store = make_buffered()
+
+    async def scenario():
+        store.start()
+        await store.incr("alice", 900)
+        result = await store.reserve("alice", 1000, None, 50, 10, 8192, 60)
+        await store.aclose()
+        return result
+
+    ok, budget, _ = run(scenario())
+    assert ok and budget == 50
+
+@pytest.mark.parametrize("inner_backend", ["memory", "redis"])
+@pytest.mark.parametrize("unflushed", [1001, 1500])
+def test_buffered_reserve_rejects_when_pending_exceeds_limit(inner_backend, unflushed):
+    """Pending usage past the limit is a rejection, never an error or an unlimited grant"""
+    store = make_buffered(make_store(inner_backend))
+
+    async def scenario():
+        store.start()
+        await store.incr("alice", unflushed)
+        result = await store.reserve("alice", 1000, None, 50, 10, 8192, 60)
+        await store.aclose()
+        return result
+
+    ok, _, reservation_id = run(scenario())
+    assert not ok and reservation_id is None
+
+def test_buffered_flushes_on_close():
+    """Closing writes whatever is still pending"""
+    inner = InMemoryUsageStore()
+    store = make_buffered(inner)
+
+    async def scenario():
+        store.start()
+        await store.incr("alice", 7)
+        await store.aclose()
+        return await inner.get("alice")
+
+    assert run(scenario())["daily_used"] == 7
+
+def test_buffered_flushes_early_when_full():
+    """Reaching the pending-user cap wakes the flusher before the interval"""
+    inner = InMemoryUsageStore()
+    store = make_buffered(inner, max_pending_users=2)
+
+    async def scenario():
+        store.start()
+        await store.incr("alice", 1)
+        await store.incr("bob", 1)
+        await asyncio.sleep(0.05)
+        flushed = (await inner.get("bob"))["daily_used"]
+        await store.aclose()
+        return flushed
+
+    assert run(scenario()) == 1
+
+def test_buffered_keeps_deltas_when_flush_fails():
+    """A failed flush retries the same deltas next time"""
+    inner = FailingStore()
+    store = make_buffered(inner)
+
+    async def scenario():
+        store.start()
+        await store.incr("alice", 3)
+        failed = await store.flush()
+        seen = await store.get("alice")
+        inner.fail = False
+        await store.aclose()
+        return failed, seen, await inner.get("alice")
+
+    failed, seen, stored = run(scenario())
+    assert failed == 0
+    assert seen["daily_used"] == 3
+    assert stored["daily_used"] == 3
+    assert store.get_stats()["flush_errors"] == 1
+
+def test_periods_default_to_utc(monkeypatch):
+    """Without configuration, periods roll over at UTC midnight"""
+    monkeypatch.delenv("USAGE_RESET_TIMEZONE", raising=False)
+    periods = UsagePeriods()
+    now = datetime(2024, 1, 31, 23, 30, tzinfo=timezone.utc)
+    assert periods.epochs("free", now) == ("20240131", "202401")
+    next_day, next_month = periods.next_resets("free", now)
+    assert next_day == datetime(2024, 2, 1, tzinfo=timezone.utc)
+    assert next_month == datetime(2024, 2, 1, tzinfo=timezone.utc)
+
+def test_periods_use_tier_time_zone(monkeypatch):
+    """A tier override moves that tier's boundaries to its own zone"""
+    monkeypatch.setenv("USAGE_RESET_TIMEZONE", "UTC")
+    monkeypatch.setenv("USAGE_RESET_TIMEZONE_PRO", "Asia/Tokyo")
+    periods = UsagePeriods()
+    now = datetime(2024, 1, 31, 16, 0, tzinfo=timezone.utc)  # 01:00 on Feb 1st in Tokyo
+    assert periods.epochs("free", now) == ("20240131", "202401")
+    assert periods.epochs("pro", now) == ("20240201", "202402")
+    next_day, _ = periods.next_resets("pro", now)
+    assert next_day.astimezone(timezone.utc) == datetime(2024, 2, 1, 15, 0, tzinfo=timezone.utc)
+
+def test_new_period_starts_from_zero(store):
+    """Usage from an earlier period doesn't count, with no sweep involved"""
+    async def scenario():
+        await store.incr_many({("alice", "20000101", "200001"): 500})
+        await store.incr("alice", 7)
+        return await store.get("alice")
+
+    assert run(scenario()) == {"daily_used": 7, "monthly_used": 7, "held": 0}
+
+def test_buffered_deltas_stay_in_their_period():
+    """A delta buffered before a day rolls over is flushed into that day"""
+    inner = InMemoryUsageStore()
+    store = make_buffered(inner)
+
+    async def scenario():
+        store.start()
+        store._add_pending("alice", "20000101", "200001", 500)
+        await store.incr("alice", 7)
+        seen = await store.get("alice")
+        await store.aclose()
+        return seen, await inner.get("alice"), inner.usage["alice"]["d:20000101"]
+
+    seen, stored, old_day = run(scenario())
+    assert seen["daily_used"] == 7 and stored["daily_used"] == 7
+    assert old_day == 500
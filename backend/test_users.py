@@ -0,0 +1,126 @@
+import asyncio
+import pytest
+from users import CachedUserRepository, SQLUserRepository, UserExistsError
+
+@pytest.fixture
+def repository(tmp_path):
+    """A fresh SQLite-backed repository per test"""
+    return SQLUserRepository(f"sqlite+aiosqlite:///{tmp_path / 'users.db'}")
+
+def run(repository, scenario):
+    async def wrapped():
+        await repository.init()
+        try:
+            return await scenario()
+        finally:
+            await repository.aclose()
+    return asyncio.run(wrapped())
+
+def test_create_and_lookup(repository):
+    """Users are found by username and email"""
+    async def scenario():
+        await repository.create("alice", hashed_password="hash", email="alice@example.com")
+        return (
+            await repository.get_by_username("alice"),
+            await repository.get_by_email("alice@example.com"),
+            await repository.get_by_username("bob")
+        )
+
+    by_name, by_email, missing = run(repository, scenario)
+    assert by_name.hashed_password == "hash"
+    assert by_name.tier == "free"
+    assert by_email.username == "alice"
+    assert missing is None
+
+def test_duplicate_username_rejected(repository):
+    async def scenario():
+        await repository.create("alice")
+        await repository.create("alice")
+
+    with pytest.raises(UserExistsError):
+        run(repository, scenario)
+    assert repository.stats["conflicts"] == 1
+
+def test_oauth_get_or_create_is_idempotent(repository):
+    """The same OAuth identity maps to one user, concurrent sign-ins included"""
+    async def scenario():
+        users = await asyncio.gather(*(
+            repository.get_or_create_oauth("google", "123", name="Al", email="al@example.com")
+            for _ in range(3)
+        ))
+        return users, await repository.get_by_oauth("google", "123")
+
+    users, stored = run(repository, scenario)
+    assert {u.username for u in users} == {"google_123"}
+    assert stored.name == "Al" and stored.oauth_provider == "google"
+
+def test_set_tier(repository):
+    """Tier changes persist and unknown users report no update"""
+    async def scenario():
+        await repository.create("alice")
+        updated = await repository.set_tier("alice", "pro")
+        missing = await repository.set_tier("bob", "pro")
+        return updated, missing, await repository.get_by_username("alice")
+
+    updated, missing, user = run(repository, scenario)
+    assert updated and not missing
+    assert user.tier == "pro"
+
+def make_cached(repository, ttl=60, max_size=100):
+    return CachedUserRepository(repository, ttl, max_size)
+
+def test_cache_serves_repeat_lookups(repository):
+    """Only the first lookup of a user reaches the database"""
+    cached = make_cached(repository)
+
+    async def scenario():
+        await cached.create("alice")
+        for _ in range(5):
+            await cached.get_by_username("alice")
+
+    run(cached, scenario)
+    assert repository.stats["lookups"] == 1
+    assert cached.get_stats()["cache"]["hits"] == 4
+
+def test_cache_invalidated_by_tier_change(repository):
+    """An upgrade is visible on the next lookup, not after the TTL"""
+    cached = make_cached(repository)
+
+    async def scenario():
+        await cached.create("alice")
+        await cached.get_by_username("alice")
+        await cached.set_tier("alice", "pro")
+        return await cached.get_by_username("alice")
+
+    assert run(cached, scenario).tier == "pro"
+
+def test_cache_entries_expire(repository):
+    """Changes made elsewhere show up once the TTL passes"""
+    cached = make_cached(repository, ttl=0.05)
+
+    async def scenario():
+        await cached.create("alice")
+        await cached.get_by_username("alice")
+        # Another worker upgrades the user directly
+        await repository.set_tier("alice", "pro")
+        stale = await cached.get_by_username("alice")
+        await asyncio.sleep(0.1)
+        return stale, await cached.get_by_username("alice")
+
+    stale, fresh = run(cached, scenario)
+    assert stale.tier == "free" and fresh.tier == "pro"
+    assert cached.get_stats()["cache"]["expired"] == 1
+
+def test_cache_skips_missing_and_stays_bounded(repository):
+    """Unknown users aren't cached and the cache never exceeds its size"""
+    cached = make_cached(repository, max_size=2)
+
+    async def scenario():
+        assert await cached.get_by_username("alice") is None
+        for name in ("alice", "bob", "carol"):
+            await cached.create(name)
+            await cached.get_by_username(name)
+
+    run(cached, scenario)
+    stats = cached.get_stats()["cache"]
+    assert stats["size"] == 2 and stats["evictions"] == 1
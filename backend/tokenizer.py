@@ -0,0 +1,229 @@
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional
+import asyncio
+import base64
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Keep tokenizer files next to the app so workers never download them at runtime;
+# write the tiktoken vocab here at build time with `python tokenizer.py`
+DEFAULT_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "tokenizer_cache")
+
+class LazyTokenizer:
+    """Shared token counter: DeepSeek's own vocab when available, loaded on first use"""
+
+    # Rough characters-per-token ratio used when no vocab can be loaded
+    FALLBACK_CHARS_PER_TOKEN = 4
+
+    def __init__(self):
+        self.model = os.getenv('TOKENIZER_MODEL', 'gpt-3.5-turbo')
+        self.cache_dir = os.getenv('TOKENIZER_CACHE_DIR', DEFAULT_CACHE_DIR)
+        # tokenizer.json from the DeepSeek model repository
+        self.deepseek_path = os.getenv(
+            'DEEPSEEK_TOKENIZER_PATH',
+            os.path.join(self.cache_dir, 'deepseek_tokenizer.json')
+        )
+        # tiktoken vocab exported by the build step, loaded without tiktoken's download cache
+        self.tiktoken_path = os.getenv('TIKTOKEN_VOCAB_PATH', os.path.join(self.cache_dir, 'tiktoken_vocab.json'))
+        # Off by default: tiktoken downloads without a timeout while holding the load lock
+        self.allow_download = os.getenv('TOKENIZER_ALLOW_DOWNLOAD', 'false').lower() == 'true'
+        # Refuse to start without a vocab rather than quietly charging len/4 estimates
+        self.require_vocab = os.getenv('TOKENIZER_REQUIRE_VOCAB', 'true').lower() == 'true'
+        self.max_cache_size = int(os.getenv('TOKEN_COUNT_CACHE_SIZE', 4096))
+        self.backend: Optional[str] = None
+        self._deepseek = None
+        self._encoding = None
+        self._failed = False
+        self._lock = threading.Lock()
+        self._cache: OrderedDict = OrderedDict()
+        self._cache_lock = threading.Lock()
+        self.stats = {
+            'loaded': False,
+            'load_seconds': 0.0,
+            'fallback_counts': 0,
+            'load_error': None,
+            'count_cache_hits': 0,
+            'count_cache_misses': 0
+        }
+
+    def check_vocab(self) -> None:
+        """Raise if no vocab is on disk and none may be downloaded; called at startup"""
+        if not self.require_vocab or self.allow_download:
+            return
+        if not (os.path.exists(self.deepseek_path) or os.path.exists(self.tiktoken_path)):
+            raise RuntimeError(
+                f"No tokenizer vocab in {self.cache_dir}: run `python tokenizer.py` at build time, "
+                f"or set TOKENIZER_REQUIRE_VOCAB=false to accept approximate counts"
+            )
+
+    @staticmethod
+    def _cache_key(text: str) -> bytes:
+        # A digest, so the LRU doesn't keep thousands of full completion texts alive
+        return hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest()
+
+    def _load_deepseek(self) -> bool:
+        """Load DeepSeek's tokenizer.json through the Rust-backed `tokenizers` library"""
+        if not os.path.exists(self.deepseek_path):
+            return False
+        try:
+            from tokenizers import Tokenizer
+        except ImportError:
+            logging.warning("tokenizers is not installed, falling back to tiktoken")
+            return False
+        self._deepseek = Tokenizer.from_file(self.deepseek_path)
+        self.backend = "deepseek"
+        logging.info(f"DeepSeek tokenizer loaded from {self.deepseek_path}")
+        return True
+
+    def _load_tiktoken(self) -> None:
+        import tiktoken
+
+        if os.path.exists(self.tiktoken_path):
+            with open(self.tiktoken_path, encoding="utf-8") as f:
+                vocab = json.load(f)
+            self._encoding = tiktoken.Encoding(
+                vocab["name"],
+                pat_str=vocab["pat_str"],
+                mergeable_ranks={base64.b64decode(token): rank for token, rank in vocab["ranks"].items()},
+                special_tokens=vocab["special_tokens"]
+            )
+            source = self.tiktoken_path
+        elif self.allow_download:
+            # Goes through tiktoken's own cache, wherever the operator pointed it
+            self._encoding = tiktoken.encoding_for_model(self.model)
+            source = "tiktoken's download cache"
+        else:
+            # Fail fast on air-gapped hosts instead of waiting on network timeouts
+            raise RuntimeError(f"No tokenizer vocab at {self.tiktoken_path} and downloads are disabled")
+        self.backend = "tiktoken"
+        logging.info(f"Tokenizer for {self.model} loaded from {source}")
+
+    def export_tiktoken_vocab(self, encoding) -> str:
+        """Write an encoding's vocab to tiktoken_path so workers load it from local disk"""
+        vocab = {
+            "name": encoding.name,
+            "pat_str": encoding._pat_str,
+            "special_tokens": encoding._special_tokens,
+            "ranks": {base64.b64encode(token).decode("ascii"): rank for token, rank in encoding._mergeable_ranks.items()}
+        }
+        os.makedirs(os.path.dirname(self.tiktoken_path), exist_ok=True)
+        tmp_path = self.tiktoken_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(vocab, f)
+        os.replace(tmp_path, self.tiktoken_path)
+        return self.tiktoken_path
+
+    def _load(self) -> None:
+        start = time.perf_counter()
+        try:
+            if not self._load_deepseek():
+                self._load_tiktoken()
+            self.stats['loaded'] = True
+        except Exception as e:
+            self._failed = True
+            self.backend = "approximate"
+            self.stats['load_error'] = str(e)
+            logging.warning(f"Tokenizer unavailable, using approximate token counts: {str(e)}")
+        finally:
+            self.stats['load_seconds'] = time.perf_counter() - start
+            # Drop any counts cached before the vocab was resolved
+            with self._cache_lock:
+                self._cache.clear()
+
+    def _ensure_loaded(self) -> None:
+        if self.backend is None:
+            with self._lock:
+                if self.backend is None:
+                    self._load()
+
+    def get_encoding(self) -> Optional[Any]:
+        """Return the loaded tokenizer, loading it once; None if no vocab could be loaded"""
+        self._ensure_loaded()
+        return self._deepseek or self._encoding
+
+    def encode_batch(self, texts: List[str]) -> List[List[int]]:
+        """Encode many texts in one native call"""
+        self._ensure_loaded()
+        if self._deepseek is not None:
+            return [e.ids for e in self._deepseek.encode_batch(texts, add_special_tokens=False)]
+        if self._encoding is not None:
+            return self._encoding.encode_batch(texts)
+        raise RuntimeError("Tokenizer vocab is unavailable")
+
+    def count_tokens_batch(self, texts: List[str]) -> List[int]:
+        """Count tokens for many texts, encoding only those not in the LRU"""
+        counts: List[Optional[int]] = [None] * len(texts)
+        keys = [self._cache_key(text) for text in texts]
+        misses: Dict[bytes, List[int]] = {}
+        with self._cache_lock:
+            for i, key in enumerate(keys):
+                if key in self._cache:
+                    self._cache.move_to_end(key)
+                    counts[i] = self._cache[key]
+                    self.stats['count_cache_hits'] += 1
+                else:
+                    misses.setdefault(key, []).append(i)
+        if not misses:
+            return counts
+
+        self.stats['count_cache_misses'] += len(misses)
+        pending = [texts[indexes[0]] for indexes in misses.values()]
+        if self.get_encoding() is None:
+            self.stats['fallback_counts'] += len(pending)
+            fresh = [
+                (len(text) + self.FALLBACK_CHARS_PER_TOKEN - 1) // self.FALLBACK_CHARS_PER_TOKEN
+                for text in pending
+            ]
+        else:
+            fresh = [len(ids) for ids in self.encode_batch(pending)]
+
+        with self._cache_lock:
+            for key, count in zip(misses, fresh):
+                for i in misses[key]:
+                    counts[i] = count
+                self._cache[key] = count
+                self._cache.move_to_end(key)
+            while len(self._cache) > self.max_cache_size:
+                self._cache.popitem(last=False)
+        return counts
+
+    def count_tokens(self, text: str) -> int:
+        """Count tokens for one text, memoized so repeated prompts are encoded once"""
+        return self.count_tokens_batch([text])[0]
+
+    async def count_tokens_async(self, texts: List[str]) -> List[int]:
+        """Count a batch in a worker thread so long texts don't block the event loop"""
+        return await asyncio.to_thread(self.count_tokens_batch, texts)
+
+    async def warm(self) -> None:
+        """Load the vocab in a worker thread so the first request doesn't pay for it"""
+        await asyncio.to_thread(self._ensure_loaded)
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Get load status and count cache efficiency"""
+        return {
+            **self.stats,
+            'backend': self.backend,
+            'model': self.model,
+            'cache_dir': self.cache_dir,
+            'deepseek_path': self.deepseek_path,
+            'tiktoken_path': self.tiktoken_path,
+            'cache_size': len(self._cache)
+        }
+
+# Initialize shared tokenizer
+tokenizer = LazyTokenizer()
+
+if __name__ == "__main__":
+    # Build step: download the fallback vocab once and export it next to the app
+    import tiktoken
+    print(f"Wrote {tokenizer.export_tiktoken_vocab(tiktoken.encoding_for_model(tokenizer.model))}")
+    tokenizer.get_encoding()
+    print(tokenizer.get_stats())
@@ -0,0 +1,143 @@
+from bisect import bisect_left
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+import math
+import os
+import time
+from dotenv import load_dotenv
+
+load_dotenv()
+
+MAX_SEQ = 2**64 - 1  # Largest sequence part of a stream id
+
+def _parse_id(event_id: str) -> Tuple[int, int]:
+    """Split a "<ms>-<seq>" event id; raises ValueError for malformed cursors"""
+    ms, _, seq = event_id.partition("-")
+    return int(ms), int(seq or 0)
+
+def _event(user_id: str, event_id: str, fields: Dict[str, Any]) -> Dict[str, Any]:
+    ms, _ = _parse_id(event_id)
+    return {
+        "id": event_id,
+        "user_id": user_id,
+        "tokens_used": int(fields["tokens_used"]),
+        "operation": fields["operation"],
+        "timestamp": datetime.utcfromtimestamp(ms / 1000).isoformat()
+    }
+
+class InMemoryUsageHistory:
+    """Per-user event lists ordered by stream-style ids, for tests and single-worker development"""
+
+    name = "memory"
+
+    def __init__(self, retention_seconds: float):
+        self.retention_seconds = retention_seconds
+        self.retention_ms = int(retention_seconds * 1000)
+        # user_id -> (sorted ids, events)
+        self.events: Dict[str, Tuple[List[Tuple[int, int]], List[Dict[str, Any]]]] = {}
+        self._last_id: Tuple[int, int] = (0, 0)
+        self.stats = {'recorded': 0, 'pages': 0}
+
+    def _next_id(self) -> Tuple[int, int]:
+        ms = int(time.time() * 1000)
+        last_ms, last_seq = self._last_id
+        self._last_id = (ms, 0) if ms > last_ms else (last_ms, last_seq + 1)
+        return self._last_id
+
+    def _trim(self, user_id: str) -> None:
+        ids, events = self.events[user_id]
+        cutoff = bisect_left(ids, (int(time.time() * 1000) - self.retention_ms, 0))
+        if cutoff:
+            del ids[:cutoff]
+            del events[:cutoff]
+        if not ids:
+            del self.events[user_id]
+
+    async def record(self, user_id: str, tokens_used: int, operation: str) -> str:
+        ms, seq = self._next_id()
+        event_id = f"{ms}-{seq}"
+        ids, events = self.events.setdefault(user_id, ([], []))
+        ids.append((ms, seq))
+        events.append(_event(user_id, event_id, {"tokens_used": tokens_used, "operation": operation}))
+        self._trim(user_id)
+        self.stats['recorded'] += 1
+        return event_id
+
+    async def page(self, user_id: str, limit: int, cursor: Optional[str] = None) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+        cursor_id = _parse_id(cursor) if cursor else None
+        self.stats['pages'] += 1
+        if user_id not in self.events:
+            return [], None
+        self._trim(user_id)
+        if user_id not in self.events:
+            return [], None
+        ids, events = self.events[user_id]
+        end = bisect_left(ids, cursor_id) if cursor_id else len(ids)
+        start = max(0, end - limit)
+        page = events[start:end][::-1]
+        return page, (page[-1]["id"] if start > 0 else None)
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {**self.stats, 'backend': self.name, 'users': len(self.events)}
+
+class RedisUsageHistory:
+    """One Redis stream per user; ids are time ordered, so pages are range reads"""
+
+    name = "redis"
+
+    def __init__(self, redis_client, retention_seconds: float):
+        self.redis = redis_client
+        self.retention_seconds = retention_seconds
+        self.stats = {'recorded': 0, 'pages': 0}
+
+    @staticmethod
+    def _key(user_id: str) -> str:
+        return f"usage_history:{user_id}"
+
+    async def record(self, user_id: str, tokens_used: int, operation: str) -> str:
+        """Append an event, trimming entries older than the retention window"""
+        key = self._key(user_id)
+        min_id = f"{int((time.time() - self.retention_seconds) * 1000)}-0"
+        async with self.redis.pipeline(transaction=False) as pipe:
+            pipe.xadd(key, {"tokens_used": tokens_used, "operation": operation}, minid=min_id, approximate=True)
+            # Streams of users who stop calling disappear after the window
+            pipe.expire(key, max(1, math.ceil(self.retention_seconds)))
+            event_id, _ = await pipe.execute()
+        self.stats['recorded'] += 1
+        return event_id.decode() if isinstance(event_id, bytes) else event_id
+
+    async def page(self, user_id: str, limit: int, cursor: Optional[str] = None) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+        """Newest first, `limit` events older than the cursor"""
+        max_id = "+"
+        if cursor:
+            # Inclusive bound on the id just before the cursor; exclusive "(" ranges need Redis 6.2
+            ms, seq = _parse_id(cursor)
+            max_id = f"{ms}-{seq - 1}" if seq else f"{ms - 1}-{MAX_SEQ}"
+        self.stats['pages'] += 1
+        key = self._key(user_id)
+        min_id = f"{int((time.time() - self.retention_seconds) * 1000)}-0"
+        entries = await self.redis.xrevrange(key, max=max_id, min=min_id, count=limit + 1)
+
+        events = []
+        for event_id, fields in entries[:limit]:
+            if isinstance(event_id, bytes):
+                event_id = event_id.decode()
+                fields = {k.decode(): v.decode() for k, v in fields.items()}
+            events.append(_event(user_id, event_id, fields))
+        next_cursor = events[-1]["id"] if len(entries) > limit else None
+        return events, next_cursor
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {**self.stats, 'backend': self.name}
+
+def create_usage_history(redis_client=None):
+    """Create the history store selected by USAGE_HISTORY_STORE (redis or memory)"""
+    retention_seconds = float(os.getenv('USAGE_HISTORY_RETENTION_DAYS', 90)) * 86400
+    name = os.getenv('USAGE_HISTORY_STORE', 'redis').lower()
+    if name == "memory":
+        return InMemoryUsageHistory(retention_seconds)
+    if name == "redis":
+        if redis_client is None:
+            raise ValueError("USAGE_HISTORY_STORE=redis needs a Redis client")
+        return RedisUsageHistory(redis_client, retention_seconds)
+    raise ValueError(f"Unknown USAGE_HISTORY_STORE '{name}', expected 'redis' or 'memory'")
@@ -0,0 +1,177 @@
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, List, Optional, Tuple
+import logging
+import os
+import time
+from dotenv import load_dotenv
+from usage_store import WriteBehindFlusher, decode_redis_value
+
+load_dotenv()
+
+# Bucket id formats and how long each granularity is kept
+GRANULARITIES = {
+    "hour": ("%Y%m%d%H", timedelta(hours=1)),
+    "day": ("%Y%m%d", timedelta(days=1))
+}
+
+def _bucket_ids(granularity: str, periods: int, now: Optional[datetime] = None) -> List[str]:
+    """Ids of the last `periods` UTC buckets, newest first"""
+    fmt, step = GRANULARITIES[granularity]
+    now = now or datetime.now(timezone.utc)
+    return [(now - step * i).strftime(fmt) for i in range(periods)]
+
+def _fold(rows: Dict[str, float], bucket: str) -> Dict[str, Any]:
+    """Turn "<tier>|<model>|<metric>" fields into totals plus a per tier/model breakdown.
+
+    billed_cost is what users are charged at the flat per-1K rate, not the upstream
+    API spend, which CostTracker prices from the upstream's own usage.
+    """
+    breakdown: Dict[str, Dict[str, Any]] = {}
+    for field, value in rows.items():
+        tier, model, metric = field.split("|")
+        entry = breakdown.setdefault(f"{tier}|{model}", {"tier": tier, "model": model, "tokens": 0, "billed_cost": 0.0})
+        entry[metric] += float(value) if metric == "billed_cost" else int(float(value))
+    return {
+        "bucket": bucket,
+        "tokens": sum(e["tokens"] for e in breakdown.values()),
+        "billed_cost": sum((e["billed_cost"] for e in breakdown.values()), 0.0),
+        "breakdown": list(breakdown.values())
+    }
+
+class InMemoryUsageRollups:
+    """Per-process rollup buckets, for tests and single-worker development"""
+
+    name = "memory"
+
+    def __init__(self, retention: Dict[str, int]):
+        # granularity -> buckets kept per scope
+        self.retention = retention
+        # (username or None for everyone, granularity) -> {bucket: {field: value}}
+        self.buckets: Dict[Tuple[str, str], Dict[str, Dict[str, float]]] = {}
+        self.stats = {'events': 0}
+
+    def start(self) -> None:
+        pass
+
+    async def aclose(self) -> None:
+        pass
+
+    async def record(self, username: str, tier: str, model: str, tokens: int, billed_cost: float) -> None:
+        """Fold one usage event into the user's and the global hourly and daily buckets"""
+        self.stats['events'] += 1
+        for scope in (username, None):
+            for granularity in GRANULARITIES:
+                bucket = _bucket_ids(granularity, 1)[0]
+                series = self.buckets.setdefault((scope, granularity), {})
+                rows = series.setdefault(bucket, {})
+                rows[f"{tier}|{model}|tokens"] = rows.get(f"{tier}|{model}|tokens", 0) + tokens
+                rows[f"{tier}|{model}|billed_cost"] = rows.get(f"{tier}|{model}|billed_cost", 0.0) + billed_cost
+                for old in sorted(series)[:-self.retention[granularity]]:
+                    del series[old]
+
+    async def series(self, username: Optional[str], granularity: str, periods: int) -> List[Dict[str, Any]]:
+        """The last `periods` buckets for a user (or everyone when None), newest first"""
+        series = self.buckets.get((username, granularity), {})
+        return [_fold(series.get(bucket, {}), bucket) for bucket in _bucket_ids(granularity, periods)]
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {**self.stats, 'backend': self.name, 'series': len(self.buckets)}
+
+class RedisUsageRollups(WriteBehindFlusher):
+    """Rollup hashes in Redis, one per scope and bucket, written behind in pipelined batches"""
+
+    name = "redis"
+
+    def __init__(self, redis_client, retention: Dict[str, int], flush_interval: float):
+        super().__init__(flush_interval)
+        self.redis = redis_client
+        self.retention = retention
+        # (key, field) -> delta not yet written
+        self._pending: Dict[Tuple[str, str], float] = {}
+        self.stats = {'events': 0, 'flushes': 0, 'flush_errors': 0, 'flushed_fields': 0, 'last_flush_ms': 0.0}
+
+    @staticmethod
+    def _key(username: Optional[str], granularity: str, bucket: str) -> str:
+        scope = "all" if username is None else f"u:{username}"
+        return f"rollup:{scope}:{granularity}:{bucket}"
+
+    def _ttl(self, granularity: str) -> int:
+        return int(GRANULARITIES[granularity][1].total_seconds()) * self.retention[granularity]
+
+    async def record(self, username: str, tier: str, model: str, tokens: int, billed_cost: float) -> None:
+        """Fold one usage event into the user's and the global hourly and daily buckets"""
+        self.stats['events'] += 1
+        for scope in (username, None):
+            for granularity in GRANULARITIES:
+                key = self._key(scope, granularity, _bucket_ids(granularity, 1)[0])
+                for field, delta in ((f"{tier}|{model}|tokens", tokens), (f"{tier}|{model}|billed_cost", billed_cost)):
+                    self._pending[(key, field)] = self._pending.get((key, field), 0) + delta
+        if self._task is None:
+            await self.flush()
+
+    async def flush(self) -> int:
+        """Write all pending deltas in one pipeline, returning how many fields changed"""
+        if not self._pending:
+            return 0
+        batch, self._pending = self._pending, {}
+        start = time.perf_counter()
+        try:
+            async with self.redis.pipeline(transaction=False) as pipe:
+                expiring = set()
+                for (key, field), delta in batch.items():
+                    if field.endswith("|billed_cost"):
+                        pipe.hincrbyfloat(key, field, delta)
+                    else:
+                        pipe.hincrby(key, field, int(delta))
+                    expiring.add(key)
+                for key in expiring:
+                    pipe.expire(key, self._ttl(key.split(":")[-2]))
+                await pipe.execute()
+        except Exception as e:
+            # Merge the batch back so the next flush retries it
+            logging.error(f"Usage rollup flush failed for {len(batch)} fields: {str(e)}")
+            self.stats['flush_errors'] += 1
+            for item, delta in batch.items():
+                self._pending[item] = self._pending.get(item, 0) + delta
+            return 0
+        self.stats['flushes'] += 1
+        self.stats['flushed_fields'] += len(batch)
+        self.stats['last_flush_ms'] = (time.perf_counter() - start) * 1000
+        return len(batch)
+
+    async def series(self, username: Optional[str], granularity: str, periods: int) -> List[Dict[str, Any]]:
+        """The last `periods` buckets for a user (or everyone when None), newest first, in one round trip"""
+        buckets = _bucket_ids(granularity, periods)
+        keys = [self._key(username, granularity, bucket) for bucket in buckets]
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for key in keys:
+                pipe.hgetall(key)
+            replies = await pipe.execute()
+
+        results = []
+        for key, bucket, rows in zip(keys, buckets, replies):
+            rows = {decode_redis_value(f): float(v) for f, v in rows.items()}
+            # Include what this worker hasn't flushed yet
+            for (pending_key, field), delta in self._pending.items():
+                if pending_key == key:
+                    rows[field] = rows.get(field, 0) + delta
+            results.append(_fold(rows, bucket))
+        return results
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {**self.stats, 'backend': self.name, 'pending_fields': len(self._pending)}
+
+def create_usage_rollups(redis_client=None):
+    """Create the rollup store selected by USAGE_ROLLUP_STORE (redis or memory)"""
+    retention = {
+        "hour": int(os.getenv('USAGE_ROLLUP_HOURS', 24 * 7)),
+        "day": int(os.getenv('USAGE_ROLLUP_DAYS', 400))
+    }
+    name = os.getenv('USAGE_ROLLUP_STORE', 'redis').lower()
+    if name == "memory":
+        return InMemoryUsageRollups(retention)
+    if name == "redis":
+        if redis_client is None:
+            raise ValueError("USAGE_ROLLUP_STORE=redis needs a Redis client")
+        return RedisUsageRollups(redis_client, retention, float(os.getenv('USAGE_FLUSH_INTERVAL_MS', 250)) / 1000)
+    raise ValueError(f"Unknown USAGE_ROLLUP_STORE '{name}', expected 'redis' or 'memory'")
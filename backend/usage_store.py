@@ -0,0 +1,499 @@
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone, tzinfo
+from typing import Any, Dict, List, Optional, Tuple
+import asyncio
+import logging
+import os
+import time
+import uuid
+from zoneinfo import ZoneInfo
+from dotenv import load_dotenv
+
+load_dotenv()
+
+DAILY_TTL = 2 * 86400  # Keep yesterday's counter around for late reads
+MONTHLY_TTL = 35 * 86400
+
+# KEYS: daily counter, monthly counter, holds zset
+# ARGV: daily_limit, monthly_limit (-1 = none), prompt_tokens, min_completion,
+#       max_completion, now, expires_at, reservation_id, holds_ttl
+# Holds the prompt plus the whole granted budget, so concurrent grants never add up
+# past the limit. Returns {ok, budget, member, expired}
+RESERVE_LUA = """
+local now = tonumber(ARGV[6])
+local expired = redis.call('ZREMRANGEBYSCORE', KEYS[3], '-inf', now)
+local held = 0
+for _, member in ipairs(redis.call('ZRANGE', KEYS[3], 0, -1)) do
+    held = held + tonumber(string.match(member, ':(%d+)$'))
+end
+
+local remaining = nil
+local daily_limit = tonumber(ARGV[1])
+local monthly_limit = tonumber(ARGV[2])
+if daily_limit >= 0 then
+    remaining = daily_limit - tonumber(redis.call('GET', KEYS[1]) or '0')
+end
+if monthly_limit >= 0 then
+    local left = monthly_limit - tonumber(redis.call('GET', KEYS[2]) or '0')
+    if remaining == nil or left < remaining then
+        remaining = left
+    end
+end
+
+local prompt_tokens = tonumber(ARGV[3])
+local budget = math.min(tonumber(ARGV[5]), remaining - held - prompt_tokens)
+if budget < tonumber(ARGV[4]) then
+    return {0, budget, '', expired}
+end
+
+local member = ARGV[8] .. ':' .. (prompt_tokens + budget)
+redis.call('ZADD', KEYS[3], tonumber(ARGV[7]), member)
+redis.call('EXPIRE', KEYS[3], tonumber(ARGV[9]))
+return {1, budget, member, expired}
+"""
+
+def _zone(name: str) -> tzinfo:
+    return timezone.utc if name.upper() == "UTC" else ZoneInfo(name)
+
+class UsagePeriods:
+    """The day and month a tier's counters belong to, in that tier's reset time zone.
+
+    Periods are embedded in the counter keys, so a reset is just a new key and
+    nothing has to sweep users. USAGE_RESET_TIMEZONE sets the zone (UTC by default);
+    USAGE_RESET_TIMEZONE_<TIER> overrides it for one tier.
+    """
+
+    def __init__(self):
+        self.default_zone = _zone(os.getenv('USAGE_RESET_TIMEZONE', 'UTC'))
+        self._zones: Dict[str, tzinfo] = {}
+
+    def zone_for(self, tier=None) -> tzinfo:
+        if tier is None:
+            return self.default_zone
+        tier = str(getattr(tier, "value", tier)).upper()
+        if tier not in self._zones:
+            name = os.getenv(f'USAGE_RESET_TIMEZONE_{tier}')
+            self._zones[tier] = _zone(name) if name else self.default_zone
+        return self._zones[tier]
+
+    def epochs(self, tier=None, now: Optional[datetime] = None) -> Tuple[str, str]:
+        """Day and month identifiers that suffix the counter keys"""
+        local = (now or datetime.now(timezone.utc)).astimezone(self.zone_for(tier))
+        return local.strftime("%Y%m%d"), local.strftime("%Y%m")
+
+    def next_resets(self, tier=None, now: Optional[datetime] = None) -> Tuple[datetime, datetime]:
+        """When the current day and month end for a tier"""
+        local = (now or datetime.now(timezone.utc)).astimezone(self.zone_for(tier))
+        midnight = local.replace(hour=0, minute=0, second=0, microsecond=0)
+        next_day = midnight + timedelta(days=1)
+        next_month = (midnight.replace(day=1) + timedelta(days=32)).replace(day=1)
+        return next_day, next_month
+
+class InMemoryUsageStore:
+    """Per-process usage counters, for tests and single-worker development"""
+
+    name = "memory"
+
+    def __init__(self, periods: Optional[UsagePeriods] = None):
+        self.periods = periods or UsagePeriods()
+        # username -> {"d:<day>" / "m:<month>": tokens}
+        self.usage: Dict[str, Dict[str, int]] = {}
+        # username -> {reservation_id: (tokens, expires_at)}
+        self.holds: Dict[str, Dict[str, tuple]] = {}
+        self.stats = {'expired_holds': 0}
+
+    def _used(self, username: str, day: str, month: str) -> Tuple[int, int]:
+        entry = self.usage.get(username, {})
+        return entry.get(f"d:{day}", 0), entry.get(f"m:{month}", 0)
+
+    def _add(self, username: str, day: str, month: str, tokens: int) -> Tuple[int, int]:
+        entry = self.usage.setdefault(username, {})
+        entry[f"d:{day}"] = entry.get(f"d:{day}", 0) + tokens
+        entry[f"m:{month}"] = entry.get(f"m:{month}", 0) + tokens
+        # Keep the current and previous period of each kind, like expiring Redis keys
+        for prefix in ("d:", "m:"):
+            for key in sorted(k for k in entry if k.startswith(prefix))[:-2]:
+                del entry[key]
+        return entry[f"d:{day}"], entry[f"m:{month}"]
+
+    def _held(self, username: str) -> int:
+        held = self.holds.get(username)
+        if not held:
+            return 0
+        now = time.time()
+        for reservation_id in [rid for rid, (_, expires_at) in held.items() if expires_at <= now]:
+            del held[reservation_id]
+            self.stats['expired_holds'] += 1
+        return sum(tokens for tokens, _ in held.values())
+
+    async def get_many(self, usernames: List[str], tiers: Optional[list] = None) -> List[Dict[str, int]]:
+        results = []
+        for username, tier in zip(usernames, tiers or [None] * len(usernames)):
+            daily_used, monthly_used = self._used(username, *self.periods.epochs(tier))
+            results.append({
+                "daily_used": daily_used,
+                "monthly_used": monthly_used,
+                "held": self._held(username)
+            })
+        return results
+
+    async def get(self, username: str, tier=None) -> Dict[str, int]:
+        return (await self.get_many([username], [tier]))[0]
+
+    async def incr_many(self, deltas: Dict[Tuple[str, str, str], int]) -> Dict[Tuple[str, str, str], Dict[str, int]]:
+        """Apply increments keyed by (username, day, month)"""
+        totals = {}
+        for (username, day, month), tokens in deltas.items():
+            daily_used, monthly_used = self._add(username, day, month, tokens)
+            totals[(username, day, month)] = {"daily_used": daily_used, "monthly_used": monthly_used}
+        return totals
+
+    async def incr(self, username: str, tokens: int, tier=None) -> Dict[str, int]:
+        key = (username, *self.periods.epochs(tier))
+        return (await self.incr_many({key: tokens}))[key]
+
+    async def reserve(self, username: str, daily_limit: Optional[int], monthly_limit: Optional[int],
+                      prompt_tokens: int, min_completion: int, max_completion: int,
+                      ttl: float, tier=None) -> Tuple[bool, int, Optional[str]]:
+        # No awaits between the check and the hold, so this is atomic on the event loop
+        daily_used, monthly_used = self._used(username, *self.periods.epochs(tier))
+        remaining = []
+        if daily_limit is not None:
+            remaining.append(daily_limit - daily_used)
+        if monthly_limit is not None:
+            remaining.append(monthly_limit - monthly_used)
+        budget = min(max_completion, min(remaining) - self._held(username) - prompt_tokens)
+        if budget < min_completion:
+            return False, budget, None
+
+        reservation_id = uuid.uuid4().hex
+        self.holds.setdefault(username, {})[reservation_id] = (
+            prompt_tokens + budget,
+            time.time() + ttl
+        )
+        return True, budget, reservation_id
+
+    async def release(self, username: str, reservation_id: str) -> bool:
+        return self.holds.get(username, {}).pop(reservation_id, None) is not None
+
+    def start(self) -> None:
+        pass
+
+    async def aclose(self) -> None:
+        pass
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {**self.stats, 'backend': self.name, 'users': len(self.usage)}
+
+class RedisUsageStore:
+    """Usage counters shared by all workers, under epoch-suffixed keys that expire on their own"""
+
+    name = "redis"
+
+    def __init__(self, redis_client, periods: Optional[UsagePeriods] = None):
+        self.redis = redis_client
+        self.periods = periods or UsagePeriods()
+        self._reserve_script = redis_client.register_script(RESERVE_LUA)
+        self.stats = {'expired_holds': 0}
+
+    @staticmethod
+    def _keys(username: str, day: str, month: str) -> Tuple[str, str, str]:
+        return (
+            f"usage:{username}:d:{day}",
+            f"usage:{username}:m:{month}",
+            f"usage:{username}:holds"
+        )
+
+    async def get_many(self, usernames: List[str], tiers: Optional[list] = None) -> List[Dict[str, int]]:
+        """Read counters and live holds for many users in one round trip"""
+        now = time.time()
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for username, tier in zip(usernames, tiers or [None] * len(usernames)):
+                daily_key, monthly_key, holds_key = self._keys(username, *self.periods.epochs(tier))
+                pipe.mget(daily_key, monthly_key)
+                pipe.zrangebyscore(holds_key, now, "+inf")
+            replies = await pipe.execute()
+
+        results = []
+        for counters, members in zip(replies[0::2], replies[1::2]):
+            results.append({
+                "daily_used": int(counters[0] or 0),
+                "monthly_used": int(counters[1] or 0),
+                "held": sum(int(decode_redis_value(m).rsplit(":", 1)[1]) for m in members)
+            })
+        return results
+
+    async def get(self, username: str, tier=None) -> Dict[str, int]:
+        return (await self.get_many([username], [tier]))[0]
+
+    async def incr_many(self, deltas: Dict[Tuple[str, str, str], int]) -> Dict[Tuple[str, str, str], Dict[str, int]]:
+        """Add increments keyed by (username, day, month) and refresh TTLs in one pipelined round trip"""
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for (username, day, month), tokens in deltas.items():
+                daily_key, monthly_key, _ = self._keys(username, day, month)
+                pipe.incrby(daily_key, tokens)
+                pipe.expire(daily_key, DAILY_TTL)
+                pipe.incrby(monthly_key, tokens)
+                pipe.expire(monthly_key, MONTHLY_TTL)
+            replies = await pipe.execute()
+        return {
+            key: {"daily_used": int(replies[i * 4]), "monthly_used": int(replies[i * 4 + 2])}
+            for i, key in enumerate(deltas)
+        }
+
+    async def incr(self, username: str, tokens: int, tier=None) -> Dict[str, int]:
+        key = (username, *self.periods.epochs(tier))
+        return (await self.incr_many({key: tokens}))[key]
+
+    async def reserve(self, username: str, daily_limit: Optional[int], monthly_limit: Optional[int],
+                      prompt_tokens: int, min_completion: int, max_completion: int,
+                      ttl: float, tier=None) -> Tuple[bool, int, Optional[str]]:
+        now = time.time()
+        ok, budget, member, expired = await self._reserve_script(
+            keys=list(self._keys(username, *self.periods.epochs(tier))),
+            args=[
+                -1 if daily_limit is None else daily_limit,
+                -1 if monthly_limit is None else monthly_limit,
+                prompt_tokens,
+                min_completion,
+                max_completion,
+                now,
+                now + ttl,
+                uuid.uuid4().hex,
+                int(ttl) + 1
+            ]
+        )
+        self.stats['expired_holds'] += int(expired)
+        return bool(ok), int(budget), (decode_redis_value(member) or None)
+
+    async def release(self, username: str, reservation_id: str) -> bool:
+        return bool(await self.redis.zrem(f"usage:{username}:holds", reservation_id))
+
+    def start(self) -> None:
+        pass
+
+    async def aclose(self) -> None:
+        pass
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {**self.stats, 'backend': self.name}
+
+class WriteBehindFlusher(ABC):
+    """Background loop calling flush() every `flush_interval` seconds, or sooner when woken.
+
+    Until start() is called, subclasses write through instead of buffering.
+    """
+
+    def __init__(self, flush_interval: float):
+        self.flush_interval = flush_interval
+        self._wake = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._closing = False
+
+    def start(self) -> None:
+        """Begin periodic flushing"""
+        if self._task is None and self.flush_interval > 0:
+            self._closing = False
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self) -> None:
+        while not self._closing:
+            try:
+                await asyncio.wait_for(self._wake.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            await self.flush()
+
+    @abstractmethod
+    async def flush(self) -> int:
+        """Write everything pending, returning how many entries were written"""
+
+    async def aclose(self) -> None:
+        """Stop the flush loop and write whatever is still pending"""
+        if self._task is not None:
+            self._closing = True
+            self._wake.set()
+            await self._task
+            self._task = None
+        await self.flush()
+
+class BufferedUsageStore(WriteBehindFlusher):
+    """Write-behind wrapper: coalesces increments per user and flushes them in pipelined batches.
+
+    Reads and reservations add the deltas not yet flushed, so limits still see them.
+    """
+
+    # Last known counters kept to answer incr() without a read
+    SNAPSHOT_CACHE_SIZE = 10000
+
+    def __init__(self, inner, flush_interval: float, max_pending_users: int):
+        super().__init__(flush_interval)
+        self.inner = inner
+        self.periods = inner.periods
+        self.name = f"buffered-{inner.name}"
+        self.max_pending_users = max_pending_users
+        # username -> {(day, month): tokens}, so deltas land in the period they were made in
+        self._pending: Dict[str, Dict[Tuple[str, str], int]] = {}
+        self._inflight: Dict[str, Dict[Tuple[str, str], int]] = {}
+        self._snapshots: OrderedDict = OrderedDict()
+        self._flush_lock = asyncio.Lock()
+        self.flush_stats = {
+            'increments': 0,
+            'flushes': 0,
+            'flush_errors': 0,
+            'flushed_users': 0,
+            'flushed_tokens': 0,
+            'last_flush_users': 0,
+            'max_flush_users': 0,
+            'last_flush_ms': 0.0,
+            'max_flush_ms': 0.0,
+            'total_flush_ms': 0.0
+        }
+
+    @property
+    def stats(self) -> Dict[str, Any]:
+        return self.inner.stats
+
+    def _unflushed(self, username: str, day: str, month: str) -> Tuple[int, int]:
+        """Daily and monthly tokens not yet written for the given periods"""
+        daily = monthly = 0
+        for deltas in (self._pending.get(username, {}), self._inflight.get(username, {})):
+            for (delta_day, delta_month), tokens in deltas.items():
+                daily += tokens if delta_day == day else 0
+                monthly += tokens if delta_month == month else 0
+        return daily, monthly
+
+    def _remember(self, key: Tuple[str, str, str], counters: Dict[str, int]) -> None:
+        self._snapshots[key] = {"daily_used": counters["daily_used"], "monthly_used": counters["monthly_used"]}
+        self._snapshots.move_to_end(key)
+        while len(self._snapshots) > self.SNAPSHOT_CACHE_SIZE:
+            self._snapshots.popitem(last=False)
+
+    async def flush(self) -> int:
+        """Write all pending deltas in one batch, returning how many users were flushed"""
+        async with self._flush_lock:
+            if not self._pending:
+                return 0
+            self._inflight, self._pending = self._pending, {}
+            batch = {
+                (username, day, month): tokens
+                for username, deltas in self._inflight.items()
+                for (day, month), tokens in deltas.items()
+            }
+            start = time.perf_counter()
+            try:
+                totals = await self.inner.incr_many(batch)
+            except Exception as e:
+                # Keep the deltas for the next flush rather than losing usage
+                logging.error(f"Usage flush failed for {len(self._inflight)} users: {str(e)}")
+                self.flush_stats['flush_errors'] += 1
+                for (username, day, month), tokens in batch.items():
+                    self._add_pending(username, day, month, tokens)
+                self._inflight = {}
+                return 0
+
+            for key, counters in totals.items():
+                self._remember(key, counters)
+            users = len(self._inflight)
+            self._inflight = {}
+
+            elapsed_ms = (time.perf_counter() - start) * 1000
+            self.flush_stats['flushes'] += 1
+            self.flush_stats['flushed_users'] += users
+            self.flush_stats['flushed_tokens'] += sum(batch.values())
+            self.flush_stats['last_flush_users'] = users
+            self.flush_stats['max_flush_users'] = max(self.flush_stats['max_flush_users'], users)
+            self.flush_stats['last_flush_ms'] = elapsed_ms
+            self.flush_stats['max_flush_ms'] = max(self.flush_stats['max_flush_ms'], elapsed_ms)
+            self.flush_stats['total_flush_ms'] += elapsed_ms
+            return users
+
+    def _add_pending(self, username: str, day: str, month: str, tokens: int) -> None:
+        deltas = self._pending.setdefault(username, {})
+        deltas[(day, month)] = deltas.get((day, month), 0) + tokens
+
+    async def get_many(self, usernames: List[str], tiers: Optional[list] = None) -> List[Dict[str, int]]:
+        tiers = tiers or [None] * len(usernames)
+        results = await self.inner.get_many(usernames, tiers)
+        for username, tier, usage in zip(usernames, tiers, results):
+            day, month = self.periods.epochs(tier)
+            self._remember((username, day, month), usage)
+            daily, monthly = self._unflushed(username, day, month)
+            usage["daily_used"] += daily
+            usage["monthly_used"] += monthly
+        return results
+
+    async def get(self, username: str, tier=None) -> Dict[str, int]:
+        return (await self.get_many([username], [tier]))[0]
+
+    async def incr(self, username: str, tokens: int, tier=None) -> Dict[str, int]:
+        """Buffer the increment and return the last known counters plus everything unflushed"""
+        if self._task is None:
+            return await self.inner.incr(username, tokens, tier)
+
+        day, month = self.periods.epochs(tier)
+        self.flush_stats['increments'] += 1
+        self._add_pending(username, day, month, tokens)
+        if len(self._pending) >= self.max_pending_users:
+            self._wake.set()
+
+        snapshot = self._snapshots.get((username, day, month))
+        if snapshot is None:
+            return await self.get(username, tier)
+        self._snapshots.move_to_end((username, day, month))
+        daily, monthly = self._unflushed(username, day, month)
+        return {"daily_used": snapshot["daily_used"] + daily, "monthly_used": snapshot["monthly_used"] + monthly}
+
+    async def reserve(self, username: str, daily_limit: Optional[int], monthly_limit: Optional[int],
+                      prompt_tokens: int, min_completion: int, max_completion: int,
+                      ttl: float, tier=None) -> Tuple[bool, int, Optional[str]]:
+        # Unflushed usage shrinks the limits, keeping the inner check atomic. Clamp at 0:
+        # a negative limit would read as "no limit" (-1) or break the script
+        daily, monthly = self._unflushed(username, *self.periods.epochs(tier))
+        return await self.inner.reserve(
+            username,
+            None if daily_limit is None else max(0, daily_limit - daily),
+            None if monthly_limit is None else max(0, monthly_limit - monthly),
+            prompt_tokens,
+            min_completion,
+            max_completion,
+            ttl,
+            tier
+        )
+
+    async def release(self, username: str, reservation_id: str) -> bool:
+        return await self.inner.release(username, reservation_id)
+
+    def get_stats(self) -> Dict[str, Any]:
+        flushes = self.flush_stats['flushes']
+        return {
+            **self.inner.get_stats(),
+            **self.flush_stats,
+            'backend': self.name,
+            'pending_users': len(self._pending),
+            'avg_flush_users': self.flush_stats['flushed_users'] / flushes if flushes else 0,
+            'avg_flush_ms': self.flush_stats['total_flush_ms'] / flushes if flushes else 0.0,
+            'flush_interval': self.flush_interval
+        }
+
+def decode_redis_value(value) -> str:
+    return value.decode() if isinstance(value, bytes) else value
+
+def create_usage_store(redis_client=None):
+    """Create the store selected by TOKEN_STORE (redis or memory)"""
+    name = os.getenv('TOKEN_STORE', 'redis').lower()
+    periods = UsagePeriods()
+    if name == "memory":
+        return InMemoryUsageStore(periods)
+    if name == "redis":
+        if redis_client is None:
+            raise ValueError("TOKEN_STORE=redis needs a Redis client")
+        store = RedisUsageStore(redis_client, periods)
+        # Coalesce usage writes unless USAGE_FLUSH_INTERVAL_MS=0
+        flush_interval_ms = float(os.getenv('USAGE_FLUSH_INTERVAL_MS', 250))
+        if flush_interval_ms > 0:
+            return BufferedUsageStore(store, flush_interval_ms / 1000, int(os.getenv('USAGE_FLUSH_MAX_USERS', 1000)))
+        return store
+    raise ValueError(f"Unknown TOKEN_STORE '{name}', expected 'redis' or 'memory'")
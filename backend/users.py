@@ -0,0 +1,233 @@
+from collections import OrderedDict
+from datetime import datetime
+from typing import Any, Dict, Optional
+import logging
+import os
+import time
+from dotenv import load_dotenv
+from pydantic import BaseModel
+from sqlalchemy import (
+    Column, DateTime, Index, Integer, MetaData, String, Table, bindparam, insert, select, update
+)
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import create_async_engine
+
+load_dotenv()
+
+metadata = MetaData()
+
+users_table = Table(
+    "users",
+    metadata,
+    Column("id", Integer, primary_key=True, autoincrement=True),
+    # Username for password logins, "<provider>_<subject>" for OAuth users; also the JWT subject
+    Column("username", String(255), nullable=False, unique=True),
+    Column("email", String(320)),
+    Column("name", String(255)),
+    Column("hashed_password", String(255)),
+    Column("tier", String(32), nullable=False, default="free"),
+    Column("oauth_provider", String(32)),
+    Column("oauth_subject", String(255)),
+    Column("created_at", DateTime, nullable=False, default=datetime.utcnow),
+    Index("ix_users_email", "email"),
+    Index("ix_users_oauth", "oauth_provider", "oauth_subject", unique=True)
+)
+
+# Built once with bound parameters, so SQLAlchemy reuses the compiled SQL and
+# asyncpg reuses its server-side prepared statements across requests
+BY_USERNAME = select(users_table).where(users_table.c.username == bindparam("username"))
+BY_EMAIL = select(users_table).where(users_table.c.email == bindparam("email"))
+BY_OAUTH = select(users_table).where(
+    users_table.c.oauth_provider == bindparam("provider"),
+    users_table.c.oauth_subject == bindparam("subject")
+)
+SET_TIER = update(users_table).where(users_table.c.username == bindparam("match_username")).values(
+    tier=bindparam("tier")
+)
+
+class UserRecord(BaseModel):
+    username: str
+    email: Optional[str] = None
+    name: Optional[str] = None
+    hashed_password: Optional[str] = None
+    tier: str = "free"
+    oauth_provider: Optional[str] = None
+    oauth_subject: Optional[str] = None
+    created_at: Optional[datetime] = None
+
+class UserExistsError(ValueError):
+    """Raised when a username or OAuth identity is already registered"""
+
+class SQLUserRepository:
+    """Users in SQL behind a pooled async engine: SQLite locally, Postgres in production"""
+
+    def __init__(self, database_url: str, pool_size: int = 5, max_overflow: int = 10):
+        self.database_url = database_url
+        options: Dict[str, Any] = {"pool_pre_ping": True}
+        if not database_url.startswith("sqlite"):
+            options.update(pool_size=pool_size, max_overflow=max_overflow)
+        self.engine = create_async_engine(database_url, **options)
+        self.stats = {'lookups': 0, 'misses': 0, 'created': 0, 'conflicts': 0, 'updates': 0}
+
+    async def init(self) -> None:
+        """Create the table and indexes if they don't exist yet"""
+        async with self.engine.begin() as conn:
+            await conn.run_sync(metadata.create_all)
+        logging.info(f"User repository ready on {self.engine.url.render_as_string(hide_password=True)}")
+
+    async def aclose(self) -> None:
+        await self.engine.dispose()
+
+    async def _fetch_one(self, statement, params: Dict[str, Any]) -> Optional[UserRecord]:
+        self.stats['lookups'] += 1
+        async with self.engine.connect() as conn:
+            row = (await conn.execute(statement, params)).mappings().first()
+        if row is None:
+            self.stats['misses'] += 1
+            return None
+        return UserRecord(**{k: v for k, v in row.items() if k != "id"})
+
+    async def get_by_username(self, username: str) -> Optional[UserRecord]:
+        return await self._fetch_one(BY_USERNAME, {"username": username})
+
+    async def get_by_email(self, email: str) -> Optional[UserRecord]:
+        return await self._fetch_one(BY_EMAIL, {"email": email})
+
+    async def get_by_oauth(self, provider: str, subject: str) -> Optional[UserRecord]:
+        return await self._fetch_one(BY_OAUTH, {"provider": provider, "subject": subject})
+
+    async def create(self, username: str, **fields) -> UserRecord:
+        """Insert a user; raises UserExistsError if the username or OAuth identity is taken"""
+        record = UserRecord(username=username, created_at=datetime.utcnow(), **fields)
+        try:
+            async with self.engine.begin() as conn:
+                await conn.execute(insert(users_table), record.model_dump())
+        except IntegrityError:
+            self.stats['conflicts'] += 1
+            raise UserExistsError(f"User {username} already exists")
+        self.stats['created'] += 1
+        return record
+
+    async def get_or_create_oauth(self, provider: str, subject: str, **fields) -> UserRecord:
+        """Find the user for an OAuth identity, creating it on first sign-in"""
+        user = await self.get_by_oauth(provider, subject)
+        if user is not None:
+            return user
+        try:
+            return await self.create(
+                f"{provider}_{subject}", oauth_provider=provider, oauth_subject=subject, **fields
+            )
+        except UserExistsError:
+            # A concurrent sign-in created it first
+            return await self.get_by_oauth(provider, subject)
+
+    async def set_tier(self, username: str, tier: str) -> bool:
+        async with self.engine.begin() as conn:
+            result = await conn.execute(SET_TIER, {"match_username": username, "tier": tier})
+        self.stats['updates'] += 1
+        return result.rowcount > 0
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            **self.stats,
+            'dialect': self.engine.dialect.name,
+            'pool': self.engine.pool.status()
+        }
+
+class CachedUserRepository:
+    """Bounded TTL cache of username lookups in front of a repository.
+
+    Writes through this wrapper invalidate the local entry; other workers pick up
+    changes when their entry expires, so keep the TTL short.
+    """
+
+    def __init__(self, inner, ttl: float, max_size: int):
+        self.inner = inner
+        self.ttl = ttl
+        self.max_size = max_size
+        # username -> (record, expires_at)
+        self._cache: OrderedDict = OrderedDict()
+        # Bumped on every invalidation so a lookup that raced a write doesn't cache stale data
+        self._generation = 0
+        self.cache_stats = {'hits': 0, 'misses': 0, 'expired': 0, 'invalidations': 0, 'evictions': 0}
+
+    async def init(self) -> None:
+        await self.inner.init()
+
+    async def aclose(self) -> None:
+        await self.inner.aclose()
+
+    def invalidate(self, username: str) -> None:
+        """Drop a cached user after its tier or limits change"""
+        self._generation += 1
+        if self._cache.pop(username, None) is not None:
+            self.cache_stats['invalidations'] += 1
+
+    async def get_by_username(self, username: str) -> Optional[UserRecord]:
+        entry = self._cache.get(username)
+        if entry is not None:
+            record, expires_at = entry
+            if expires_at > time.monotonic():
+                self._cache.move_to_end(username)
+                self.cache_stats['hits'] += 1
+                return record
+            del self._cache[username]
+            self.cache_stats['expired'] += 1
+
+        self.cache_stats['misses'] += 1
+        generation = self._generation
+        record = await self.inner.get_by_username(username)
+        # Only existing users are cached, so a fresh registration is never hidden
+        if record is not None and generation == self._generation:
+            self._cache[username] = (record, time.monotonic() + self.ttl)
+            self._cache.move_to_end(username)
+            while len(self._cache) > self.max_size:
+                self._cache.popitem(last=False)
+                self.cache_stats['evictions'] += 1
+        return record
+
+    async def get_by_email(self, email: str) -> Optional[UserRecord]:
+        return await self.inner.get_by_email(email)
+
+    async def get_by_oauth(self, provider: str, subject: str) -> Optional[UserRecord]:
+        return await self.inner.get_by_oauth(provider, subject)
+
+    async def create(self, username: str, **fields) -> UserRecord:
+        return await self.inner.create(username, **fields)
+
+    async def get_or_create_oauth(self, provider: str, subject: str, **fields) -> UserRecord:
+        return await self.inner.get_or_create_oauth(provider, subject, **fields)
+
+    async def set_tier(self, username: str, tier: str) -> bool:
+        self.invalidate(username)
+        updated = await self.inner.set_tier(username, tier)
+        self.invalidate(username)
+        return updated
+
+    def get_stats(self) -> Dict[str, Any]:
+        lookups = self.cache_stats['hits'] + self.cache_stats['misses']
+        return {
+            **self.inner.get_stats(),
+            'cache': {
+                **self.cache_stats,
+                'size': len(self._cache),
+                'ttl': self.ttl,
+                'hit_rate': self.cache_stats['hits'] / lookups if lookups else 0.0
+            }
+        }
+
+def create_user_repository():
+    """Create the repository for USER_DATABASE_URL (SQLite file by default)"""
+    repository = SQLUserRepository(
+        os.getenv('USER_DATABASE_URL', 'sqlite+aiosqlite:///./users.db'),
+        pool_size=int(os.getenv('USER_DB_POOL_SIZE', 5)),
+        max_overflow=int(os.getenv('USER_DB_MAX_OVERFLOW', 10))
+    )
+    # Cache auth-path lookups unless USER_CACHE_TTL=0
+    ttl = float(os.getenv('USER_CACHE_TTL', 30))
+    if ttl > 0:
+        return CachedUserRepository(repository, ttl, int(os.getenv('USER_CACHE_SIZE', 10000)))
+    return repository
+
+# Initialize user repository
+user_repository = create_user_repository()